@@ -162,6 +162,12 @@ class MicroViewNavigationToolbar(NavigationToolbar2WxAgg, wx.ToolBar):
             self.AUTO_THRESHOLD, stockicons.getToolbarBitmap(
                 'autothreshold-wizard-24'),
             'Automatically select threshold from histogram', 'Automatically select threshold from histogram')
+        self.threshold_classes = wx.Choice(
+            self, wx.ID_ANY, choices=['2 classes', '3 classes', '4 classes'])
+        self.threshold_classes.SetSelection(0)
+        self.threshold_classes.SetToolTipString(
+            'Number of classes used by the automatic threshold')
+        self.AddControl(self.threshold_classes)
         self.AddCheckTool(self.SHOW_HIGHLIGHT, stockicons.getToolbarBitmap(
             'highlight'), shortHelp='Show Highlight', longHelp='Show Highlight')
         self.AddSimpleTool(self.COPY_HIGHLIGHT, stockicons.getToolbarBitmap(
@@ -218,6 +224,9 @@ class MicroViewNavigationToolbar(NavigationToolbar2WxAgg, wx.ToolBar):
         self.bCursorCanBeDisplayed = True
         NavigationToolbar2WxAgg.release(self, evt)
 
+    def GetThresholdClasses(self):
+        return self.threshold_classes.GetSelection() + 2
+
     def ShouldIShowCursor(self):
         return (self.bCursorCanBeDisplayed and self.bCursorDisplayEnabled)
 
@@ -539,9 +548,16 @@ class BasePlotWindow(VTKPlotWindowGUI.VTKPlotWindowGUI):
         self._current_index = evt.GetCurrentImageIndex()
 
     def showThresholdMarker(self, threshold):
+        """Show a single threshold, or a sequence of multi-level thresholds"""
+
+        thresholds = list(np.atleast_1d(threshold))
 
-        dlg = wx.MessageDialog(self, 'threshold:' + ' %0.1f' % (
-            threshold), 'Auto-Threshold', wx.OK | wx.ICON_INFORMATION)
+        if len(thresholds) == 1:
+            label = 'threshold:'
+        else:
+            label = 'thresholds:'
+        dlg = wx.MessageDialog(self, label + ', '.join(' %0.1f' % t for t in thresholds),
+                               'Auto-Threshold', wx.OK | wx.ICON_INFORMATION)
         dlg.ShowModal()
         dlg.Destroy()
 
@@ -550,7 +566,7 @@ class BasePlotWindow(VTKPlotWindowGUI.VTKPlotWindowGUI):
             # draw Otsu threshold
             if self._otsu_marker:
                 self._otsu_marker.remove()
-            self._otsu_marker = self.axes.scatter([self._otsu_threshold], [-1000], c='r',
+            self._otsu_marker = self.axes.scatter(thresholds, [-1000] * len(thresholds), c='r',
                                                   marker='^', linewidths=0, zorder=3)
 
     def GetMouseMoveLabelFormat(self):
@@ -704,18 +720,32 @@ class BasePlotWindow(VTKPlotWindowGUI.VTKPlotWindowGUI):
     def GetwlTableInvisible(self):
         return self._wlTableInvisible
 
-    def CreateHighlightLookupTable(self):
+    def CreateHighlightLookupTable(self, lower, upper, integer_data=False):
+        """Create a colour table that highlights image values in [lower, upper]
+
+        The overlay shows the image itself, so the table has three entries:
+        values below and above the selection map to the transparent first and
+        last entries, and values inside it map to the middle one.
+        """
+
+        lower, upper = min(lower, upper), max(lower, upper)
+        if integer_data:
+            # put the bin edges between integers, so that round-off can't
+            # move a value at either end of the selection out of it
+            lower = math.ceil(lower) - 0.5
+            upper = math.floor(upper) + 0.5
+        else:
+            lower -= max(abs(lower), 1.0) * 1e-9
+            upper += max(abs(upper), 1.0) * 1e-9
+
+        width = max(upper - lower, 1e-9)
 
-        # Create colour table for histogram overlay
-        table = vtk.vtkWindowLevelLookupTable()
-        table.SetSaturationRange(0, 0)
-        table.SetHueRange(0, 0)
-        table.SetValueRange(0, 1)
-        table.SetLevel(0.5)
-        table.SetWindow(1.0)
-        table.SetNumberOfColors(2)
+        table = vtk.vtkLookupTable()
+        table.SetNumberOfTableValues(3)
+        table.SetTableRange(lower - width, upper + width)
         table.SetTableValue(0, 0.0, 0.0, 0.0, 0.0)
         table.SetTableValue(1, 1.0, 0.0, 0.0, 1.0)
+        table.SetTableValue(2, 0.0, 0.0, 0.0, 0.0)
         table.Build()
         return table
 
@@ -747,7 +777,8 @@ class BasePlotWindow(VTKPlotWindowGUI.VTKPlotWindowGUI):
         This routine posts an AutoThresholdCommandEvent command in order to request a new calculation of an
         optimal Otsu threshold.
         """
-        event.notify(AutoThresholdCommandEvent())
+        event.notify(AutoThresholdCommandEvent(
+            self.toolbar.GetThresholdClasses()))
 
     def SetInput(self, inp):
 
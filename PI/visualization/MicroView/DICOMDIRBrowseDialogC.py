@@ -1,4 +1,11 @@
 import logging
+import collections
+import glob
+import hashlib
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import appdirs
 import DICOMDIRBrowseDialog
 from PI.visualization.common.wxDICOMPropertyPage import populate_dicom_properties
 from PI.visualization.MicroView.interfaces import IMicroViewOutput
@@ -11,8 +18,180 @@ import os
 from zope import component
 
 
+class DICOMPreviewCache(object):
+
+    """Preview thumbnails of DICOM images, kept in memory and on disk.
+
+    Entries are keyed by SOPInstanceUID (or filename, if unknown) together with
+    the file's modification time and size, so a changed file is decoded again.
+    The thumbnails on disk are pruned, least recently used first, to keep them
+    within disk_size bytes and max_age seconds.  Safe to use from worker
+    threads."""
+
+    _cache_version = 2
+
+    # longest side of a stored thumbnail, in pixels
+    max_size = 256
+
+    # thumbnails written between prunings of the disk cache
+    prune_interval = 50
+
+    def __init__(self, memory_size=64, disk_size=256 * 1024 * 1024, max_age=30 * 24 * 3600):
+        self._dir = os.path.join(appdirs.user_cache_dir(
+            "MicroView", "Parallax Innovations"), "DICOMPreviews")
+        self._memory = collections.OrderedDict()
+        self._memory_size = memory_size
+        self._disk_size = disk_size
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        # prune on the first write
+        self._puts = 0
+
+    def _Key(self, filename, uid):
+        stat = os.stat(filename)
+        return hashlib.sha1('{0}|{1}|{2}|{3}'.format(
+            uid or os.path.abspath(filename), stat.st_mtime, stat.st_size,
+            self._cache_version)).hexdigest()
+
+    def Get(self, filename, uid=None):
+        """Returns the cached thumbnail, or None"""
+        try:
+            key = self._Key(filename, uid)
+        except OSError:
+            return None
+
+        with self._lock:
+            thumbnail = self._memory.pop(key, None)
+            if thumbnail is not None:
+                self._memory[key] = thumbnail
+                return thumbnail
+
+        _filename = os.path.join(self._dir, key + '.npz')
+        try:
+            with np.load(_filename) as f:
+                thumbnail = f['thumbnail']
+        except:
+            return None
+
+        # a thumbnail that's used is the last to be pruned
+        try:
+            os.utime(_filename, None)
+        except OSError:
+            pass
+
+        self._Remember(key, thumbnail)
+        return thumbnail
+
+    def Put(self, filename, uid, thumbnail):
+        try:
+            key = self._Key(filename, uid)
+        except OSError:
+            return thumbnail
+
+        self._Remember(key, thumbnail)
+
+        # write to a temporary file first so a reader never sees half a file
+        _filename = os.path.join(self._dir, key + '.npz')
+        tmp_filename = os.path.join(self._dir, key + '.tmp.npz')
+        try:
+            if not os.path.exists(self._dir):
+                os.makedirs(self._dir)
+            np.savez_compressed(tmp_filename, thumbnail=thumbnail)
+            if os.path.exists(_filename):
+                os.remove(_filename)
+            os.rename(tmp_filename, _filename)
+        except:
+            logging.debug("Unable to write DICOM preview {0}".format(_filename))
+
+        with self._lock:
+            prune = (self._puts % self.prune_interval == 0)
+            self._puts += 1
+        if prune:
+            self.Prune()
+
+        return thumbnail
+
+    def Prune(self):
+        """Remove the least recently used thumbnails from disk, until those
+        left are within the size and age limits"""
+
+        entries = []
+        for _filename in glob.glob(os.path.join(self._dir, '*.npz')):
+            # being written
+            if _filename.endswith('.tmp.npz'):
+                continue
+            try:
+                stat = os.stat(_filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, _filename))
+
+        # newest first
+        entries.sort(reverse=True)
+        oldest = time.time() - self._max_age
+        total = 0
+        for mtime, size, _filename in entries:
+            total += size
+            if total > self._disk_size or mtime < oldest:
+                try:
+                    os.remove(_filename)
+                except OSError:
+                    pass
+
+    def _Remember(self, key, thumbnail):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._memory[key] = thumbnail
+            while len(self._memory) > self._memory_size:
+                self._memory.popitem(last=False)
+
+    def Prefetch(self, filename, uid=None):
+        """Decode and cache a thumbnail if it isn't cached already"""
+        if self.Get(filename, uid) is not None:
+            return
+        try:
+            self.Put(filename, uid, self.MakeThumbnail(dicom.read_file(filename)))
+        except:
+            logging.debug("Unable to prefetch DICOM preview for '{0}'".format(filename))
+
+    @classmethod
+    def MakeThumbnail(cls, ds):
+        """Returns a thumbnail of a DICOM image.
+
+        The thumbnail is a subsampled uint8 array, either (rows, columns) for
+        greyscale or (rows, columns, 3) for colour images.  Multi-frame images
+        are represented by their middle frame."""
+
+        arr = ds.pixel_array
+        rgb = int(getattr(ds, 'SamplesPerPixel', 1)) > 1
+
+        if arr.ndim == (4 if rgb else 3):
+            arr = arr[arr.shape[0] // 2]
+
+        # colour-by-plane data
+        if rgb and arr.shape[-1] != 3 and arr.shape[0] == 3:
+            arr = np.rollaxis(arr, 0, 3)
+
+        # subsample large images - the preview is small anyway
+        step = max(1, int(np.ceil(max(arr.shape[:2]) / float(cls.max_size))))
+        arr = arr[::step, ::step]
+
+        if arr.dtype != np.uint8 or not rgb:
+            try:
+                arr = bytescale(arr)
+            except ValueError:
+                # problems exist in scipy.misc.bytescale...
+                arr = arr.astype('float32')
+                arr = (arr - arr.min()) / (arr.max() - arr.min()) * 255.0
+                arr = arr.astype('uint8')
+        return np.ascontiguousarray(arr)
+
+
 class DICOMDIR_DisplayPanel(wx.Panel):
 
+    # shared between dialogs, so previously seen series display immediately
+    _previews = DICOMPreviewCache()
+
     def __init__(self, parent, path=None, main=None):
 
         wx.Panel.__init__(self, parent, -1)
@@ -21,7 +200,13 @@ class DICOMDIR_DisplayPanel(wx.Panel):
         self._ds = None
         self._search_filter = None
 
+        # decodes previews of neighbouring series in the background.  Requests
+        # made before the latest selection are skipped
+        self._prefetch_pool = ThreadPool(1)
+        self._prefetch_generation = 0
+
         self.Bind(wx.EVT_SIZE, self.OnSize)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
 
         self.tree = gizmos.TreeListCtrl(self, -1, style=wx.TR_DEFAULT_STYLE
                                         #| wx.TR_HAS_BUTTONS
@@ -275,6 +460,11 @@ class DICOMDIR_DisplayPanel(wx.Panel):
     def OnSize(self, evt):
         self.tree.SetSize(self.GetSize())
 
+    def OnDestroy(self, evt):
+        evt.Skip()
+        if evt.GetEventObject() is self:
+            self._prefetch_pool.terminate()
+
     def OnSelectionChanged(self, evt):
         evt.Skip()
         self.UpdateSelection(evt)
@@ -334,18 +524,24 @@ class DICOMDIR_DisplayPanel(wx.Panel):
         series, acqnum = ds, num
         image_records = series.children
 
-        image_filenames = self.GetSelectedSeriesFilenames(series, acqnum)
+        images = self.GetSelectedSeriesImages(series, acqnum)
+        image_filenames = [filename for filename, uid in images]
 
         ds = None
-        if len(image_filenames) > 0:
-            filename = image_filenames[len(image_filenames) / 2]
+        if len(images) > 0:
+            filename, uid = images[len(images) / 2]
             if filename != self._last_filename:
                 self._last_filename = filename
                 with wx.BusyCursor():
-                    self._ds = ds = self.UpdateDICOMDetailsFromFile(filename)
+                    self._ds = ds = self.UpdateDICOMDetailsFromFile(filename, uid)
 
         self.filenames = image_filenames
 
+        # get the series either side ready in case the user moves on to them
+        self._prefetch_generation += 1
+        for neighbour in (self.tree.GetPrevSibling(item), self.tree.GetNextSibling(item)):
+            self.PrefetchPreview(neighbour)
+
         # create a canonical series name
         name = ''
         if ds:
@@ -358,11 +554,38 @@ class DICOMDIR_DisplayPanel(wx.Panel):
                 name += '{}'.format(ds.PatientName.strip()).replace(' ', '_')
             self.canonical_series_name = name
 
+    def PrefetchPreview(self, item):
+        """Decode the preview for a series tree item in the background"""
+
+        if not item.IsOk():
+            return
+        data = self.tree.GetItemData(item)
+        if not data:
+            return
+        series, acqnum = data.GetData()
+        if series.DirectoryRecordType != 'SERIES':
+            return
+
+        images = self.GetSelectedSeriesImages(series, acqnum)
+        if len(images) > 0:
+            filename, uid = images[len(images) / 2]
+            self._prefetch_pool.apply_async(
+                self._Prefetch, (self._prefetch_generation, filename, uid))
+
+    def _Prefetch(self, generation, filename, uid):
+        # runs on the prefetch thread, after any requests queued before it
+        if generation == self._prefetch_generation:
+            self._previews.Prefetch(filename, uid)
+
     def GetSelectedSeriesFilenames(self, series, acqnum):
+        return [filename for filename, uid in self.GetSelectedSeriesImages(series, acqnum)]
+
+    def GetSelectedSeriesImages(self, series, acqnum):
+        """Returns (filename, SOPInstanceUID) pairs for the images in a series"""
 
         image_records = series.children
 
-        image_filenames = []
+        images = []
         for image_rec in image_records:
 
             # sanity check - is this an image?
@@ -383,9 +606,10 @@ class DICOMDIR_DisplayPanel(wx.Panel):
                     self.base_dir, image_rec.ReferencedFileID, folder_bug_workaround=True)
 
             # sanity check - some bad DICOMDIR files reference folder name
-            image_filenames.append(filename)
+            images.append(
+                (filename, image_rec.get('ReferencedSOPInstanceUIDInFile')))
 
-        return image_filenames
+        return images
 
     def GetFilenames(self):
         return self.filenames
@@ -396,11 +620,19 @@ class DICOMDIR_DisplayPanel(wx.Panel):
     def GetCanonicalSeriesName(self):
         return self.canonical_series_name
 
-    def UpdateDICOMDetailsFromFile(self, filename):
-        """load DICOM image a prepare a thumbnail bitmap. Also update dicom details."""
+    def UpdateDICOMDetailsFromFile(self, filename, uid=None):
+        """load DICOM image a prepare a thumbnail bitmap. Also update dicom details.
 
+        Thumbnails are cached, in which case only the header is read."""
+
+        arr = self._previews.Get(filename, uid)
         try:
-            ds = dicom.read_file(filename)
+            if arr is None:
+                ds = dicom.read_file(filename)
+                arr = self._previews.Put(
+                    filename, uid, DICOMPreviewCache.MakeThumbnail(ds))
+            else:
+                ds = dicom.read_file(filename, stop_before_pixels=True)
         except Exception, e:
             logging.exception("DICOMDIRBrowseDialogC")
             msg = "Unable to read file '{}'".format(filename)
@@ -413,18 +645,10 @@ class DICOMDIR_DisplayPanel(wx.Panel):
                 dlg.Destroy()
             return
 
-        arr = ds.pixel_array
         if len(arr.shape) == 3:
-            _, _h, _w = arr.shape
+            _h, _w, _ = arr.shape
         else:
             _h, _w = arr.shape
-            try:
-                arr = bytescale(arr)
-            except ValueError:
-                # problems exist in scipy.misc.bytescale...
-                arr = arr.astype('float32')
-                arr = (arr - arr.min()) / (arr.max() - arr.min()) * 255.0
-                arr = arr.astype('uint8')
             new_arr = np.zeros([_h, _w, 3], dtype='uint8')
             new_arr[:, :, 0] = arr
             new_arr[:, :, 1] = arr
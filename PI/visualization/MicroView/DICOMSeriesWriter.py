@@ -0,0 +1,215 @@
+# =========================================================================
+#
+# Copyright (c) 2000-2008 GE Healthcare
+# Copyright (c) 2011-2015 Parallax Innovations Inc.
+#
+# Use, modification and redistribution of the software, in source or
+# binary forms, are permitted provided that the following terms and
+# conditions are met:
+#
+# 1) Redistribution of the source code, in verbatim or modified
+#   form, must retain the above copyright notice, this license,
+#   the following disclaimer, and any notices that refer to this
+#   license and/or the following disclaimer.
+#
+# 2) Redistribution in binary form must include the above copyright
+#    notice, a copy of this license and the following disclaimer
+#   in the documentation or with other materials provided with the
+#   distribution.
+#
+# 3) Modified copies of the source code must be clearly marked as such,
+#   and must not be misrepresented as verbatim copies of the source code.
+#
+# EXCEPT WHEN OTHERWISE STATED IN WRITING BY THE COPYRIGHT HOLDERS AND/OR
+# OTHER PARTIES, THE COPYRIGHT HOLDERS AND/OR OTHER PARTIES PROVIDE THE
+# SOFTWARE "AS IS" WITHOUT EXPRESSED OR IMPLIED WARRANTY INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE.  IN NO EVENT UNLESS AGREED TO IN WRITING WILL
+# ANY COPYRIGHT HOLDER OR OTHER PARTY WHO MAY MODIFY AND/OR REDISTRIBUTE
+# THE SOFTWARE UNDER THE TERMS OF THIS LICENSE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, LOSS OF DATA OR DATA BECOMING INACCURATE OR LOSS OF PROFIT OR
+# BUSINESS INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE OR INABILITY TO
+# USE THE SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+#
+# =========================================================================
+
+#
+# This file represents a derivative work by Parallax Innovations Inc.
+
+"""
+Parallel writing of a volume as a series of single-slice DICOM files.
+
+DICOMSeriesWriter builds the header elements that are common to every slice
+once, including a new SeriesInstanceUID for each series it writes, and
+precomputes the few that differ (InstanceNumber, ImagePositionPatient,
+SliceLocation and SOPInstanceUID).  Slices are then
+encoded and written on a thread pool with a bounded number in flight, so
+writes to high-latency storage overlap without the whole series being
+encoded into memory at once.  Each file is written to a temporary name,
+flushed to disk and renamed into place, so a partial file is never left
+behind under its final name.
+"""
+
+import collections
+import multiprocessing
+import os
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import dicom
+from dicom.dataset import Dataset, FileDataset
+import numpy
+from vtk.util.numpy_support import vtk_to_numpy
+from zope import event
+
+from PI.visualization.common.events import ProgressEvent
+
+
+class DICOMSeriesWriter(object):
+
+    """Write the slices of a vtkImageData as DICOM files, in parallel."""
+
+    # writing is dominated by I/O latency, so use more threads than cores
+    max_workers = 4 * multiprocessing.cpu_count()
+
+    def __init__(self, header, base_uid):
+        """header is a FileDataset holding the elements common to every slice,
+        such as the one made by MicroViewOutput.CreateDefaultDICOMFile()"""
+
+        self._header = header
+        self._base_uid = base_uid
+
+    @staticmethod
+    def CanWrite(image):
+        """True if image's scalars can be stored as DICOM pixel data"""
+        dtype = numpy.dtype(vtk_to_numpy(image.GetPointData().GetScalars()).dtype)
+        return image.GetNumberOfScalarComponents() in (1, 3) and \
+            dtype.kind in 'iu' and dtype.itemsize in (1, 2, 4)
+
+    def _NewRootUID(self):
+        """A root UID for one series; the series and its slices add a number to it"""
+        return '{0}.{1}'.format(self._base_uid, uuid.uuid4().int % 10 ** 24)
+
+    def _CommonElements(self, image, arr, root):
+        """The header shared by every slice, including the pixel description"""
+
+        common = Dataset()
+        common.update(self._header)
+
+        # the header may be copied from the image that was read, so a series
+        # of its own stops an export from being merged with its source, or
+        # with an earlier export of the same image
+        common.add_new(0x0020000E, 'UI', '{0}.0'.format(root))  # SeriesInstanceUID
+
+        nz, ny, nx, nc = arr.shape
+        spacing = image.GetSpacing()
+        bits = arr.dtype.itemsize * 8
+
+        common.add_new(0x00280002, 'US', nc)                     # SamplesPerPixel
+        common.add_new(0x00280004, 'CS', 'MONOCHROME2' if nc == 1 else 'RGB')
+        if nc > 1:
+            common.add_new(0x00280006, 'US', 0)                  # PlanarConfiguration
+        common.add_new(0x00280010, 'US', ny)                     # Rows
+        common.add_new(0x00280011, 'US', nx)                     # Columns
+        common.add_new(0x00280030, 'DS', [spacing[1], spacing[0]])  # PixelSpacing
+        common.add_new(0x00180050, 'DS', spacing[2])             # SliceThickness
+        common.add_new(0x00280100, 'US', bits)                   # BitsAllocated
+        common.add_new(0x00280101, 'US', bits)                   # BitsStored
+        common.add_new(0x00280102, 'US', bits - 1)               # HighBit
+        common.add_new(0x00280103, 'US', 1 if arr.dtype.kind == 'i' else 0)
+
+        return common
+
+    def _SliceElements(self, image, nz, root):
+        """Per-slice (InstanceNumber, ImagePositionPatient, SOPInstanceUID) values"""
+
+        spacing = image.GetSpacing()
+        origin = image.GetOrigin()
+        extent = image.GetExtent()
+
+        # the header's position is the source image's, which no longer holds
+        # once the image has been cropped or resampled, so start from the
+        # image's own first voxel
+        first = numpy.array([origin[i] + extent[2 * i] * spacing[i] for i in range(3)])
+
+        # step along the slice normal if the header describes the orientation,
+        # otherwise along z
+        try:
+            orientation = numpy.array(map(float, self._header.ImageOrientationPatient))
+            normal = numpy.cross(orientation[:3], orientation[3:])
+        except (AttributeError, ValueError, TypeError):
+            normal = numpy.array([0.0, 0.0, 1.0])
+
+        # each slice adds its instance number to the series' root UID
+        deltas = []
+        for z in range(nz):
+            position = first + z * spacing[2] * normal
+            deltas.append((z + 1, ['%.6g' % p for p in position], '{0}.{1}'.format(root, z + 1)))
+        return deltas
+
+    def _WriteSlice(self, filename, common, delta, pixels):
+
+        instance, position, uid = delta
+
+        file_meta = Dataset()
+        file_meta.update(self._header.file_meta)
+        file_meta.add_new(0x00020003, 'UI', uid)                 # MediaStorageSOPInstanceUID
+
+        ds = FileDataset(filename, {}, file_meta=file_meta, preamble="\0" * 128)
+        ds.update(common)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+
+        # replace, rather than modify, the shared elements
+        ds.add_new(0x00080018, 'UI', uid)                        # SOPInstanceUID
+        ds.add_new(0x00200013, 'IS', instance)                   # InstanceNumber
+        ds.add_new(0x00200032, 'DS', position)                   # ImagePositionPatient
+        ds.add_new(0x00201041, 'DS', position[2])                # SliceLocation
+        ds.add_new(0x7FE00010, 'OB' if pixels.dtype.itemsize == 1 else 'OW',
+                   pixels.astype(pixels.dtype.newbyteorder('<')).tostring())
+
+        tmp_filename = filename + '.tmp'
+        dicom.write_file(tmp_filename, ds)
+        with open(tmp_filename, 'rb+') as _f:
+            os.fsync(_f.fileno())
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+
+    def Write(self, image, filenames, title="Writing DICOM slices..."):
+        """Write each z-slice of an (updated) vtkImageData to the corresponding filename"""
+
+        x0, x1, y0, y1, z0, z1 = image.GetExtent()
+        nz = z1 - z0 + 1
+        if len(filenames) != nz:
+            raise ValueError("Expected %d filenames, got %d" % (nz, len(filenames)))
+
+        arr = vtk_to_numpy(image.GetPointData().GetScalars()).reshape(
+            nz, y1 - y0 + 1, x1 - x0 + 1, image.GetNumberOfScalarComponents())
+
+        root = self._NewRootUID()
+        common = self._CommonElements(image, arr, root)
+        deltas = self._SliceElements(image, nz, root)
+
+        def write(z):
+            # DICOM rows run top to bottom
+            pixels = arr[z, ::-1]
+            if pixels.shape[-1] == 1:
+                pixels = pixels[..., 0]
+            self._WriteSlice(filenames[z], common, deltas[z], pixels)
+
+        max_in_flight = 2 * self.max_workers
+        pool = ThreadPool(max(1, min(self.max_workers, nz)))
+        pending = collections.deque()
+        done = 0
+        try:
+            for z in range(nz):
+                pending.append(pool.apply_async(write, (z,)))
+                while len(pending) >= max_in_flight or (z == nz - 1 and pending):
+                    # raises the worker's exception, if any
+                    pending.popleft().get()
+                    done += 1
+                    event.notify(ProgressEvent(title, float(done) / nz))
+        finally:
+            pool.terminate()
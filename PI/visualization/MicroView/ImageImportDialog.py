@@ -140,6 +140,12 @@ class ImageImportDialog ( wx.Dialog ):
 	    self.m_check3DImage = wx.CheckBox( self.m_panelMainDialog, wx.ID_ANY, u"3D image", wx.DefaultPosition, wx.DefaultSize, 0 )
 	    bSizer3.Add( self.m_check3DImage, 0, wx.ALL, 5 )
 	
+	    self.m_checkMemoryMap = wx.CheckBox( self.m_panelMainDialog, wx.ID_ANY, u"Memory-map file", wx.DefaultPosition, wx.DefaultSize, 0 )
+	    self.m_checkMemoryMap.SetToolTipString( u"Map a 3D raw file into memory instead of reading it, so that only the slices being viewed are loaded" )
+	    self.m_checkMemoryMap.Enable( False )
+	
+	    bSizer3.Add( self.m_checkMemoryMap, 0, wx.ALL, 5 )
+	
 	
 	    Options.Add( bSizer3, 0, wx.EXPAND, 5 )
 	
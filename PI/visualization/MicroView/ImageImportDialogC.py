@@ -1,4 +1,5 @@
 import appdirs
+import collections
 import logging
 import numpy as np
 import os
@@ -35,6 +36,7 @@ class ImageImportDialogSettings(object):
         self.bIsRawImage = True
         self.bShouldIConvertToGreyscale = False
         self.bIs3DImage = False
+        self.bMemoryMapRawImage = False
         self.header_size = 0
         self.data_type = 'short'
         self.data_endian = 'little endian'
@@ -50,6 +52,10 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
     A customized image input dialog.
     """
 
+    # image metadata found by probe_image_metadata(), keyed by (path, mtime, size)
+    _metadata_cache = collections.OrderedDict()
+    _metadata_cache_size = 64
+
     def __init__(self, parent):
 
         # Start by calling base class constructor
@@ -94,6 +100,8 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
         self.m_checkConvertToGrayscale.SetValue(
             state.bShouldIConvertToGreyscale)
         self.m_check3DImage.SetValue(state.bIs3DImage)
+        self.m_checkMemoryMap.SetValue(
+            getattr(state, 'bMemoryMapRawImage', False))
         self.m_textCtrlHeaderSize.ChangeValue(str(state.header_size))
         self.m_choiceDataType.SetStringSelection(state.data_type)
         self.m_choiceDataEndian.SetStringSelection(state.data_endian)
@@ -107,6 +115,7 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
         self.m_checkBoxFlipImage.Enable(state.bIsRawImage)
         if not state.bIsRawImage:
             self.m_checkBoxFlipImage.SetValue(False)
+        self.m_checkMemoryMap.Enable(state.bIsRawImage and state.bIs3DImage)
 
         self.m_textCtrlZSize.Enable(state.bIs3DImage)
 
@@ -129,6 +138,7 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
         state.bShouldIConvertToGreyscale = self.m_checkConvertToGrayscale.GetValue(
         )
         state.bIs3DImage = self.m_check3DImage.GetValue()
+        state.bMemoryMapRawImage = self.m_checkMemoryMap.GetValue()
         state.header_size = self.m_textCtrlHeaderSize.GetValue()
         state.data_type = self.m_choiceDataType.GetStringSelection()
         state.data_endian = self.m_choiceDataEndian.GetStringSelection()
@@ -143,6 +153,9 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
     def isGrayScaleRequested(self):
         return self.m_checkConvertToGrayscale.IsChecked()
 
+    def isMemoryMapRequested(self):
+        return self.m_checkMemoryMap.IsEnabled() and self.m_checkMemoryMap.IsChecked()
+
     def ImageSizeOk(self, szInBytes):
         """Check the size of imported image to see
         if it will fit into memory. This seems only an issue for
@@ -314,6 +327,72 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
     def GetFileList(self):
         return self._file_list
 
+    def probe_image_metadata(self, full_name):
+        """Determine the number of channels, spacing, extent, scalar type and byte order
+        of the image the reader is pointed at, without reading any voxel data.
+
+        Results are cached per file path, modification time and size, so browsing back
+        and forth in the dialog doesn't touch the file again.
+        """
+
+        try:
+            st = os.stat(full_name)
+            key = (full_name, st.st_mtime, st.st_size)
+        except OSError:
+            key = None
+
+        cache = ImageImportDialogC._metadata_cache
+        if key in cache:
+            metadata = cache.pop(key)
+            cache[key] = metadata
+            return metadata
+
+        # only the header is read here - UpdateInformation() runs the reader's
+        # RequestInformation pass, which doesn't allocate or read the image
+        if vtk.vtkVersion().GetVTKMajorVersion() > 5:
+            self._reader.UpdateInformation()
+            info = self._reader.GetOutputInformation(0)
+            metadata = {
+                'number_channels': vtk.vtkImageData.GetNumberOfScalarComponents(info),
+                'spacing': tuple(info.Get(vtk.vtkDataObject.SPACING())),
+                'extent': tuple(info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())),
+                'scalar_type': vtk.vtkImageData.GetScalarType(info),
+            }
+        else:
+            o = self._reader.GetOutput()
+            o.UpdateInformation()
+            metadata = {
+                'number_channels': o.GetNumberOfScalarComponents(),
+                'spacing': tuple(o.GetSpacing()),
+                'extent': tuple(o.GetWholeExtent()),
+                'scalar_type': o.GetScalarType(),
+            }
+
+        x0, x1, y0, y1, z0, z1 = metadata['extent']
+        if metadata['number_channels'] < 1 or x1 < x0 or y1 < y0 or z1 < z0:
+            # some readers only find out about the image when they read it
+            logging.info("Image header incomplete - reading {0}".format(full_name))
+            o = self._reader.GetOutput()
+            if vtk.vtkVersion().GetVTKMajorVersion() > 5:
+                self._reader.Update()
+            else:
+                o.Update()
+            metadata = {
+                'number_channels': o.GetNumberOfScalarComponents(),
+                'spacing': tuple(o.GetSpacing()),
+                'extent': tuple(o.GetExtent()),
+                'scalar_type': o.GetScalarType(),
+            }
+
+        metadata['byte_order'] = self._reader.GetDataByteOrder()
+
+        if key is not None:
+            cache[key] = metadata
+            while len(cache) > ImageImportDialogC._metadata_cache_size:
+                cache.popitem(last=False)
+
+        return metadata
+
     def guess_image_pixel_size(self, full_name):
         # try to guess what the pixel size is
         try:
@@ -323,19 +402,13 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
             # other than None
 
             if self._reader._reader is not None:
-                o = self._reader.GetOutput()
-
-                if vtk.vtkVersion().GetVTKMajorVersion() > 5:
-                    o.Update()
-                else:
-                    # this is undesirable...
-                    o.Update()
+                metadata = self.probe_image_metadata(full_name)
 
                 # if we got this far, the images are known to us
                 self.m_textCtrlNumberChannels.ChangeValue(
-                    str(o.GetNumberOfScalarComponents()))
+                    str(metadata['number_channels']))
 
-                spacing = list(o.GetSpacing())
+                spacing = list(metadata['spacing'])
 
                 if self.bIsDICOM:
                     indices = [0]
@@ -348,7 +421,7 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
 
                 self.SetSpacing(spacing)
                 # update dimensions without reading image
-                x0, x1, y0, y1, z0, z1 = o.GetWholeExtent()
+                x0, x1, y0, y1, z0, z1 = metadata['extent']
                 x = x1 - x0 + 1
                 y = y1 - y0 + 1
                 z = z1 - z0 + 1
@@ -369,6 +442,7 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
                 # we know about this file type, so it isn't raw
                 self.m_checkRawImage.SetValue(False)
                 self.m_checkBoxFlipImage.Enable(False)
+                self.m_checkMemoryMap.Enable(False)
 
                 # dicom images need flipping?
                 #if self.bIsDICOM:
@@ -379,7 +453,7 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
                 self.m_panelRawParameters.Enable(False)
 
                 # update scalar type
-                scalar_type = o.GetScalarType()
+                scalar_type = metadata['scalar_type']
 
                 obj = self.m_choiceDataType
 
@@ -397,7 +471,7 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
                     obj.SetStringSelection('double')
 
                 # determine byte order
-                order = self._reader.GetDataByteOrder()
+                order = metadata['byte_order']
                 self.m_choiceDataEndian.SetSelection(1 - order)
 
             else:
@@ -405,6 +479,7 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
                 self.m_checkRawImage.SetValue(True)
                 self.m_panelRawParameters.Enable(True)
                 self.m_checkBoxFlipImage.Enable(True)
+                self.m_checkMemoryMap.Enable(self.m_check3DImage.GetValue())
                 self.m_textCtrlImageTitle.ChangeValue("Raw Data Import")
         except:
             logging.exception("ImageImportDialog")
@@ -558,6 +633,8 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
         self.m_checkBoxFlipImage.Enable(evt.IsChecked())
         if not evt.IsChecked():
             self.m_checkBoxFlipImage.SetValue(False)
+        self.m_checkMemoryMap.Enable(
+            evt.IsChecked() and self.m_check3DImage.GetValue())
 
     def ToggleGrayScale(self, evt):
         self.updateButtonState()
@@ -575,6 +652,8 @@ class ImageImportDialogC(ImageImportDialog.ImageImportDialog):
             self.m_textCtrlZSize.Enable(False)
             self.m_spinCtrlFirstNum.Enable(True)
             self.m_spinCtrlLastNum.Enable(True)
+        self.m_checkMemoryMap.Enable(
+            evt.IsChecked() and self.m_checkRawImage.GetValue())
 
         self.updateButtonState()
 
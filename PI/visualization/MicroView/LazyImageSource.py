@@ -0,0 +1,305 @@
+# =========================================================================
+#
+# Copyright (c) 2000-2008 GE Healthcare
+# Copyright (c) 2011-2015 Parallax Innovations Inc.
+#
+# Use, modification and redistribution of the software, in source or
+# binary forms, are permitted provided that the following terms and
+# conditions are met:
+#
+# 1) Redistribution of the source code, in verbatim or modified
+#   form, must retain the above copyright notice, this license,
+#   the following disclaimer, and any notices that refer to this
+#   license and/or the following disclaimer.
+#
+# 2) Redistribution in binary form must include the above copyright
+#    notice, a copy of this license and the following disclaimer
+#   in the documentation or with other materials provided with the
+#   distribution.
+#
+# 3) Modified copies of the source code must be clearly marked as such,
+#   and must not be misrepresented as verbatim copies of the source code.
+#
+# EXCEPT WHEN OTHERWISE STATED IN WRITING BY THE COPYRIGHT HOLDERS AND/OR
+# OTHER PARTIES, THE COPYRIGHT HOLDERS AND/OR OTHER PARTIES PROVIDE THE
+# SOFTWARE "AS IS" WITHOUT EXPRESSED OR IMPLIED WARRANTY INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE.  IN NO EVENT UNLESS AGREED TO IN WRITING WILL
+# ANY COPYRIGHT HOLDER OR OTHER PARTY WHO MAY MODIFY AND/OR REDISTRIBUTE
+# THE SOFTWARE UNDER THE TERMS OF THIS LICENSE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, LOSS OF DATA OR DATA BECOMING INACCURATE OR LOSS OF PROFIT OR
+# BUSINESS INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE OR INABILITY TO
+# USE THE SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+#
+# =========================================================================
+
+#
+# This file represents a derivative work by Parallax Innovations Inc.
+
+"""
+A streaming image source that reads large volumes on demand.
+
+LazyImageSource sits between a reader and the rest of the pipeline.  It
+reports the reader's full image information straight away, but only reads
+the z-slabs that cover each update extent requested downstream.  Slabs are
+kept in an LRU cache bounded by a memory budget, so browsing a very large
+stack holds a fixed working set.  Requests too large for the cache (for
+instance a filter that needs the whole volume) are read straight through
+without being cached.
+
+The output only ever holds the extent last requested downstream, so code
+that needs every voxel uses GetWholeImage(), or GetRealImage() on a
+LazyMVImage, which reads the volume into an image of its own once.  From
+then on the slabs are served from that image.
+
+This relies on Python algorithms, so it's only available with VTK 6 or
+later.
+"""
+
+import collections
+import logging
+
+import vtk
+from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
+
+from PI.visualization.vtkMultiIO import MVImage
+
+# default number of slices read at a time
+DEFAULT_SLAB_SIZE = 16
+
+# default cache size, in bytes
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024
+
+
+class SlabCache(object):
+
+    """A least-recently-used cache of image slabs, bounded by total size in bytes."""
+
+    def __init__(self, budget=DEFAULT_MEMORY_BUDGET):
+        self._slabs = collections.OrderedDict()
+        self._budget = budget
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._slabs)
+
+    def GetMemoryBudget(self):
+        return self._budget
+
+    def SetMemoryBudget(self, budget):
+        self._budget = budget
+        self._Evict()
+
+    def GetMemoryUsage(self):
+        return self._nbytes
+
+    def Get(self, key):
+        """Return the cached slab, or None, marking it as most recently used."""
+        slab = self._slabs.pop(key, None)
+        if slab is not None:
+            self._slabs[key] = slab
+        return slab
+
+    def Put(self, key, slab):
+        old = self._slabs.pop(key, None)
+        if old is not None:
+            self._nbytes -= self._SizeOf(old)
+        self._slabs[key] = slab
+        self._nbytes += self._SizeOf(slab)
+        self._Evict()
+
+    def Clear(self):
+        self._slabs.clear()
+        self._nbytes = 0
+
+    def _Evict(self):
+        # always keep the most recent slab, even if it alone is over budget
+        while self._nbytes > self._budget and len(self._slabs) > 1:
+            key, slab = self._slabs.popitem(last=False)
+            self._nbytes -= self._SizeOf(slab)
+
+    @staticmethod
+    def _SizeOf(slab):
+        return slab.GetActualMemorySize() * 1024
+
+
+class LazyImageSource(VTKPythonAlgorithmBase):
+
+    """Read an image from an upstream reader one z-slab at a time, as requested.
+
+    The upstream algorithm must honour update extents, as vtkImageReader2 and
+    its subclasses do; otherwise every slab costs a full read.
+    """
+
+    def __init__(self, port, slab_size=DEFAULT_SLAB_SIZE, budget=DEFAULT_MEMORY_BUDGET):
+        VTKPythonAlgorithmBase.__init__(self, nInputPorts=0, nOutputPorts=1,
+                                        outputType='vtkImageData')
+
+        # hold on to the producer itself - the reader that created it may
+        # discard its own reference once the image has been handed over
+        self._producer = port.GetProducer()
+        self._index = port.GetIndex()
+        self._slab_size = max(1, int(slab_size))
+        self._cache = SlabCache(budget)
+        self._cache_time = 0
+        self._whole_image = None
+        self._whole_observer = None
+
+    def GetSlabSize(self):
+        return self._slab_size
+
+    def SetSlabSize(self, slab_size):
+        slab_size = max(1, int(slab_size))
+        if slab_size != self._slab_size:
+            self._slab_size = slab_size
+            self._cache.Clear()
+            self.Modified()
+
+    def GetMemoryBudget(self):
+        return self._cache.GetMemoryBudget()
+
+    def SetMemoryBudget(self, budget):
+        self._cache.SetMemoryBudget(budget)
+
+    def GetMemoryUsage(self):
+        return self._cache.GetMemoryUsage()
+
+    def ClearCache(self):
+        self._cache.Clear()
+
+    def GetWholeImage(self):
+        """The whole volume, read into an image of its own the first time it's asked for."""
+
+        self.UpdateInformation()
+        if self._whole_image is None:
+            whole = self.GetOutputInformation(0).Get(
+                vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+            logging.info("Reading whole extent {}".format(tuple(whole)))
+
+            # the reader starts from fresh arrays each time it executes, so
+            # sharing its scalars is safe
+            image = vtk.vtkImageData()
+            image.ShallowCopy(self._Read(whole))
+
+            # changes made to the whole image must reach the slices too
+            self._whole_observer = image.AddObserver(
+                'ModifiedEvent', lambda obj, evt: self.Modified())
+            self._whole_image = image
+            self._cache.Clear()
+            self.Modified()
+
+        return self._whole_image
+
+    def _ReleaseWholeImage(self):
+        if self._whole_image is not None:
+            self._whole_image.RemoveObserver(self._whole_observer)
+            self._whole_image = None
+            self._whole_observer = None
+
+    def GetSampledScalarRange(self):
+        """Scalar range of the middle slab, without reading the whole volume."""
+        self.UpdateInformation()
+        whole = self.GetOutputInformation(0).Get(
+            vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+        z = (whole[4] + whole[5]) // 2
+        return self._GetSlab((z - whole[4]) // self._slab_size, whole).GetScalarRange()
+
+    def RequestInformation(self, request, inInfo, outInfo):
+
+        self._producer.UpdateInformation()
+        src = self._producer.GetOutputInformation(self._index)
+        info = outInfo.GetInformationObject(0)
+
+        sddp = vtk.vtkStreamingDemandDrivenPipeline
+        info.Set(sddp.WHOLE_EXTENT(), src.Get(sddp.WHOLE_EXTENT()), 6)
+        info.Set(vtk.vtkDataObject.SPACING(), src.Get(vtk.vtkDataObject.SPACING()), 3)
+        info.Set(vtk.vtkDataObject.ORIGIN(), src.Get(vtk.vtkDataObject.ORIGIN()), 3)
+        vtk.vtkDataObject.SetPointDataActiveScalarInfo(
+            info, vtk.vtkImageData.GetScalarType(src),
+            vtk.vtkImageData.GetNumberOfScalarComponents(src))
+
+        # the reader may have been changed since the slabs were read
+        if self._producer.GetMTime() > self._cache_time:
+            self._cache.Clear()
+            self._ReleaseWholeImage()
+            self._cache_time = self._producer.GetMTime()
+
+        return 1
+
+    def RequestData(self, request, inInfo, outInfo):
+
+        info = outInfo.GetInformationObject(0)
+        sddp = vtk.vtkStreamingDemandDrivenPipeline
+        whole = info.Get(sddp.WHOLE_EXTENT())
+        extent = info.Get(sddp.UPDATE_EXTENT())
+        output = vtk.vtkImageData.GetData(outInfo)
+
+        # once the whole volume is in memory, every request is served from it
+        if self._whole_image is not None:
+            output.ShallowCopy(self._whole_image)
+            return 1
+
+        first = (extent[4] - whole[4]) // self._slab_size
+        last = (extent[5] - whole[4]) // self._slab_size
+        slab_bytes = (whole[1] - whole[0] + 1) * (whole[3] - whole[2] + 1) * self._slab_size * \
+            vtk.vtkDataArray.GetDataTypeSize(vtk.vtkImageData.GetScalarType(info)) * \
+            vtk.vtkImageData.GetNumberOfScalarComponents(info)
+
+        if (last - first + 1) * slab_bytes > self._cache.GetMemoryBudget():
+            # too big to cache, e.g. the whole volume - read it straight through
+            logging.info("Reading extent {} without caching".format(tuple(extent)))
+            output.ShallowCopy(self._Read(extent))
+            return 1
+
+        output.SetExtent(extent)
+        output.AllocateScalars(vtk.vtkImageData.GetScalarType(info),
+                               vtk.vtkImageData.GetNumberOfScalarComponents(info))
+
+        for n in range(first, last + 1):
+            slab = self._GetSlab(n, whole)
+            z0, z1 = slab.GetExtent()[4:6]
+            output.CopyAndCastFrom(slab, (extent[0], extent[1], extent[2], extent[3],
+                                          max(z0, extent[4]), min(z1, extent[5])))
+
+        return 1
+
+    def _GetSlab(self, n, whole):
+        slab = self._cache.Get(n)
+        if slab is None:
+            z0 = whole[4] + n * self._slab_size
+            z1 = min(z0 + self._slab_size - 1, whole[5])
+            slab = vtk.vtkImageData()
+            slab.DeepCopy(self._Read((whole[0], whole[1], whole[2], whole[3], z0, z1)))
+            self._cache.Put(n, slab)
+        return slab
+
+    def _Read(self, extent):
+        self._producer.SetUpdateExtent(self._index, extent)
+        self._producer.Update()
+        return self._producer.GetOutputDataObject(self._index)
+
+
+class LazyMVImage(MVImage.MVImage):
+
+    """An MVImage whose voxels are read on demand by a LazyImageSource.
+
+    The output port streams slabs to whatever is connected to it, such as the
+    slice planes.  GetRealImage() hands out the whole volume instead, reading
+    it the first time it's asked for, so code holding on to the image data
+    never sees a partial extent.
+    """
+
+    def __init__(self, source, **kw):
+        MVImage.MVImage.__init__(self, source.GetOutputPort(), **kw)
+        self._lazySource = source
+
+    def GetLazySource(self):
+        return self._lazySource
+
+    def GetRealImage(self):
+        return self._lazySource.GetWholeImage()
+
+    def Update(self):
+        # voxels are read when they're needed
+        self._lazySource.UpdateInformation()
@@ -47,6 +47,8 @@ Classes:
     MicroViewInput - manages image input
     MicroViewOutput - manages image output
     ImageImportDialog - manages MicroView's image import dialog
+    DICOMHeaderIndex - persistent cache of DICOM headers, keyed by file mtime/size
+    MicroViewDICOMExaminer - sorts a directory of DICOM files into series
 
 Global Functions:
 
@@ -67,7 +69,6 @@ import time
 import dicom
 from dicom.dataset import Dataset, FileDataset
 import enum
-import gdcm
 import os
 import glob
 import re
@@ -76,6 +77,12 @@ import time
 import types
 import collections
 import appdirs
+import hashlib
+import cPickle
+import multiprocessing
+import numpy
+import stat as stat_module
+from multiprocessing.pool import ThreadPool
 import xlwt
 import wx
 import URLManager
@@ -92,6 +99,9 @@ from vtkEVS import EVSFileDialog
 from PI.visualization.common import MicroViewSettings, MicroViewHistory
 
 import ImageImportDialogC
+import StackLoader
+import DICOMSeriesWriter
+import ROIValueExport
 import ImageExportWizard
 import DICOMDIRBrowseDialogC
 
@@ -358,6 +368,12 @@ class MicroViewInput(MicroViewIO):
         # used for UserEvent
         self._helpTopic = None
         self._importDialog = None
+        self._importer = None
+        self._importerInput = None
+        self._stackFileNames = None
+        self._stackImporter = None
+        self._lazySource = None
+        self._lazyImage = None
         self._image_title = ''
         self._firstImportFileName = ''
 
@@ -375,8 +391,103 @@ class MicroViewInput(MicroViewIO):
         image = reader.GetOutput()
         # propagate coordinate system info
         image.SetCoordinateSystem(reader.GetCoordinateSystem())
+
+        # very large images are read on demand
+        self._lazySource = self._CreateLazySource(reader)
+        if self._lazySource is not None:
+            import LazyImageSource
+            image = LazyImageSource.LazyMVImage(self._lazySource, input=image)
+            image.SetCoordinateSystem(reader.GetCoordinateSystem())
+            self._lazyImage = image
+        else:
+            self._lazyImage = None
+
+            # DICOM series are decoded in parallel when we can
+            self._stackImporter = None
+            if self._stackFileNames:
+                self._stackImporter = self._DecodeDICOMSlices(self._stackFileNames)
+            if self._stackImporter is not None:
+                image = MVImage.MVImage(self._stackImporter.GetOutputPort(), input=image)
+                image.SetCoordinateSystem(reader.GetCoordinateSystem())
+
         return image
 
+    def GetLazySource(self, image):
+        """Returns the LazyImageSource behind image, or None if it was read in full."""
+        if image is not None and image is self._lazyImage:
+            return self._lazySource
+        return None
+
+    def _CreateLazySource(self, reader):
+
+        # streaming through a python source needs VTK-6
+        if vtk.vtkVersion().GetVTKMajorVersion() < 6:
+            return None
+
+        config = MicroViewSettings.MicroViewSettings.getObject()
+        try:
+            enabled = config.bLazyImageLoading
+        except:
+            enabled = config.bLazyImageLoading = False
+        try:
+            budget = int(config.LazyImageMemoryBudget) * 1024 * 1024
+        except:
+            # in megabytes
+            config.LazyImageMemoryBudget = 1024
+            budget = 1024 * 1024 * 1024
+
+        if not enabled:
+            return None
+
+        port = reader.GetOutputPort()
+        producer = port.GetProducer()
+        producer.UpdateInformation()
+        info = producer.GetOutputInformation(port.GetIndex())
+        e = info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+        nbytes = (e[1] - e[0] + 1) * (e[3] - e[2] + 1) * (e[5] - e[4] + 1) * \
+            vtk.vtkDataArray.GetDataTypeSize(vtk.vtkImageData.GetScalarType(info)) * \
+            vtk.vtkImageData.GetNumberOfScalarComponents(info)
+
+        # small images are quicker to read in one go
+        if nbytes <= budget:
+            return None
+
+        import LazyImageSource
+
+        logging.info("Image is {0:.0f} MB - reading slices on demand".format(
+            nbytes / (1024.0 * 1024.0)))
+
+        return LazyImageSource.LazyImageSource(port, budget=budget)
+
+    def _DecodeDICOMSlices(self, filenames):
+        """Decode the slices of a DICOM series on a thread pool, checking them
+        against those read by the reader, which must already have the files.
+
+        Returns a vtkImageImport, or None if the reader has to read them."""
+
+        # reading single slices from the reader needs VTK-6
+        if vtk.vtkVersion().GetVTKMajorVersion() < 6:
+            return None
+
+        filenames = list(filenames)
+        if len(filenames) < 2:
+            return None
+
+        try:
+            examiner = MicroViewDICOMExaminer(os.path.dirname(filenames[0]))
+            with open(filenames[0], 'rb') as _f:
+                if not examiner._IsDICOMPreamble(_f.read(512)):
+                    return None
+            headers = [ds for _, ds in examiner.ReadHeaders(filenames, prune=False)]
+            if not StackLoader.DICOMStackLoader.CanLoad(headers):
+                return None
+            return StackLoader.DICOMStackLoader(
+                filenames, headers, self._reader.GetOutputPort(), "Reading image...").Load()
+        except Exception, e:
+            logging.warning(
+                "Unable to read slices in parallel ({0}) - reading them in sequence".format(e))
+            return None
+
     def OpenFile(self, filename=None):
         """Opens and reads a file. Return errors status."""
 
@@ -478,6 +589,9 @@ class MicroViewInput(MicroViewIO):
             bool: True if image load was successful
         """
 
+        self._stackFileNames = None
+        self._stackImporter = None
+
         if isinstance(filename, str) or isinstance(filename, unicode):
 
             # Open the single file
@@ -510,6 +624,10 @@ class MicroViewInput(MicroViewIO):
                 dlg.Destroy()
                 return False
 
+            # decoded in parallel by GetImageOutput(), if they're DICOM
+            self._stackFileNames = [filename.GetValue(i)
+                                    for i in range(filename.GetNumberOfValues())]
+
         self._reader.SetProgressText("Reading image...")
 
         # Keep a history of recent files
@@ -586,8 +704,18 @@ class MicroViewInput(MicroViewIO):
             if self.convertToGrayScale:
                 logging.info('computing image magnitude...')
                 f = vtkImageMagnitude2()
-                f.SetInputConnection(self._reader.GetOutputPort())
+                if self._importer is not None:
+                    f.SetInputConnection(self._importer.GetOutputPort())
+                else:
+                    f.SetInputConnection(self._reader.GetOutputPort())
                 image = MVImage.MVImage(f.GetOutputPort())
+            elif self._importer is not None:
+                # memory-mapped raw image, or slices decoded in parallel
+                if self._importerInput is not None:
+                    image = MVImage.MVImage(self._importer.GetOutputPort(),
+                                            input=self._importerInput)
+                else:
+                    image = MVImage.MVImage(self._importer.GetOutputPort())
             else:
                 # 2013-08-30:  raw images are returned as real images, everything else should already by
                 # a MVImage object
@@ -622,9 +750,68 @@ class MicroViewInput(MicroViewIO):
                 self.convertToGrayScale = self._importDialog.isGrayScaleRequested()
                 self.ImageImport()
 
+    # raw data types that can be memory-mapped, with their numpy and VTK
+    # equivalents
+    _memmap_types = {
+        'unsigned char': ('u1', vtk.VTK_UNSIGNED_CHAR),
+        'unsigned short': ('u2', vtk.VTK_UNSIGNED_SHORT),
+        'short': ('i2', vtk.VTK_SHORT),
+        'int': ('i4', vtk.VTK_INT),
+        'float': ('f4', vtk.VTK_FLOAT),
+        'double': ('f8', vtk.VTK_DOUBLE),
+    }
+
+    def MemoryMapRawImage(self, filename, headersize, dims, spacing, data_type, big_endian, flip):
+        """Map a 3D raw file into memory and wrap it with a vtkImageImport.
+
+        The file is mapped copy-on-write: voxels are paged in from disk as
+        they're touched, and in-place filtering never writes back to the file.
+        Returns None if the file can't be used without reordering its bytes or
+        rows, in which case the caller should read it normally.
+        """
+        if data_type not in self._memmap_types:
+            return None
+
+        np_type, vtk_type = self._memmap_types[data_type]
+        dtype = numpy.dtype(('>' if big_endian else '<') + np_type)
+
+        if not dtype.isnative:
+            logging.info(
+                "Raw image byte order differs from this machine's - reading instead of memory-mapping")
+            return None
+        if not flip:
+            # rows are stored top-down and have to be reversed
+            logging.info(
+                "Raw image must be flipped - reading instead of memory-mapping")
+            return None
+
+        xsize, ysize, zsize = dims
+        try:
+            buf = numpy.memmap(filename, dtype=dtype, mode='c', offset=headersize,
+                               shape=(zsize, ysize, xsize))
+        except (IOError, ValueError), e:
+            logging.warning("Unable to memory-map '%s': %s" % (filename, e))
+            return None
+
+        importer = vtk.vtkImageImport()
+        importer.SetImportVoidPointer(buf)
+        importer.SetDataScalarType(vtk_type)
+        importer.SetNumberOfScalarComponents(1)
+        importer.SetDataExtent(0, xsize - 1, 0, ysize - 1, 0, zsize - 1)
+        importer.SetWholeExtent(0, xsize - 1, 0, ysize - 1, 0, zsize - 1)
+        importer.SetDataSpacing(spacing)
+
+        # the importer doesn't own the memory, so keep the mapping alive for
+        # as long as the importer is
+        importer._buffer = buf
+
+        return importer
+
     def ImageImport(self):
 
         self._importDone = False
+        self._importer = None
+        self._importerInput = None
 
         # save settings
         self._importDialog.SaveSettings()
@@ -698,9 +885,21 @@ class MicroViewInput(MicroViewIO):
                 self._importDialog.m_textCtrlHeaderSize.GetValue())
             xsize = int(self._importDialog.m_textCtrlXSize.GetValue())
             ysize = int(self._importDialog.m_textCtrlYSize.GetValue())
+            dt = self._importDialog.m_choiceDataType.GetStringSelection()
+            endian = self._importDialog.m_choiceDataEndian.GetStringSelection(
+            )
             if raw_3D:
                 zsize = int(self._importDialog.m_textCtrlZSize.GetValue())
 
+                if self._importDialog.isMemoryMapRequested():
+                    self._importer = self.MemoryMapRawImage(
+                        file_list[0], headersize, (xsize, ysize, zsize),
+                        (xspacing, yspacing, zspacing), dt,
+                        endian == 'big endian', flip)
+                    if self._importer is not None:
+                        self._importDone = True
+                        return
+
             reader = vtk.vtkImageReader2()
 
             # vtkImageReader2 doesn't like to handle one filename with string
@@ -728,7 +927,6 @@ class MicroViewInput(MicroViewIO):
             reader.SetDataSpacing(xspacing, yspacing, zspacing)
             reader.SetFileLowerLeft(flip)
 
-            dt = self._importDialog.m_choiceDataType.GetStringSelection()
             if dt == 'unsigned char':
                 reader.SetDataScalarTypeToUnsignedChar()
             elif dt == 'unsigned short':
@@ -744,8 +942,6 @@ class MicroViewInput(MicroViewIO):
             else:
                 logging.error("data type '%s' not supported" % dt)
 
-            endian = self._importDialog.m_choiceDataEndian.GetStringSelection(
-            )
             if endian == 'big endian':
                 reader.SetDataByteOrderToBigEndian()
             else:
@@ -759,6 +955,17 @@ class MicroViewInput(MicroViewIO):
             del reader
 
         else:
+            # decode image series in parallel when we can
+            if l > 0 and not bIsDICOM and StackLoader.ImageStackLoader.CanLoad(file_list):
+                try:
+                    self._importer = StackLoader.ImageStackLoader(
+                        file_list, "Importing images...", (xspacing, yspacing, zspacing)).Load()
+                    self._importDone = True
+                    return
+                except Exception, e:
+                    logging.warning(
+                        "Unable to read slices in parallel ({0}) - reading them in sequence".format(e))
+
             if l > 0:
                 # create a VTK string array
                 arr = vtk.vtkStringArray()
@@ -771,6 +978,10 @@ class MicroViewInput(MicroViewIO):
                         logging.warning("File '%s' is missing." % name)
                 if bIsDICOM:
                     self._reader.SetFileNames(arr, check_order=True)
+                    self._importer = self._DecodeDICOMSlices(
+                        [arr.GetValue(i) for i in range(arr.GetNumberOfValues())])
+                    if self._importer is not None:
+                        self._importerInput = self._reader.GetOutput()
                 else:
                     self._reader.SetFileNames(arr)
             else:
@@ -804,6 +1015,8 @@ class MicroViewInput(MicroViewIO):
         """Automatically import (i.e., no prompting the user) the
         images from ExternalSelection (a class defined below."""
         self._importDone = False
+        self._importer = None
+        self._importerInput = None
 
         if not aFileNames:
             selection = ExternalSelection()
@@ -813,12 +1026,29 @@ class MicroViewInput(MicroViewIO):
         cFiles = len(aFileNames)
         if (self._reader != None and cFiles > 0):
             self._firstImportFileName = aFileNames[0]
+
+            # decode image series in parallel when we can
+            if StackLoader.ImageStackLoader.CanLoad(aFileNames):
+                try:
+                    self._importer = StackLoader.ImageStackLoader(
+                        aFileNames, "Importing images...").Load()
+                    self._importDone = True
+                    return
+                except Exception, e:
+                    logging.warning(
+                        "Unable to read slices in parallel ({0}) - reading them in sequence".format(e))
+
             strExt = os.path.splitext(self._firstImportFileName)[1]
             self._reader.SetExtension(strExt, self._firstImportFileName)
             self._reader.SetDataExtent(0, 0, 0, 0, 0, cFiles)
             self._reader.SetDataSpacing(1.0, 1.0, 1.0)
             self._reader.SetFileList(aFileNames)
 
+            # DICOM series are decoded in parallel when we can
+            self._importer = self._DecodeDICOMSlices(aFileNames)
+            if self._importer is not None:
+                self._importerInput = self._reader.GetOutput()
+
         self._importDone = True
 
 
@@ -1119,38 +1349,45 @@ class MicroViewOutput(MicroViewIO):
                 else:
                     num += 1
 
-            # set up writer
-            if self._writer is None:
-                self.create_writer()
-            self._writer.SetWriterByFileExtension('.dcm')
-
-            fn = vtk.vtkStringArray()
             template = os.path.join(subfolder, 'I%06d')
-            for i in range(zsize):
-                fn.InsertNextValue(template % i)
-            self._writer.SetFileNames(fn)
-
-            # do export
-            # use an MVImage here rather than raw image
-            self._writer.SetInput(image)
-            self._writer.SetDICOMHeader(dicom_header)
 
             # give app last-ditch opportunity before writing image
             ortho = component.getUtility(ICurrentOrthoView)
             event.notify(ImageWriteBeginEvent(ortho.GetImageIndex()))
 
-            self._writer.Write()
+            if DICOMSeriesWriter.DICOMSeriesWriter.CanWrite(image.GetRealImage()):
+                # write slices in parallel
+                writer = DICOMSeriesWriter.DICOMSeriesWriter(
+                    dicom_header, self._parallax_base_uid)
+                writer.Write(image.GetRealImage(), [template % i for i in range(zsize)],
+                             "Exporting DICOM slices...")
+            else:
+                # set up writer
+                if self._writer is None:
+                    self.create_writer()
+                self._writer.SetWriterByFileExtension('.dcm')
+
+                fn = vtk.vtkStringArray()
+                for i in range(zsize):
+                    fn.InsertNextValue(template % i)
+                self._writer.SetFileNames(fn)
+
+                # do export
+                # use an MVImage here rather than raw image
+                self._writer.SetInput(image)
+                self._writer.SetDICOMHeader(dicom_header)
+
+                self._writer.Write()
 
             # update DICOMDIR
             cwd = os.getcwd()
-            os.chdir(directory)
-
-            # walk directory and find all DICOM files contained within
-            filenames = []
+            dlg = None
 
             t0 = time.time()
 
             try:
+                os.chdir(directory)
+
                 msg = "Examining existing DICOM records..."
                 logging.info(msg)
 
@@ -1167,109 +1404,61 @@ class MicroViewOutput(MicroViewIO):
                 if not dlg.UpdatePulse(msg):
                     return
 
+                examiner = MicroViewDICOMExaminer(directory)
+
                 if dcmdir is not None:
-                    t0 = time.time()
-                    # simply append to existing DICOMDIR file
+                    # simply append the new series to the existing DICOMDIR file
                     dd = dicomdir(dcmdir)
-
-                    # create/add a patient record
-                    patient = Dataset()
-                    patient.DirectoryRecordType = 'PATIENT'
-                    patient.PatientName = dicom_header.PatientName
-                    patient.PatientID = dicom_header.PatientID
-                    dd.add_record(patient)
-
-                    # create a study record
-                    study = Dataset()
-                    study.DirectoryRecordType = 'STUDY'
-                    study.StudyDate = dicom_header.StudyDate
-                    study.StudyTime = dicom_header.StudyTime
-                    study.AccessionNumber = ''
-                    study.StudyInstanceUID = dicom_header.StudyInstanceUID
-                    study.StudyID = dicom_header.StudyID
-                    dd.add_record(study, patient_record=patient)
-
-                    # create a series record
-                    series = Dataset()
-                    series.DirectoryRecordType = 'SERIES'
-                    series.SeriesDate = dicom_header.SeriesDate
-                    series.SeriesTime = dicom_header.SeriesTime
-                    series.SeriesDescription = dicom_header.get('SeriesDescription', '')
-                    series.AccessionNumber = ''
-                    series.SeriesInstanceUID = dicom_header.SeriesInstanceUID
-                    series.SeriesNumber = dicom_header.SeriesNumber
-                    series.Modality = dicom_header.Modality
-                    dd.add_record(
-                        series, study_record=study, patient_record=patient)
-
-                    # create the image records
-                    for i in range(zsize):
-
-                        image = Dataset()
-                        image.DirectoryRecordType = 'IMAGE'
-                        image.RecordInUseFlag = 65535
-                        image.ReferencedFileID = [name, 'I%06d' % i]
-                        # CT Image Storage
-                        image.ReferencedSOPClassUIDInFile = '1.2.840.10008.5.1.4.1.1.2'
-                        image.ReferencedSOPInstanceUIDInFile = '1.2.3.4.5.6'
-                        image.ReferencedTransferSyntaxUIDInFile = '1.2.840.10008.1.2.1'
-                        image.ImageType = dicom_header.ImageType
-                        image.InstanceNumber = '1'
-                        dd.add_record(
-                            image, series_record=series, study_record=study, patient_record=patient)
-
-                    # update everything
-                    if not dlg.UpdatePulse("Updating DICOMDIR file..."):
-                        return
-                    dd.update()
-                    ds = dd.get_dicomdir()
-                    dicom.write_file(dicomdir_filename, ds)
-                    t1 = time.time()
-
-                    # TODO: implement the rest of this here
+                    headers = examiner.ReadHeaders([template % i for i in range(zsize)], prune=False)
                 else:
-                    for root, dirs, files in os.walk(directory):
-                        for _file in files:
-                            filename = os.path.join(root, _file)
-                            if not 'dicomdir' in filename.lower():
-                                try:
-                                    code = self.is_file_dicom(filename)
-                                    if code == 3:
-                                        filename2 = os.path.abspath(filename).replace(
-                                            os.path.abspath(directory), '').replace(os.path.sep, '/')[1:]
-                                        filenames.append(
-                                            filename2.encode('utf-8'))
-                                except:
-                                    pass
-
-                    gen = gdcm.DICOMDIRGenerator()
-                    gen.SetRootDirectory(directory.encode('utf-8'))
-                    gen.SetFilenames(tuple(filenames))
-
-                    if not dlg.UpdatePulse("Generating new DICOMDIR file..."):
-                        return
-
-                    if not gen.Generate():
-                        logging.error("DICOMDIR generation failed!")
-                        return
-
-                    if not dlg.UpdatePulse("Writing DICOMDIR file..."):
-                        return
-
-                    w = gdcm.Writer()
-                    w.SetFile(gen.GetFile())
-                    w.SetFileName(dicomdir_filename.encode('utf-8'))
-
-                    if not w.Write():
-                        logging.error("DICOMDIR write failed!")
-                        return
+                    # catalogue the whole tree.  Only the directories that
+                    # changed since an earlier export -- the new MV#### folder
+                    # among them -- are listed and read, the rest come from
+                    # the header index
+                    headers = examiner.ReadTreeHeaders()
+
+                    # keep an unreadable DICOMDIR rather than overwrite it
+                    if os.path.exists(dicomdir_filename):
+                        backup = dicomdir_filename + '.bak'
+                        if os.path.exists(backup):
+                            os.remove(backup)
+                        os.rename(dicomdir_filename, backup)
+                        logging.warning(
+                            "Moved unreadable DICOMDIR to {}".format(backup))
+                    dd = dicomdir(dicomdir_filename)
+
+                for i, (filename, ds) in enumerate(headers):
+
+                    if i % 100 == 0:
+                        if not dlg.UpdatePulse(msg):
+                            return
+
+                    # not a DICOM file, or we failed to read it
+                    if ds is None:
+                        continue
+
+                    # throw out DICOMDIR.  Files that aren't DICOM part 10 have no
+                    # meta information
+                    if getattr(ds.get('file_meta'), 'MediaStorageSOPClassUID', None) == \
+                            '1.2.840.10008.1.3.10':
+                        continue
+
+                    dd.add_file(filename, directory, ds=ds)
+
+                # update everything
+                if not dlg.UpdatePulse("Updating DICOMDIR file..."):
+                    return
+                dd.update()
+                ds = dd.get_dicomdir()
+                dicom.write_file(dicomdir_filename, ds)
             finally:
-                dlg.Destroy()
+                if dlg is not None:
+                    dlg.Destroy()
+                os.chdir(cwd)
 
             t1 = time.time()
             logging.info("Elapsed time: {}".format(t1 - t0))
 
-            os.chdir(cwd)
             logging.info(
                 "Exported data to DICOMDIR folder: {}".format(subfolder))
 
@@ -1578,6 +1767,88 @@ class MicroViewOutput(MicroViewIO):
             logging.error("ROI is not set")
             return -1
 
+        image = component.getUtility(ICurrentImage)
+
+        # an untransformed crop on the image grid is pure voxel copying, so
+        # avoid the interpolator altogether
+        if not self._transform and self._IsOnImageGrid(stencil_data, image):
+            source, extent = self._CreateSubVolumeCrop(image, stencil_data)
+        else:
+            source, extent = self._CreateSubVolumeReslice(image, stencil_data)
+
+        spacing = image.GetSpacing()
+        origin = image.GetOrigin()
+
+        # Set a new origin to the output image,
+        # We could have done this by setting new origin/extent
+        # to reslice, but that would conflict with SetStencil.
+        newOrigin = (origin[0] + spacing[0] * extent[0],
+                     origin[1] + spacing[1] * extent[2],
+                     origin[2] + spacing[2] * extent[4])
+        changeInfo = vtk.vtkImageChangeInformation()
+        changeInfo.SetInputConnection(source.GetOutputPort())
+        changeInfo.SetOutputOrigin(newOrigin)
+        changeInfo.SetOutputExtentStart(0, 0, 0)
+
+        # save the image
+        return self._SaveImageToFile(MVImage.MVImage(changeInfo.GetOutputPort(), input=image),
+                                     progressText='Saving sub volume...', filename=filename,
+                                     message='Save Crop region to file...')
+
+    def _IsOnImageGrid(self, stencil_data, image):
+        """Check whether the stencil voxels coincide with the image voxels"""
+
+        spacing = image.GetSpacing()
+        origin = image.GetOrigin()
+        s_spacing = stencil_data.GetSpacing()
+        s_origin = stencil_data.GetOrigin()
+
+        # vtkImageStencil reads the stencil runs in the image's index space
+        # and ignores the stencil origin, so the origins must agree too
+        for i in range(3):
+            tol = 1e-3 * abs(spacing[i])
+            if abs(s_spacing[i] - spacing[i]) > tol:
+                return False
+            if abs(s_origin[i] - origin[i]) > tol:
+                return False
+
+        return True
+
+    def _CreateSubVolumeCrop(self, image, stencil_data):
+        """Crop the sub volume without resampling.
+
+        The clip only narrows the whole extent, so each piece the writer asks
+        for is read from the image and copied once by vtkImageStencil, which
+        fills in the background only outside the stencil runs.  Writers that
+        write piece-wise therefore never see more than one slab at a time.
+        """
+
+        whole = image.GetWholeExtent()
+        extent = list(stencil_data.GetExtent())
+        for i in range(3):
+            extent[2 * i] = max(extent[2 * i], whole[2 * i])
+            extent[2 * i + 1] = min(extent[2 * i + 1], whole[2 * i + 1])
+
+        clip = vtk.vtkImageClip()
+        clip.SetInputConnection(image.GetOutputPort())
+        clip.SetOutputWholeExtent(extent)
+        clip.ClipDataOff()
+
+        stencil = vtk.vtkImageStencil()
+        stencil.SetInputConnection(clip.GetOutputPort())
+        stencil.SetBackgroundValue(image.GetScalarRange()[0])
+
+        # VTK-6
+        if vtk.vtkVersion().GetVTKMajorVersion() > 5:
+            stencil.SetStencilData(stencil_data)
+        else:
+            stencil.SetStencil(stencil_data)
+
+        return stencil, extent
+
+    def _CreateSubVolumeReslice(self, image, stencil_data):
+        """Resample the sub volume through vtkImageReslice"""
+
         # fire a warning if self._transform is on,
         # we'll implement the feature later
         if self._transform:
@@ -1585,7 +1856,6 @@ class MicroViewOutput(MicroViewIO):
                 "FIX ME: image transform is not taken into consideration.")
 
         extent = stencil_data.GetExtent()
-        image = component.getUtility(ICurrentImage)
         spacing = image.GetSpacing()
         origin = image.GetOrigin()
 
@@ -1607,21 +1877,7 @@ class MicroViewOutput(MicroViewIO):
         # set background value in stenciled image to minimum in image
         reslice.SetBackgroundLevel(image.GetScalarRange()[0])
 
-        # Set a new origin to the output image,
-        # We could have done this by setting new origin/extent
-        # to reslice, but that would conflict with SetStencil.
-        newOrigin = (origin[0] + spacing[0] * extent[0],
-                     origin[1] + spacing[1] * extent[2],
-                     origin[2] + spacing[2] * extent[4])
-        changeInfo = vtk.vtkImageChangeInformation()
-        changeInfo.SetInput(reslice.GetOutput())
-        changeInfo.SetOutputOrigin(newOrigin)
-        changeInfo.SetOutputExtentStart(0, 0, 0)
-
-        # save the image
-        return self._SaveImageToFile(MVImage.MVImage(changeInfo.GetOutputPort(), input=image),
-                                     progressText='Saving sub volume...', filename=filename,
-                                     message='Save Crop region to file...')
+        return reslice, extent
 
     def SaveStatisticsToDisk(self, results, filename=None):
 
@@ -1849,6 +2105,51 @@ class MicroViewOutput(MicroViewIO):
 
         return 0
 
+    def SaveImageValues(self, filename=None, stencil_data=None):
+        """Save the values of the image voxels inside the ROI.
+
+        The format is chosen by extension: NumPy array, raw binary with a JSON
+        description, or CSV.
+        """
+
+        if stencil_data is None:
+            msg = "No stencil defined - cannot save image values"
+            logging.error(msg)
+            dlg = wx.MessageDialog(component.getUtility(IMicroViewMainFrame), msg,
+                                   'Error', wx.OK | wx.ICON_ERROR)
+            dlg.ShowModal()
+            dlg.Destroy()
+            return
+
+        if not filename:
+            ft = collections.OrderedDict([('NumPy array', ['*.npy']),
+                                          ('Raw binary with JSON description', ['*.raw']),
+                                          ('CSV file', ['*.csv'])])
+            filename = self.AskSaveAsFileName(
+                ft, message='Save image values...', defaultfile='values.npy')
+            if not filename:
+                return
+
+        image = component.getUtility(ICurrentImage)
+
+        try:
+            with wx.BusyCursor():
+                image.Update()
+                count = ROIValueExport.export_roi_values(
+                    image.GetRealImage(), stencil_data, filename)
+            logging.info("Saved %d image values to '%s'" % (count, filename))
+        except Exception, e:
+            logging.exception("SaveImageValues")
+            message = "An error occurred while trying to write image values to"
+            dlg = wx.MessageDialog(component.getUtility(IMicroViewMainFrame), "%s '%s'\n\n%s" % (
+                message, filename, e), 'Error', wx.OK | wx.ICON_ERROR)
+            dlg.ShowModal()
+            dlg.Destroy()
+            return
+
+        self.SaveCurrentDirectory(os.path.dirname(os.path.abspath(filename)))
+        return count
+
     def SaveAreaAsImage(self, stencil=None):
         """Write the scene in a ROI to an image file provided the ROI is rectangular and 2D.
         The original code is in StatsVolumeSelectionFactory.
@@ -2166,8 +2467,155 @@ class ExternalSelection(object):
 #=====================================================================
 
 
+class DICOMHeaderIndex(object):
+
+    """A persistent, per-directory index of DICOM headers.
+
+    Entries are keyed by filename and validated against the file's
+    modification time and size, so re-examining an unchanged directory only
+    costs a stat() per file.  Files that turned out not to be DICOM are
+    recorded too (with a header of None) so they aren't re-read either.
+
+    The listings of subdirectories are kept too, keyed by directory and
+    validated against its modification time, so that a tree can be walked
+    without listing or stat()ing the files of directories that haven't
+    changed."""
+
+    _cache_version = 2
+
+    # directories modified this recently may still change within the
+    # resolution of their modification time, so their listings aren't kept
+    _settle_time = 2.0
+
+    def __init__(self, _dir):
+
+        self._dir = os.path.abspath(_dir)
+        self._entries = {}
+        self._directories = {}
+        self._modified = False
+
+        cache_dir = os.path.join(appdirs.user_cache_dir(
+            "MicroView", "Parallax Innovations"), "DICOMHeaders")
+        # byte-string paths are hashed as they are; they may not be ASCII
+        _dir = self._dir
+        if isinstance(_dir, unicode):
+            _dir = _dir.encode('utf-8')
+        key = hashlib.sha1(_dir).hexdigest()
+        self._filename = os.path.join(cache_dir, key + '.pkl')
+
+        self.Load()
+
+    def Load(self):
+        """Load the index from disk, if present and of a compatible version"""
+        self._entries = {}
+        self._directories = {}
+        self._modified = False
+        if not os.path.exists(self._filename):
+            return
+        try:
+            with open(self._filename, 'rb') as _f:
+                version, _dir, entries, directories = cPickle.load(_f)
+            if version == self._cache_version and _dir == self._dir:
+                self._entries = entries
+                self._directories = directories
+        except:
+            logging.debug(
+                "Unable to read DICOM header index {0}".format(self._filename))
+
+    def Save(self):
+        """Write the index back to disk if it has changed"""
+        if not self._modified:
+            return
+        _dir = os.path.dirname(self._filename)
+        tmp_filename = self._filename + '.tmp'
+        try:
+            if not os.path.exists(_dir):
+                os.makedirs(_dir)
+            with open(tmp_filename, 'wb') as _f:
+                cPickle.dump((self._cache_version, self._dir, self._entries, self._directories),
+                             _f, cPickle.HIGHEST_PROTOCOL)
+            if os.path.exists(self._filename):
+                os.remove(self._filename)
+            os.rename(tmp_filename, self._filename)
+            self._modified = False
+        except:
+            logging.debug(
+                "Unable to write DICOM header index {0}".format(self._filename))
+
+    def Lookup(self, filename, stat):
+        """Returns (True, header) for a valid entry, (False, None) otherwise.
+
+        header is None for files previously found not to be DICOM"""
+        entry = self._entries.get(filename)
+        if entry is not None and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+            return True, entry[2]
+        return False, None
+
+    def Get(self, filename):
+        """Returns (True, header) if there's an entry for filename, without
+        checking that the file hasn't changed, and (False, None) otherwise."""
+        entry = self._entries.get(filename)
+        if entry is not None:
+            return True, entry[2]
+        return False, None
+
+    def Store(self, filename, stat, ds):
+        self._entries[filename] = (stat.st_mtime, stat.st_size, ds)
+        self._modified = True
+
+    def LookupDirectory(self, path, stat):
+        """Returns (True, (subdirectories, filenames)) if path hasn't changed
+        since it was stored, (False, None) otherwise."""
+        entry = self._directories.get(path)
+        if entry is not None and entry[0] == stat.st_mtime:
+            return True, entry[1]
+        return False, None
+
+    def StoreDirectory(self, path, stat, subdirectories, filenames):
+        """Store a fresh listing of path, dropping the entries under
+        subdirectories that have gone since it was last stored"""
+        entry = self._directories.get(path)
+        if entry is not None:
+            for name in set(entry[1][0]).difference(subdirectories):
+                self.DropDirectory(os.path.join(path, name))
+        # a directory that may still change is listed again next time, but
+        # its listing is kept to find the subdirectories that go
+        mtime = stat.st_mtime
+        if time.time() - mtime < self._settle_time:
+            mtime = None
+        self._directories[path] = (mtime, (subdirectories, filenames))
+        self._modified = True
+
+    def DropDirectory(self, path):
+        """Drop the entries for a directory that no longer exists, and everything under it"""
+        prefix = os.path.join(path, '')
+        for key in [key for key in self._directories if key == path or key.startswith(prefix)]:
+            del self._directories[key]
+        for key in [key for key in self._entries if key.startswith(prefix)]:
+            del self._entries[key]
+        self._modified = True
+
+    def Prune(self, filenames, directories):
+        """Drop entries for files in the listed directories that are no
+        longer there.  Entries in other directories are kept."""
+        directories = set(os.path.normpath(path) for path in directories)
+        filenames = set(filenames)
+        stale = [filename for filename in self._entries
+                 if filename not in filenames and
+                 os.path.normpath(os.path.dirname(filename)) in directories]
+        for filename in stale:
+            del self._entries[filename]
+        if stale:
+            self._modified = True
+
+
 class MicroViewDICOMExaminer(object):
 
+    # number of threads used to read headers.  Header reads are dominated by
+    # I/O latency (especially on network storage) so we use more threads
+    # than cores
+    max_workers = 4 * multiprocessing.cpu_count()
+
     def __init__(self, _dir):
 
         self._dir = _dir
@@ -2177,6 +2625,7 @@ class MicroViewDICOMExaminer(object):
         self.series_slice_locations = {}
         self._filenames = []
         self.bShouldUpdateDICOMDIR = True
+        self.bUseHeaderIndex = True
 
     def GetSeriesInfo(self):
         return self.series
@@ -2208,6 +2657,15 @@ class MicroViewDICOMExaminer(object):
     def Yield(self):
         pass
 
+    def _IsDICOMPreamble(self, s):
+        """Check the first 512 bytes of a file to see if it's DICOM"""
+        if s[128:128 + 4] == 'DICM':
+            return True
+        elif '\x08\x00\x08\x60' in s and ('MONOCHROME' in s or 'PALETTE' in s or 'RGB' in s):
+            return True
+        else:
+            return False
+
     def IsDICOMFile(self, filename):
         """Check file to see if it's DICOM"""
 
@@ -2216,32 +2674,173 @@ class MicroViewDICOMExaminer(object):
 
         try:
             with open(filename, 'rb') as _f:
-                s = _f.read(512)
-                if s[128:128 + 4] == 'DICM':
-                    return True
-                elif '\x08\x00\x08\x60' in s and ('MONOCHROME' in s or 'PALETTE' in s or 'RGB' in s):
-                    return True
-                else:
-                    return False
+                return self._IsDICOMPreamble(_f.read(512))
         except:
             return False
 
+    def ReadDICOMHeader(self, filename):
+        """Open a file once, check it and read its header.
+
+        Returns None if the file isn't DICOM.  Safe to call from worker
+        threads."""
+
+        try:
+            with open(filename, 'rb') as _f:
+                if not self._IsDICOMPreamble(_f.read(512)):
+                    return None
+                _f.seek(0)
+                return dicom.read_file(_f, stop_before_pixels=True, force=True)
+        except:
+            # something went wrong - oops - our preamble check failed us?!
+            return None
+
+    def _OpenHeaderIndex(self):
+        if not self.bUseHeaderIndex:
+            return None
+        try:
+            return DICOMHeaderIndex(self._dir)
+        except:
+            logging.exception("Unable to use DICOM header index, reading all headers")
+            return None
+
+    def ReadHeaders(self, files, prune=True, trusted=(), index=None):
+        """Yields (filename, header) pairs in order, reading headers that
+        aren't in the header index on a thread pool.
+
+        prune is either a boolean or the directories that were listed to
+        give files.  Index entries for files in those directories (the ones
+        holding files, if it's True) that aren't in files are dropped.
+
+        Headers of files in trusted are taken from the index, if it has
+        them, without checking that the files haven't changed."""
+
+        if index is None:
+            index = self._OpenHeaderIndex()
+        if index is not None and prune:
+            try:
+                if prune is True:
+                    prune = set(os.path.dirname(filename) for filename in files)
+                index.Prune(files, prune)
+            except:
+                logging.exception("Unable to prune DICOM header index")
+
+        headers = {}
+        stats = {}
+        pending = []
+        trusted = set(trusted)
+        for filename in files:
+            if index is not None and filename in trusted:
+                found, ds = index.Get(filename)
+                if found:
+                    headers[filename] = ds
+                    continue
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                headers[filename] = None
+                continue
+            if not stat_module.S_ISREG(stat.st_mode):
+                headers[filename] = None
+                continue
+            stats[filename] = stat
+            if index is not None:
+                found, ds = index.Lookup(filename, stat)
+                if found:
+                    headers[filename] = ds
+                    continue
+            pending.append(filename)
+
+        pool = None
+        results = iter([])
+        if pending:
+            pool = ThreadPool(min(self.max_workers, len(pending)))
+            results = pool.imap(self.ReadDICOMHeader, pending, chunksize=8)
+
+        try:
+            for filename in files:
+                if filename not in headers:
+                    ds = results.next()
+                    headers[filename] = ds
+                    if index is not None:
+                        index.Store(filename, stats[filename], ds)
+                yield filename, headers.pop(filename)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if index is not None:
+                index.Save()
+
+    def ReadTreeHeaders(self):
+        """Yields (filename, header) pairs for every file under the directory
+        other than DICOMDIR files, in order.
+
+        Only directories that have changed since they were last walked -- a
+        new MV#### folder, say -- are listed and have their headers read.
+        Everything else comes straight from the header index."""
+
+        index = self._OpenHeaderIndex()
+
+        files = []
+        trusted = []
+        listed = []
+        pending = [self._dir]
+        while pending:
+            path = pending.pop()
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            found, listing = False, None
+            if index is not None:
+                found, listing = index.LookupDirectory(path, stat)
+
+            if found:
+                subdirectories, filenames = listing
+            else:
+                subdirectories, filenames = [], []
+                try:
+                    names = sorted(os.listdir(path))
+                except OSError:
+                    continue
+                for name in names:
+                    if os.path.isdir(os.path.join(path, name)):
+                        subdirectories.append(name)
+                    elif 'dicomdir' not in name.lower():
+                        filenames.append(name)
+                listed.append(path)
+                if index is not None:
+                    index.StoreDirectory(path, stat, subdirectories, filenames)
+
+            names = [os.path.join(path, name) for name in filenames]
+            files.extend(names)
+            if found:
+                trusted.extend(names)
+
+            # walk in the same order as os.walk
+            pending.extend(os.path.join(path, name) for name in reversed(subdirectories))
+
+        for item in self.ReadHeaders(files, prune=listed, trusted=trusted, index=index):
+            yield item
+
     def ExamineDirectory(self, matching_tags={}):
 
         self.dicom_headers = {}
         self.series = {}
         self.series_slice_locations = {}
-        self._filenames = glob.glob(os.path.join(self._dir, '*'))
+        files = sorted(glob.glob(os.path.join(self._dir, '*')))
+        self._filenames = []
         if self.bShouldUpdateDICOMDIR:
             dicomdir_filename = os.path.join(self._dir, 'DICOMDIR')
             self._dicomdir = dicomdir(dicomdir_filename)
 
-        files = self._filenames[:]
         ignored_file_warning = False
 
         with self.BusyStart():
 
-            for i in range(len(files)):
+            # only this directory was listed, so keep the index entries for
+            # any below it
+            for i, (filename, ds) in enumerate(self.ReadHeaders(files, prune=[self._dir])):
 
                 # wake up GUI periodically
                 if i % 10:
@@ -2251,28 +2850,20 @@ class MicroViewDICOMExaminer(object):
                 event.notify(ProgressEvent(
                     "Examining files...", float(i) / len(files)))
 
-                # read DICOM header
-                if not self.IsDICOMFile(files[i]):
-                    self._filenames.remove(files[i])
+                # not a DICOM file, or we failed to read it
+                if ds is None:
                     continue
 
-                # looks good - keep reading
-                try:
-                    ds = dicom.read_file(
-                        files[i], stop_before_pixels=True, force=True)
-                except:
-                    # something went wrong - oops - our IsDICOMFile() failed
-                    # us?!
-                    self._filenames.remove(files[i])
-                    continue
+                self._filenames.append(filename)
 
                 # throw out DICOMDIR
-                if ds.file_meta.MediaStorageSOPClassUID == '1.2.840.10008.1.3.10':
+                if getattr(ds.get('file_meta'), 'MediaStorageSOPClassUID', None) == \
+                        '1.2.840.10008.1.3.10':
                     continue
 
                 # update DICOMDIR for this data
                 if self.bShouldUpdateDICOMDIR:
-                    self._dicomdir.add_file(files[i], self._dir, ds=ds)
+                    self._dicomdir.add_file(filename, self._dir, ds=ds)
 
                 series_number = ds.get('SeriesNumber')
                 acq_number = ds.get('AcquisitionNumber')
@@ -2298,13 +2889,13 @@ class MicroViewDICOMExaminer(object):
                                 # we do this like this to avoid too many log
                                 # messages
                                 logging.debug("Ignoring file {0} because of mismatched tag {1} ({2} != {3})".format(
-                                    files[i], key, ds.get(key), matching_tags[key]))
+                                    filename, key, ds.get(key), matching_tags[key]))
                             file_matched = False
                             break
 
                     if file_matched:
                         # sort images into sequences
-                        self.series[label].append(files[i])
+                        self.series[label].append(filename)
 
                         # record slice locations
                         if slice_loc is not None:
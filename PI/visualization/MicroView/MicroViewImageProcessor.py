@@ -4,18 +4,26 @@ from zope import interface, event
 from PI.visualization.MicroView.interfaces import IImageProcessor
 from PI.visualization.common.events import ProgressEvent
 from PI.visualization.vtkMultiIO import MVImage
+from PI.visualization.MicroView import OtsuThreshold
 
 import vtk
 import logging
+import multiprocessing
 import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
 import skimage.filters
 import numpy as np
+from multiprocessing.pool import ThreadPool
 
 
 class MicroViewImageProcessor(object):
 
     interface.implements(IImageProcessor)
 
+    # number of worker threads used by the numpy-based filters
+    max_workers = multiprocessing.cpu_count()
+
     def ConvertToGrayScale(self, image):
         """Convert Image to grayscale representation"""
 
@@ -58,18 +66,18 @@ class MicroViewImageProcessor(object):
 
         n = image.get_array()
         dims = n.shape
+        title = "Applying uniform filter..."
 
-        if image3d or len(dims) == 2 or dims[0] == 1:
-            event.notify(ProgressEvent("Applying uniform filter...", 0.5))
+        if len(dims) == 2:
+            event.notify(ProgressEvent(title, 0.5))
             n[:] = scipy.ndimage.filters.uniform_filter(n, size=radius)
-            event.notify(ProgressEvent("Applying uniform filter...", 1.0))
+        elif image3d or dims[0] == 1:
+            self._ApplyBlockWise(
+                n, lambda block: scipy.ndimage.filters.uniform_filter(block, size=radius), radius // 2, title)
         else:
             # apply slice-by-slice filter
-            for z in range(dims[0]):
-                event.notify(
-                    ProgressEvent("Applying uniform filter...", float(z) / dims[0]))
-                n[z, :] = scipy.ndimage.filters.uniform_filter(
-                    n[z, :], size=radius)
+            self._ApplySliceWise(
+                n, lambda plane: scipy.ndimage.filters.uniform_filter(plane, size=radius), title)
 
         # image.GetPointData().GetScalars().Modified()
         image.ScalarsModified()
@@ -82,18 +90,18 @@ class MicroViewImageProcessor(object):
 
         n = image.get_array()
         dims = n.shape
+        title = "Applying maximum filter..."
 
-        if image3d or len(dims) == 2 or dims[0] == 1:
-            event.notify(ProgressEvent("Applying maximum filter...", 0.5))
+        if len(dims) == 2:
+            event.notify(ProgressEvent(title, 0.5))
             n[:] = scipy.ndimage.filters.maximum_filter(n, size=radius)
-            event.notify(ProgressEvent("Applying maximum filter...", 1.0))
+        elif image3d or dims[0] == 1:
+            self._ApplyBlockWise(
+                n, lambda block: scipy.ndimage.filters.maximum_filter(block, size=radius), radius // 2, title)
         else:
             # apply slice-by-slice filter
-            for z in range(dims[0]):
-                event.notify(
-                    ProgressEvent("Applying maximum filter...", float(z) / dims[0]))
-                n[z, :] = scipy.ndimage.filters.maximum_filter(
-                    n[z, :], size=radius)
+            self._ApplySliceWise(
+                n, lambda plane: scipy.ndimage.filters.maximum_filter(plane, size=radius), title)
 
         # image.GetPointData().GetScalars().Modified()
         image.ScalarsModified()
@@ -106,18 +114,18 @@ class MicroViewImageProcessor(object):
 
         n = image.get_array()
         dims = n.shape
+        title = "Applying minimum filter..."
 
-        if image3d or len(dims) == 2 or dims[0] == 1:
-            event.notify(ProgressEvent("Applying minimum filter...", 0.5))
+        if len(dims) == 2:
+            event.notify(ProgressEvent(title, 0.5))
             n[:] = scipy.ndimage.filters.minimum_filter(n, size=radius)
-            event.notify(ProgressEvent("Applying minimum filter...", 0.5))
+        elif image3d or dims[0] == 1:
+            self._ApplyBlockWise(
+                n, lambda block: scipy.ndimage.filters.minimum_filter(block, size=radius), radius // 2, title)
         else:
             # apply slice-by-slice filter
-            for z in range(dims[0]):
-                event.notify(
-                    ProgressEvent("Applying minimum filter...", float(z) / dims[0]))
-                n[z, :] = scipy.ndimage.filters.minimum_filter(
-                    n[z, :], size=radius)
+            self._ApplySliceWise(
+                n, lambda plane: scipy.ndimage.filters.minimum_filter(plane, size=radius), title)
 
         # image.GetPointData().GetScalars().Modified()
         image.ScalarsModified()
@@ -148,11 +156,9 @@ class MicroViewImageProcessor(object):
 
         else:
             # apply slice-by-slice filter
-            for z in range(dims[0]):
-                event.notify(
-                    ProgressEvent("Applying slice-by-slice Gaussian filter...", float(z) / dims[0]))
-                n[z, :] = scipy.ndimage.filters.gaussian_filter(
-                    n[z, :], sigma=radius)
+            self._ApplySliceWise(
+                n, lambda plane: scipy.ndimage.filters.gaussian_filter(plane, sigma=radius),
+                "Applying slice-by-slice Gaussian filter...")
             # image.GetPointData().GetScalars().Modified()
             image.ScalarsModified()
             event.notify(
@@ -287,11 +293,10 @@ class MicroViewImageProcessor(object):
         from skimage.morphology import disk
 
         n = image.get_array()
-        for z in range(n.shape[0]):
-            event.notify(ProgressEvent(
-                "Applying bilateral-mean adaptive threshold...", float(z) / n.shape[0]))
-            n[z, :, :] = skimage.filters.rank.mean_bilateral(
-                n[z, :, :], disk(radius), s0=10, s1=10)
+        selem = disk(radius)
+        self._ApplySliceWise(
+            n, lambda plane: skimage.filters.rank.mean_bilateral(plane, selem, s0=10, s1=10),
+            "Applying bilateral-mean adaptive threshold...")
         image.ScalarsModified()
         # image.GetPointData().GetScalars().Modified()
 
@@ -313,70 +318,129 @@ class MicroViewImageProcessor(object):
         logging.info("Otsu threshold applied")
 
     def AdaptiveOtsuThresholdFilter(self, image, min_level=1000.0, max_level=1e34, chunk_size=32):
-        """Break image into chunks; threshold each chunk individually
+        """Threshold an image against a smoothly varying Otsu threshold
 
-        One notable limitation here - the same threshold is applied for each pixel within each chunk so discontinuities
-        likely occur at the boundary between chunks.  A smarter approach would be to perform trilinear interpolation
-        across the entire image to find an optimal threshold and use this rather than the chunk-level Otsu value.
+        The image is broken into chunks and an Otsu threshold is found for each chunk.  Each chunk threshold is
+        assigned to the chunk's centre, and the threshold at every voxel is found by trilinear interpolation
+        between chunk centres, so there are no discontinuities at chunk boundaries.  Chunk thresholds are
+        computed in parallel, and the image is thresholded one z-slab at a time, so a full-size threshold volume
+        is never allocated.
 
         Args:
-            arr (np.ndarray): 3D numpy array representing the image
+            image (MVImage): image to threshold in-place
             min_level (float): Optional level to clamp thresholding - this is useful if we land on an image region
                 with no signal
-            max_level (float): Unused
+            max_level (float): Optional upper clamp for the threshold
             chunk_size (int): Size of image region to examine
 
         """
 
-        # Image is broken into `chunk_size` chunks along each axis
-        # min_level applies a cutoff to avoid boosting noise
-        # max_level - not sure if this is useful or not
-
         # access underlying image
         logging.info("Performing Adaptive Otsu thresholding...")
         arr = image.get_array()
+        chunk_size = int(chunk_size)
 
         zs, ys, xs = arr.shape
         xn = int(np.ceil(xs / float(chunk_size)))
         yn = int(np.ceil(ys / float(chunk_size)))
         zn = int(np.ceil(zs / float(chunk_size)))
 
-        #thresholds = np.zeros([zn, yn, xn], dtype='float32')
-
-        for z in range(zn):
-            for y in range(yn):
-                for x in range(xn):
-                    arr2 = arr[z * chunk_size:(z + 1) * chunk_size,
-                               y * chunk_size:(y + 1) * chunk_size,
-                               x * chunk_size:(x + 1) * chunk_size]
-                    try:
-                        otsu = skimage.filters.threshold_otsu(arr2)
-                        # don't let otsu threshold fall below min_level
-                        otsu = max(otsu, min_level)
-                        # don't let otsu threshold rise above max_level
-                        otsu = min(otsu, max_level)
-                        #thresholds[z, y, x] = otsu
-                        arr2[:] = arr2 > otsu
-                    except ValueError:
-                        pass
-
-        # reinterpolate threshold image
-        #thresholds2 = zoom(thresholds, [float(zs)/zn, float(ys)/yn, float(xs)/xn])
-
-        # finally, threshold image
-        #arr[:] = arr > thresholds2
+        def chunk_row_thresholds(index):
+            # Otsu threshold of each chunk along one row of chunks
+            z, y = divmod(index, yn)
+            row = arr[z * chunk_size:(z + 1) * chunk_size,
+                      y * chunk_size:(y + 1) * chunk_size]
+            return z, y, self._ChunkOtsuThresholds(row, chunk_size, min_level)
+
+        def threshold_slab(z0):
+            # threshold a slab of planes against the interpolated threshold field
+            for z in range(z0, min(z0 + chunk_size, zs)):
+                plane = np.dot(wz[z], thresholds.reshape(zn, -1)).reshape(yn, xn)
+                plane = np.dot(np.dot(wy, plane), wx.T)
+                arr[z] = arr[z] > plane
+            return z0
+
+        # chunk thresholds, clamped to the requested range
+        thresholds = np.empty((zn, yn, xn), dtype='float64')
+        for z, y, t in self._ParallelMap(chunk_row_thresholds, range(zn * yn),
+                                         "Computing adaptive Otsu thresholds..."):
+            thresholds[z, y] = t
+        np.clip(thresholds, min_level, max_level, out=thresholds)
+
+        # interpolation weights between chunk centres, along each axis
+        wz = self._ChunkInterpolationWeights(zs, zn, chunk_size)
+        wy = self._ChunkInterpolationWeights(ys, yn, chunk_size)
+        wx = self._ChunkInterpolationWeights(xs, xn, chunk_size)
+
+        for z in self._ParallelMap(threshold_slab, range(0, zs, chunk_size),
+                                   "Applying adaptive Otsu threshold..."):
+            pass
 
         # image.GetPointData().GetScalars().Modified()
         image.ScalarsModified()
 
         logging.info("Adaptive Otsu threshold applied")
 
+    def _ChunkOtsuThresholds(self, row, chunk_size, default, nbins=256):
+        """Otsu thresholds for each chunk along the x-axis of a row of chunks
+
+        The histograms for all chunks in the row are built together with a single bincount.  Chunks that can't be
+        split (e.g. constant regions) get the default threshold.
+        """
+
+        xs = row.shape[2]
+        xn = int(np.ceil(xs / float(chunk_size)))
+        starts = np.arange(0, xs, chunk_size)
+
+        # per-chunk value ranges
+        lo = np.minimum.reduceat(row.min(axis=1).min(axis=0), starts).astype('float64')
+        hi = np.maximum.reduceat(row.max(axis=1).max(axis=0), starts).astype('float64')
+        width = (hi - lo) / nbins
+        width[width == 0] = 1.0
+
+        # bin every voxel of the row into its chunk's histogram
+        chunk = np.arange(xs) // chunk_size
+        bins = ((row - lo[chunk]) / width[chunk]).astype('int64')
+        np.clip(bins, 0, nbins - 1, out=bins)
+        bins += chunk * nbins
+        histograms = np.bincount(bins.ravel(), minlength=xn * nbins).reshape(xn, nbins)
+
+        thresholds = np.empty(xn, dtype='float64')
+        centres = (np.arange(nbins) + 0.5)
+        for x in range(xn):
+            if hi[x] == lo[x]:
+                thresholds[x] = default
+            else:
+                thresholds[x] = OtsuThreshold.otsu_threshold(lo[x] + centres * width[x], histograms[x])
+
+        return thresholds
+
+    def _ChunkInterpolationWeights(self, size, count, chunk_size):
+        """Linear interpolation weights from chunk centres to voxels along one axis
+
+        Returns a (size, count) array; voxels beyond the first and last chunk centres take the nearest chunk value.
+        """
+
+        weights = np.zeros((size, count), dtype='float64')
+        if count == 1:
+            weights[:] = 1.0
+            return weights
+
+        # chunk coordinate of each voxel centre
+        g = np.clip((np.arange(size) + 0.5) / chunk_size - 0.5, 0, count - 1)
+        i0 = np.minimum(np.floor(g).astype(int), count - 2)
+        f = g - i0
+        weights[np.arange(size), i0] = 1.0 - f
+        weights[np.arange(size), i0 + 1] = f
+
+        return weights
+
     def BinaryErodeFilter(self, image, niter):
         """Erode image"""
 
         logging.info("Eroding image...")
         n = image.get_array()
-        n[:] = scipy.ndimage.morphology.binary_erosion(n, iterations=niter)
+        self._ApplyMorphology(n, scipy.ndimage.morphology.binary_erosion, niter, "Eroding image...")
         # image.GetPointData().GetScalars().Modified()
         image.ScalarsModified()
 
@@ -387,7 +451,7 @@ class MicroViewImageProcessor(object):
 
         logging.info("Dilating image...")
         n = image.get_array()
-        n[:] = scipy.ndimage.morphology.binary_dilation(n, iterations=niter)
+        self._ApplyMorphology(n, scipy.ndimage.morphology.binary_dilation, niter, "Dilating image...")
         # image.GetPointData().GetScalars().Modified()
         image.ScalarsModified()
 
@@ -415,8 +479,7 @@ class MicroViewImageProcessor(object):
 
         logging.info("Labelling image...")
         n = image.get_array()
-        _label, _n = scipy.ndimage.measurements.label(n)
-        n[:] = _label
+        _n = self._LabelBlockWise(n, "Labelling image...")
         # image.GetPointData().GetScalars().Modified()
         image.ScalarsModified()
 
@@ -461,8 +524,7 @@ class MicroViewImageProcessor(object):
         # experimental, in-place scipy work
         logging.info("Computing Euclidean distance transform...")
         n = image.get_array()
-        n[:] = scipy.ndimage.morphology.distance_transform_edt(
-            n).astype(n.dtype)
+        self._DistanceMapBlockWise(n, "Computing distance transform...")
         # image.GetPointData().GetScalars().Modified()
         image.ScalarsModified()
         logging.info("Distance transform applied")
@@ -482,6 +544,199 @@ class MicroViewImageProcessor(object):
 
         return MVImage.MVImage(_cast.GetOutputPort(), input=image)
 
+    def _ParallelMap(self, func, items, title):
+        """Run func over items on a thread pool, yielding results as they complete
+
+        scipy, skimage and numpy release the GIL in their inner loops, so threads give real parallelism without
+        copying the image between processes.  Progress is reported from the calling thread as a single
+        ProgressEvent stream covering all workers.
+        """
+
+        items = list(items)
+        pool = ThreadPool(max(1, min(self.max_workers, len(items))))
+        try:
+            for i, result in enumerate(pool.imap_unordered(func, items)):
+                event.notify(ProgressEvent(title, float(i + 1) / len(items)))
+                yield result
+        finally:
+            pool.terminate()
+
+    def _ApplySliceWise(self, arr, func, title):
+        """Replace each z-slice of arr, in-place, by func(slice), in parallel"""
+
+        def run(z):
+            arr[z] = func(arr[z])
+
+        for _ in self._ParallelMap(run, range(arr.shape[0]), title):
+            pass
+
+    def _ApplyBlockWise(self, arr, func, halo, title, block_size=None):
+        """Replace arr, in-place, by func(arr) computed over z-blocks in parallel
+
+        Each block is extended by `halo` planes on either side so that a filter whose footprint reaches at most
+        `halo` planes in z gives the same result as a whole-volume filter.  The halo planes are copied before any
+        block is written, so blocks never see their neighbours' output.
+        """
+
+        zs = arr.shape[0]
+        if block_size is None:
+            # a few blocks per worker to balance the load
+            block_size = int(np.ceil(zs / float(4 * self.max_workers)))
+        block_size = max(block_size, 2 * halo, 1)
+
+        halos = {}
+        for z0 in range(0, zs, block_size):
+            z1 = min(z0 + block_size, zs)
+            halos[z0] = (arr[max(z0 - halo, 0):z0].copy(), arr[z1:min(z1 + halo, zs)].copy())
+
+        def run(z0):
+            z1 = min(z0 + block_size, zs)
+            below, above = halos.pop(z0)
+            block = np.concatenate((below, arr[z0:z1], above))
+            arr[z0:z1] = func(block)[len(below):len(below) + z1 - z0]
+
+        for _ in self._ParallelMap(run, sorted(halos), title):
+            pass
+
+    def _ApplyMorphology(self, arr, operation, niter, title):
+        """Apply a binary erosion or dilation in-place, over z-blocks
+
+        Each iteration reaches one plane further in z, so a halo of niter planes gives the whole-volume result.
+        """
+
+        niter = int(niter)
+        if niter < 1 or arr.ndim == 2:
+            # iterate until nothing changes - the reach isn't bounded
+            arr[:] = operation(arr, iterations=niter)
+        else:
+            self._ApplyBlockWise(arr, lambda block: operation(block, iterations=niter), niter, title)
+
+    def _BlockStarts(self, zs):
+        """Start planes of the z-blocks used by the block-wise labelling and distance map"""
+
+        block_size = int(np.ceil(zs / float(4 * self.max_workers)))
+        return range(0, zs, max(block_size, 1)), max(block_size, 1)
+
+    def _LabelBlockWise(self, arr, title):
+        """Label the connected components of arr in-place.  Returns the number of labels
+
+        Blocks are labelled independently, and components that touch across a block seam are merged afterwards.
+        Labels are numbered in raster order of each component's first voxel, as scipy.ndimage.label does, so
+        the result is identical to labelling the whole volume.  Only per-block label arrays are ever allocated.
+        """
+
+        if arr.ndim == 2:
+            _label, _n = scipy.ndimage.measurements.label(arr)
+            arr[:] = _label
+            return _n
+
+        zs = arr.shape[0]
+        starts, block_size = self._BlockStarts(zs)
+
+        def label_block(z0):
+            # label a block, keeping only its counts and seam planes
+            labels, count = scipy.ndimage.measurements.label(arr[z0:z0 + block_size])
+            return z0, count, labels[0].copy(), labels[-1].copy()
+
+        blocks = {}
+        for z0, count, first, last in self._ParallelMap(label_block, starts, title):
+            blocks[z0] = (count, first, last)
+
+        # global label = block label + offset of its block
+        offsets = {}
+        total = 0
+        for z0 in starts:
+            offsets[z0] = total
+            total += blocks[z0][0]
+
+        # pair up labels on either side of each seam
+        pairs = [np.zeros((0, 2), dtype='int64')]
+        for z0 in starts[1:]:
+            prev = z0 - block_size
+            above = blocks[prev][2].astype('int64')
+            below = blocks[z0][1].astype('int64')
+            touching = (above > 0) & (below > 0)
+            pairs.append(np.column_stack((above[touching] + offsets[prev], below[touching] + offsets[z0])))
+        pairs = np.concatenate(pairs)
+
+        graph = scipy.sparse.coo_matrix(
+            (np.ones(len(pairs), dtype='int32'), (pairs[:, 0], pairs[:, 1])), shape=(total + 1, total + 1))
+        _n, component = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+        # number merged components by their lowest global label, i.e. their first voxel in raster order
+        first = np.empty(_n, dtype='int64')
+        first.fill(total + 1)
+        np.minimum.at(first, component, np.arange(total + 1))
+        rank = np.empty(_n, dtype='int64')
+        rank[np.argsort(first)] = np.arange(_n)
+        mapping = rank[component]
+
+        def relabel_block(z0):
+            labels, count = scipy.ndimage.measurements.label(arr[z0:z0 + block_size])
+            labels = labels.astype('int64')
+            labels[labels > 0] += offsets[z0]
+            arr[z0:z0 + block_size] = mapping[labels]
+
+        for _ in self._ParallelMap(relabel_block, starts, title):
+            pass
+
+        # label 0 is the background
+        return _n - 1
+
+    def _DistanceMapBlockWise(self, arr, title):
+        """Replace arr, in-place, by the Euclidean distance to its nearest zero voxel
+
+        The volume is processed in z-blocks.  A block's distances are exact wherever they don't exceed the halo
+        of planes around it, since any closer zero must lie within the halo.  Blocks are first computed in
+        parallel with a halo of one block; those with larger distances, or no zero within reach, are then
+        recomputed one at a time with a doubling halo, so that only one large window is ever held.  The mask is
+        kept bit-packed so blocks can read their neighbours after those have been overwritten.
+        """
+
+        if arr.ndim == 2:
+            arr[:] = scipy.ndimage.morphology.distance_transform_edt(arr)
+            return
+
+        zs, ys, xs = arr.shape
+        starts, block_size = self._BlockStarts(zs)
+
+        # bit-packed copy of the mask, 1/8 byte per voxel
+        mask = np.empty((zs, ys, int(np.ceil(xs / 8.0))), dtype='uint8')
+
+        def pack_block(z0):
+            mask[z0:z0 + block_size] = np.packbits(arr[z0:z0 + block_size] != 0, axis=-1)
+
+        for _ in self._ParallelMap(pack_block, starts, "Preparing distance transform..."):
+            pass
+
+        def distance_window(z0, halo):
+            # write block z0's distances, computed over a window of halo planes either side, if they're exact
+            z1 = min(z0 + block_size, zs)
+            h0, h1 = max(z0 - halo, 0), min(z1 + halo, zs)
+            whole = (h0 == 0 and h1 == zs)
+            window = np.unpackbits(mask[h0:h1], axis=-1)[..., :xs]
+            if not whole and window.all():
+                return False
+            distance = scipy.ndimage.morphology.distance_transform_edt(window)[z0 - h0:z1 - h0]
+            del window
+            if not whole and distance.max() > halo:
+                return False
+            # only the block is kept, in the image's type
+            arr[z0:z1] = distance
+            return True
+
+        def distance_block(z0):
+            if not distance_window(z0, block_size):
+                return z0
+
+        pending = sorted(z0 for z0 in self._ParallelMap(distance_block, starts, title) if z0 is not None)
+
+        for i, z0 in enumerate(pending):
+            halo = 2 * block_size
+            while not distance_window(z0, halo):
+                halo *= 2
+            event.notify(ProgressEvent(title, float(i + 1) / len(pending)))
+
     def HandleVTKProgressEvent(self, obj, evt):
         """A VTK object generated a progress event - convert it to a zope-style event"""
         event.notify(ProgressEvent(
@@ -621,6 +621,9 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
         self._plotwindow_title = "Plot Line Profile"
         self._histowindow_title = "Plot Line Profile"
 
+        # the image and ROI stencil behind the histogram highlight overlay
+        self._histogram_highlight_source = None
+
         # mean/std dev text window
         self._statswindow = None
         self._statswindow_labels = {}
@@ -970,7 +973,9 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
 
             with wx.WindowDisabler():
                 with wx.BusyCursor():
-                    image.Update()
+                    # images read on demand only load what the views ask for
+                    if mviewIn.GetLazySource(image) is None:
+                        image.Update()
                     self.SetOrthoInput(
                         image, orthoView=orthoView, mviewIn=mviewIn)
             # TODO: fix this VTK-6 line here
@@ -1684,7 +1689,11 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
             self.SetSliderValue(slice_id, _slice, _range)
 
             # VTK-6
-            if vtk.vtkVersion().GetVTKMajorVersion() > 5:
+            if hasattr(image, 'GetLazySource'):
+                # images read on demand are handed to the probe once a line
+                # profile is plotted, rather than read in full here
+                pass
+            elif vtk.vtkVersion().GetVTKMajorVersion() > 5:
                 self.probe.SetSourceData(image.GetRealImage())
             else:
                 self.probe.SetSource(image.GetRealImage())
@@ -2044,6 +2053,10 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
                             7], 'Save Crop coordinates', 'Save crop-region coords')
         item.Enable(False)
         self._save_file_ids.append(_ids[7])
+        item = menu1.Append(_ids[
+                            8], 'Save Image values...', 'Save image values inside the ROI')
+        item.Enable(False)
+        self._save_file_ids.append(_ids[8])
         item = wx.MenuItem(menu1, _ids[
                            9], 'Save Snapshot...', 'Save snapshot of window')
         item.SetBitmap(self._stockicons.getMenuBitmap('camera'))
@@ -2126,6 +2139,8 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
         self.Bind(wx.EVT_MENU, lambda e: self.SaveCropRegion(), id=_ids[6])
         self.Bind(wx.EVT_MENU, lambda e:
                   self.SaveCropRegionCoordinates(), id=_ids[7])
+        self.Bind(wx.EVT_MENU, lambda e:
+                  self.SaveImageValues(), id=_ids[8])
         self.Bind(wx.EVT_MENU, self.showTKeyHint, id=_ids[9])
         self.Bind(wx.EVT_MENU, self.saveScene, id=_ids[10])
         #self.Bind(wx.EVT_MENU, self.SerializeApp, id=_ids[11])
@@ -3125,16 +3140,27 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
         with wx.BusyCursor():
             table = component.getUtility(ICurrentOrthoView).GetLookupTable()
             _min, _max = table.GetTableRange()
-            l = self._ROIStats.GetThreshold()
-            w = (_max - _min)
-            _min = l - w / 2.0
-            _max = l + w / 2.0
+            thresholds = self._ROIStats.GetThresholds(
+                evt.GetNumberOfClasses())
+            if not thresholds:
+                return
+            if len(thresholds) == 1:
+                l = thresholds[0]
+                w = (_max - _min)
+                _min = l - w / 2.0
+                _max = l + w / 2.0
+            else:
+                # span the window over the intermediate classes
+                _min, _max = thresholds[0], thresholds[-1]
 
             table.SetTableRange(_min, _max)
             component.getUtility(ICurrentViewportManager).Render()
 
         if self._histowindow:
-            self._histowindow.showThresholdMarker(l)
+            if len(thresholds) == 1:
+                self._histowindow.showThresholdMarker(thresholds[0])
+            else:
+                self._histowindow.showThresholdMarker(thresholds)
 
     @component.adapter(GetROIStencilEvent)
     def onGetROIStencilEvent(self, evt):
@@ -3182,10 +3208,18 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
 
     def HistogramROIToStencil(self):
         logging.debug('generating ROI stencil from histogram in MicroViewMain')
-        stencil_generator_filter = vtk.vtkImageToImageStencil()
-        stencil_generator_filter.ThresholdByUpper(1)
+
+        # the highlight overlay is the image itself, so this is the only place
+        # the selection is applied to every voxel
         grow = component.getUtility(
             ICurrentOrthoView).GetOrthoPlanes().GetInput("histogram")
+        selectedrange = self._histowindow.GetSelectionRange()
+        if grow is None or selectedrange == (None, None):
+            return None
+
+        stencil_generator_filter = vtk.vtkImageToImageStencil()
+        stencil_generator_filter.ThresholdBetween(
+            min(selectedrange), max(selectedrange))
         stencil_generator_filter.SetInput(grow)
         # TODO: VTK-6 is this needed?
         # self._histowindow.SetROIStencilData(s.GetOutput())
@@ -3239,30 +3273,44 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
                 self._histowindow.SetHighlightVisible(False)
             return
 
-        thresholdfilter = vtk.vtkImageThreshold()
-        thresholdfilter.ReplaceInOn()
-        thresholdfilter.ReplaceOutOn()
-        thresholdfilter.SetInValue(1)
-        thresholdfilter.SetOutValue(0)
-        thresholdfilter.ThresholdBetween(selectedrange[0], selectedrange[1])
-        thresholdfilter.SetOutputScalarType(3)
-        clip = self.GetClippedImage()
-        if clip is None:
-            thresholdfilter.SetInput(image.GetRealImage())
-        else:
-            thresholdfilter.SetInput(clip.GetOutput())
-        thresholdfilter.Update()
+        # the overlay shows the (clipped) image through a lookup table that
+        # only colours the selected range, so moving the selection just swaps
+        # the table and the cost is in the resliced planes, not the volume.
+        # The overlay input only needs replacing when the image or ROI changes
+        real_image = image.GetRealImage()
+        stencil_data = self.GetROIStencilData()
+        if image.GetStencilDataOwner() == "histogram":
+            # don't clip the image by a stencil made from an earlier selection
+            stencil_data = None
+        source = self._histogram_highlight_source
+        if (histogram_input is None or source is None or source[0] is not real_image or
+                source[1] is not stencil_data or
+                (stencil_data is not None and source[2] != stencil_data.GetMTime())):
+
+            clip = None
+            if stencil_data is not None:
+                clip = self.GetClippedImage()
+            if clip is None:
+                overlay = real_image
+            else:
+                clip.Update()
+                overlay = clip.GetOutput()
 
-        # existing histogram overlay?  delete it.
-        if histogram_input:
-            component.getUtility(
-                ICurrentOrthoView).GetOrthoPlanes().RemoveInput("histogram")
+            # existing histogram overlay?  delete it.
+            if histogram_input:
+                component.getUtility(
+                    ICurrentOrthoView).GetOrthoPlanes().RemoveInput("histogram")
 
-        component.getUtility(ICurrentOrthoView).GetOrthoPlanes().SetInputData(
-            thresholdfilter.GetOutput(), "histogram")
+            component.getUtility(ICurrentOrthoView).GetOrthoPlanes().SetInputData(
+                overlay, "histogram")
 
+            self._histogram_highlight_source = (
+                real_image, stencil_data, stencil_data.GetMTime() if stencil_data else 0)
+
+        integer_data = real_image.GetScalarType() not in (vtk.VTK_FLOAT, vtk.VTK_DOUBLE)
         component.getUtility(ICurrentOrthoView).GetOrthoPlanes().SetLookupTable(
-            self._histowindow.CreateHighlightLookupTable(), "histogram")
+            self._histowindow.CreateHighlightLookupTable(
+                selectedrange[0], selectedrange[1], integer_data), "histogram")
 
         component.getUtility(ICurrentViewportManager).Render()
 
@@ -4631,7 +4679,8 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
 
             with wx.WindowDisabler():
                 with wx.BusyCursor():
-                    image.Update()
+                    if mviewIn.GetLazySource(image) is None:
+                        image.Update()
                     self.SetOrthoInput(
                         image, orthoView=orthoView, mviewIn=mviewIn)
                     # TODO: fix next two lines for VTK-6 compatibility
@@ -5384,6 +5433,10 @@ class MicroViewMainFrame(wx.Frame, wx.FileDropTarget):
         """Save the crop coordinates to a file"""
         return self.mviewOut.SaveSubVolumeCoordinatesToDisk(filename, stencil=self.GetROIStencilData())
 
+    def SaveImageValues(self, filename=None):
+        """Save the image values inside the ROI to a file"""
+        return self.mviewOut.SaveImageValues(filename, stencil_data=self.GetROIStencilData())
+
     def SaveCropRegionCoordinatesSpecifyName(self):
         """Save the crop coordinates to a file"""
 
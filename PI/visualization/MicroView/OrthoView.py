@@ -702,9 +702,23 @@ class OrthoView(object):
         for pane in self.renderPanes:
             pane.SetCoordinateSystem(coord_system)
 
+        # images read on demand are streamed into the slice planes, so only
+        # the slabs they display get loaded
+        lazy = None
+        if mviewIn is not None and hasattr(self.GetOrthoPlanes(), 'SetInputConnection'):
+            lazy = mviewIn.GetLazySource(image)
+        elif mviewIn is not None and mviewIn.GetLazySource(image) is not None:
+            logging.warning("Slice planes can't stream - reading whole image")
+            image.Update()
+
         # make sure header info is correct, otherwise extent calculation may be
         # wrong
-        extent = image.GetExtent()
+        if lazy is not None:
+            lazy.UpdateInformation()
+            extent = lazy.GetOutputInformation(0).Get(
+                vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+        else:
+            extent = image.GetExtent()
 
         rank = 0
         for i in range(len(extent) / 2):
@@ -720,9 +734,21 @@ class OrthoView(object):
             self.GetOrthoPlanes().SetSliceInterpolate(1)
             self.renderPanes[0].BindRotateToButton(1)
 
-        self.GetOrthoPlanes().SetInputData(image.GetRealImage())
-        self.volumeOutline.SetInputData(image.GetRealImage())
-        self.axesLabels.SetInputData(image.GetRealImage())
+        if lazy is not None:
+            self.GetOrthoPlanes().SetInputConnection(lazy.GetOutputPort())
+
+            # the outline and labels only need the image geometry
+            geometry = vtk.vtkImageData()
+            geometry.SetExtent(extent)
+            info = lazy.GetOutputInformation(0)
+            geometry.SetSpacing(info.Get(vtk.vtkDataObject.SPACING()))
+            geometry.SetOrigin(info.Get(vtk.vtkDataObject.ORIGIN()))
+            self.volumeOutline.SetInputData(geometry)
+            self.axesLabels.SetInputData(geometry)
+        else:
+            self.GetOrthoPlanes().SetInputData(image.GetRealImage())
+            self.volumeOutline.SetInputData(image.GetRealImage())
+            self.axesLabels.SetInputData(image.GetRealImage())
 
         # reset labels
         dimensions = image.GetDimensionInformation()
@@ -769,12 +795,18 @@ class OrthoView(object):
 
         self.axesLabels.SetLabels(labels)
 
-        self.lineSegment.SetInput(image.GetRealImage())
+        if lazy is not None:
+            self.lineSegment.SetInput(geometry)
+        else:
+            self.lineSegment.SetInput(image.GetRealImage())
 
-        # VTK-6 - find a better way...
-        image.Update()
+        if lazy is not None:
+            self.imageScalarRange = lazy.GetSampledScalarRange()
+        else:
+            # VTK-6 - find a better way...
+            image.Update()
 
-        self.imageScalarRange = image.GetScalarRange()
+            self.imageScalarRange = image.GetScalarRange()
         # self.autoscale(image)
 
         self.GetOrthoPlanes().SetLookupTable(self.GetLookupTable())
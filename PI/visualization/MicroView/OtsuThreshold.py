@@ -0,0 +1,204 @@
+# =========================================================================
+#
+# Copyright (c) 2000-2008 GE Healthcare
+# Copyright (c) 2011-2015 Parallax Innovations Inc.
+#
+# Use, modification and redistribution of the software, in source or
+# binary forms, are permitted provided that the following terms and
+# conditions are met:
+#
+# 1) Redistribution of the source code, in verbatim or modified
+#   form, must retain the above copyright notice, this license,
+#   the following disclaimer, and any notices that refer to this
+#   license and/or the following disclaimer.
+#
+# 2) Redistribution in binary form must include the above copyright
+#    notice, a copy of this license and the following disclaimer
+#   in the documentation or with other materials provided with the
+#   distribution.
+#
+# 3) Modified copies of the source code must be clearly marked as such,
+#   and must not be misrepresented as verbatim copies of the source code.
+#
+# EXCEPT WHEN OTHERWISE STATED IN WRITING BY THE COPYRIGHT HOLDERS AND/OR
+# OTHER PARTIES, THE COPYRIGHT HOLDERS AND/OR OTHER PARTIES PROVIDE THE
+# SOFTWARE "AS IS" WITHOUT EXPRESSED OR IMPLIED WARRANTY INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE.  IN NO EVENT UNLESS AGREED TO IN WRITING WILL
+# ANY COPYRIGHT HOLDER OR OTHER PARTY WHO MAY MODIFY AND/OR REDISTRIBUTE
+# THE SOFTWARE UNDER THE TERMS OF THIS LICENSE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, LOSS OF DATA OR DATA BECOMING INACCURATE OR LOSS OF PROFIT OR
+# BUSINESS INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE OR INABILITY TO
+# USE THE SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+#
+# =========================================================================
+
+#
+# This file represents a derivative work by Parallax Innovations Inc.
+#
+
+"""
+Otsu threshold selection on a histogram.
+
+   1) otsu_threshold: single threshold, O(bins)
+   2) multi_otsu_thresholds: 2-4 classes, by dynamic programming
+   3) rebin_histogram: coarsen very wide histograms before thresholding
+
+Histograms are given as (x, y) pairs of uniformly spaced bin centres and
+bin counts, as returned by ROIStatistics.GetHistogram().  Thresholds are
+returned in data units and fall on the boundary between the last bin of one
+class and the first bin of the next, so they don't depend on which side of
+a bin the caller considers inclusive.
+"""
+
+import numpy
+
+# multi-level Otsu is O(classes * bins^2), so keep the histogram small
+MULTI_OTSU_MAX_BINS = 1024
+
+
+def _as_histogram(x, y):
+    """Convert a histogram to float arrays and check that x and y match."""
+
+    x = numpy.asarray(x, dtype='d')
+    y = numpy.asarray(y, dtype='d')
+
+    if x.shape != y.shape or x.ndim != 1:
+        raise ValueError("histogram x and y must be 1-D arrays of equal length")
+
+    return x, y
+
+
+def _bin_boundary(x, t):
+    """The value between bin t and bin t + 1."""
+
+    if t + 1 < len(x):
+        return 0.5 * (x[t] + x[t + 1])
+    return x[t]
+
+
+def rebin_histogram(x, y, max_bins):
+    """Merge adjacent bins until the histogram has at most max_bins bins.
+
+    The counts of merged bins are summed and the new bin centres are placed
+    in the middle of each group, so the histogram keeps its extent.
+    """
+
+    x, y = _as_histogram(x, y)
+    n = len(x)
+
+    if n <= max_bins or n < 2:
+        return x, y
+
+    factor = int(numpy.ceil(float(n) / max_bins))
+    m = int(numpy.ceil(float(n) / factor))
+    dx = x[1] - x[0]
+
+    padded = numpy.zeros(m * factor, dtype='d')
+    padded[:n] = y
+    y = padded.reshape(m, factor).sum(axis=1)
+    x = x[0] + (numpy.arange(m) * factor + 0.5 * (factor - 1)) * dx
+
+    return x, y
+
+
+def otsu_threshold(x, y):
+    """Return the Otsu threshold of a histogram, or None if it's empty.
+
+    The between-class variance is evaluated for every split at once using
+    cumulative sums, so the cost is linear in the number of bins.
+    """
+
+    x, y = _as_histogram(x, y)
+
+    occupied = numpy.nonzero(y > 0)[0]
+
+    if len(occupied) == 0:
+        return None
+
+    # a single populated bin can't be split
+    if len(occupied) == 1:
+        return x[occupied[0]]
+
+    p = y / y.sum()
+    w0 = numpy.cumsum(p)[:-1]
+    mu = numpy.cumsum(p * x)[:-1]
+    mt = numpy.dot(p, x)
+    w1 = 1.0 - w0
+
+    denom = w0 * w1
+    valid = denom > 1e-12
+    sB2 = numpy.zeros_like(w0)
+    sB2[valid] = (mt * w0[valid] - mu[valid]) ** 2 / denom[valid]
+
+    # pick the centre of the optimal plateau; this keeps binary images
+    # thresholded half-way between their two values
+    best = numpy.nonzero(sB2 >= sB2.max() * (1.0 - 1e-12))[0]
+    lo = _bin_boundary(x, best[0])
+    hi = _bin_boundary(x, best[-1])
+    if best[-1] - best[0] + 1 == len(best):
+        return 0.5 * (lo + hi)
+    return lo
+
+
+def multi_otsu_thresholds(x, y, classes=3, max_bins=MULTI_OTSU_MAX_BINS):
+    """Return the classes - 1 thresholds that split a histogram into classes
+    with the largest between-class variance.
+
+    Solved exactly by dynamic programming over the (possibly rebinned)
+    histogram.  Returns an empty list if the histogram is empty or has fewer
+    bins than classes.
+    """
+
+    if classes < 2 or classes > 4:
+        raise ValueError("multi-level Otsu supports 2 to 4 classes")
+
+    if classes == 2:
+        t = otsu_threshold(x, y)
+        return [] if t is None else [t]
+
+    x, y = rebin_histogram(x, y, max_bins)
+    n = len(x)
+    total = y.sum()
+
+    if total <= 0 or n < classes:
+        return []
+
+    p = y / total
+    W = numpy.concatenate(([0.0], numpy.cumsum(p)))
+    S = numpy.concatenate(([0.0], numpy.cumsum(p * x)))
+
+    def score(i, j):
+        # sum of squares of the class mean weighted by class size, for the
+        # class made of bins i..j-1
+        w = W[j] - W[i]
+        s = S[j] - S[i]
+        return numpy.where(w > 1e-12, s * s / numpy.maximum(w, 1e-12), 0.0)
+
+    # best[j]: best score for splitting bins 0..j-1 into k classes
+    best = score(0, numpy.arange(n + 1))
+    choices = []
+
+    for k in range(2, classes + 1):
+        new_best = numpy.empty(n + 1)
+        new_best.fill(-numpy.inf)
+        choice = numpy.zeros(n + 1, dtype=int)
+        for j in range(k, n + 1):
+            i = numpy.arange(k - 1, j)
+            v = best[i] + score(i, j)
+            m = v.argmax()
+            new_best[j] = v[m]
+            choice[j] = i[m]
+        best = new_best
+        choices.append(choice)
+
+    # walk back through the class boundaries
+    cuts = []
+    j = n
+    for choice in reversed(choices):
+        j = choice[j]
+        cuts.append(j)
+    cuts.reverse()
+
+    return [_bin_boundary(x, c - 1) for c in cuts]
@@ -42,13 +42,17 @@
 Computer statistics of volume of interest using vtkImageStatistics.
    1) mean and standard deviation
    2) histogram
-   3) threshold (Otsu method)
+   3) threshold (single or multi-level Otsu method, see OtsuThreshold)
+
+Results are cached per (image, stencil) and invalidated by their MTimes, so
+repeated requests for the same ROI don't trigger another pass over the image.
 
 Derived From:
    vtkMicroViewEventObject (a concrete implementation of vtkProcessObject)
 
 """
 
+import collections
 import math
 import numpy
 import vtk
@@ -56,6 +60,7 @@ from vtk.util.numpy_support import vtk_to_numpy
 from zope import component, event
 from PI.visualization.common.events import ProgressEvent
 from PI.visualization.MicroView import _MicroView
+from PI.visualization.MicroView import OtsuThreshold
 
 from PI.visualization.MicroView.interfaces import ICurrentImage
 
@@ -69,6 +74,10 @@ class ROIStatistics(object):
         self._voiExtent = None
         self._voiPolyData = None
 
+        # box stencil generated for extent-based ROIs
+        self._extentStencilKey = None
+        self._extentStencil = None
+
         # create a statistics object
         self._imageStats = _MicroView.vtkImageStatistics()
         self._imageStats.SetProgressText("Calculating image stats...")
@@ -82,14 +91,21 @@ class ROIStatistics(object):
         self._voxelCount = None
         self._histogram = None
         self._threshold = None
+        self._thresholds = []
         self._binSize = 1
 
+        # cached results, keyed on (image, stencil).  Each entry holds the
+        # statistics and, per bin size, the histogram and threshold
+        self._cache = collections.OrderedDict()
+        self._cacheSize = 8
+
     def SetImageTransform(self, transform):
         """Set optionally the transform to the image data."""
 
         # TODO: this code is broken...
 
         self._imageTransform = transform
+        self._cache.clear()
         reslice = vtk.vtkImageReslice()
         reslice.SetInterpolationModeToCubic()
         image = component.getUtility(ICurrentImage)
@@ -164,6 +180,12 @@ class ROIStatistics(object):
         self._OtsuThreshold()
         return self._threshold
 
+    def GetThresholds(self, classes=2):
+        """Multi-level Otsu thresholds of the ROI, a list of classes - 1
+        values.  Between 2 and 4 classes are supported."""
+        self._OtsuThreshold(classes)
+        return self._thresholds
+
     def HandleVTKProgressEvent(self, obj, evt):
         """Internal method, observer method to
         the progress event of self._imageStats.
@@ -171,47 +193,126 @@ class ROIStatistics(object):
         event.notify(ProgressEvent(
             obj.GetProgressText(), obj.GetProgress()))
 
+    def _GetCacheEntry(self):
+        """Internal method to find the cached results for the current image
+        and ROI.  Returns None if there is no ROI."""
+
+        stencil = self._GetStencilData()
+
+        if stencil is None:
+            return None
+
+        # VTK-6
+        if vtk.vtkVersion().GetVTKMajorVersion() < 6:
+            stencil.Update()
+
+        image = component.getUtility(ICurrentImage)
+
+        # VTK MTimes are global and never reused, so together with the MTime
+        # an object's id can't be confused with that of an older object
+        key = (id(image), image.GetMTime(), id(stencil), stencil.GetMTime())
+
+        if key in self._cache:
+            entry = self._cache.pop(key)
+        else:
+            entry = {'stats': None, 'histograms': {}, 'thresholds': {}}
+            while len(self._cache) >= self._cacheSize:
+                self._cache.popitem(last=False)
+
+        # most recently used entries live at the end
+        self._cache[key] = entry
+        return entry
+
+    def _CanFuseHistogram(self, image):
+        """Can vtkImageStatistics compute the histogram in the same pass as
+        the other statistics?"""
+        return image.GetNumberOfScalarComponents() == 1 and \
+            image.GetScalarType() not in (vtk.VTK_FLOAT, vtk.VTK_DOUBLE)
+
     def _StatsUpdate1(self):
         """Calculate mean and standard deviation of volume of interest.
         There are a few ways to define ROI: extent, stencil, and polydata.
         We deal them all here.
+
+        The histogram for the current bin size is computed in the same pass
+        and cached along with the other statistics.
         """
 
-        stencil = self._GetStencilData()
+        entry = self._GetCacheEntry()
 
-        if stencil is None:
+        if entry is None:
             return
 
-        image = component.getUtility(ICurrentImage)
+        if entry['stats'] is None:
 
-        # since we compute the histogram all the time, ensure that these
-        # values are set correctly all the time for multi-component images
-        minval, maxval = image.GetScalarRange()
-        numOfBins = math.floor((maxval - minval) / self._binSize + 0.5)
-        numOfBins = int(numOfBins) + 1
-        self._imageStats.SetInputConnection(image.GetOutputPort())
-        self._imageStats.SetComponentExtent(0, numOfBins, 0, 0, 0, 0)
-        self._imageStats.SetComponentOrigin(
-            minval - 0.5 * self._binSize, 0.0, 0.0)
-        self._imageStats.SetComponentSpacing(self._binSize, 0.0, 0.0)
-
-        # TODO: figure out why imagestats object isn't updating correctly
-        if image.GetMTime() > self._imageStats.GetMTime():
-            self._imageStats.Modified()
+            image = component.getUtility(ICurrentImage)
 
-        self._imageStats.Update()
+            # since we compute the histogram all the time, ensure that these
+            # values are set correctly all the time for multi-component images
+            minval, maxval = image.GetScalarRange()
+            numOfBins = math.floor((maxval - minval) / self._binSize + 0.5)
+            numOfBins = int(numOfBins) + 1
+            self._imageStats.SetInputConnection(image.GetOutputPort())
+            self._imageStats.SetComponentExtent(0, numOfBins, 0, 0, 0, 0)
+            self._imageStats.SetComponentOrigin(
+                minval - 0.5 * self._binSize, 0.0, 0.0)
+            self._imageStats.SetComponentSpacing(self._binSize, 0.0, 0.0)
 
-        self._meanValue = self._imageStats.GetMean()
-        self._minValue = self._imageStats.GetMin()
-        self._maxValue = self._imageStats.GetMax()
-        self._voxelCount = self._imageStats.GetVoxelCount()
-        self._stdDeviation = self._imageStats.GetStandardDeviation()
-        self._total = self._imageStats.GetTotal()
+            # our cache entry is known to be stale, so force an update
+            self._imageStats.Modified()
+            self._imageStats.Update()
+
+            entry['stats'] = {
+                'mean': self._imageStats.GetMean(),
+                'min': self._imageStats.GetMin(),
+                'max': self._imageStats.GetMax(),
+                'voxelCount': self._imageStats.GetVoxelCount(),
+                'stdDeviation': self._imageStats.GetStandardDeviation(),
+                'total': self._imageStats.GetTotal(),
+            }
+
+            if self._CanFuseHistogram(image):
+                arr = self._imageStats.GetOutput().GetPointData().GetScalars()
+                y = vtk_to_numpy(arr).copy()
+                x = minval + numpy.arange(len(y)) * self._binSize
+                entry['histograms'][self._binSize] = (x, y)
+
+        stats = entry['stats']
+        self._meanValue = stats['mean']
+        self._minValue = stats['min']
+        self._maxValue = stats['max']
+        self._voxelCount = stats['voxelCount']
+        self._stdDeviation = stats['stdDeviation']
+        self._total = stats['total']
 
     def _CalculateHistogram(self):
         """Calculate the histogram of gray scale values
         """
 
+        entry = self._GetCacheEntry()
+
+        if entry is None:
+            self._histogram = (numpy.array([]), numpy.array([]))
+            return
+
+        if self._binSize not in entry['histograms']:
+
+            image = component.getUtility(ICurrentImage)
+
+            if self._CanFuseHistogram(image):
+                # a fresh statistics pass fills in the histogram too
+                entry['stats'] = None
+                self._StatsUpdate1()
+            else:
+                entry['histograms'][self._binSize] = \
+                    self._CalculateAutomaticHistogram()
+
+        self._histogram = entry['histograms'][self._binSize]
+
+    def _CalculateAutomaticHistogram(self):
+        """Calculate a histogram using the image's own automatically binned
+        histogram statistics"""
+
         image = component.getUtility(ICurrentImage)
         stencil_data = self._GetStencilData()
         # stencil_data.Update()  # TODO: VTK-6 figure out what to do here
@@ -227,49 +328,35 @@ class ROIStatistics(object):
         arr = histo.GetHistogram()
 
         n = arr.GetNumberOfTuples()
-        x = numpy.linspace(origin, origin + (n - 1) + spacing, num=n)
-        y = vtk_to_numpy(arr)
+        x = origin + numpy.arange(n) * spacing
+        y = vtk_to_numpy(arr).copy()
 
-        self._histogram = (x, y)
+        return (x, y)
 
-    def _OtsuThreshold(self):
+    def _OtsuThreshold(self, classes=2):
         """otsu thresholding.
         """
 
-        self._CalculateHistogram()
-        xvals, yvals = self._histogram
+        entry = self._GetCacheEntry()
 
-        if len(xvals) == 0:
+        if entry is None:
+            self._thresholds = []
             self._threshold = None
             return
 
-        x0 = numpy.array(xvals, 'd')
-        h0 = numpy.array(yvals, 'd')
+        key = (self._binSize, classes)
 
-        # ------------ otsu thresholding  ------------------
-        h = h0 / numpy.sum(h0)
+        if key not in entry['thresholds']:
+            self._CalculateHistogram()
+            x, y = self._histogram
+            entry['thresholds'][key] = OtsuThreshold.multi_otsu_thresholds(
+                x, y, classes)
 
-        # hack for binary image
-        if numpy.size(numpy.where(h0 != 0)) == 2:
-            self._threshold = (xvals[0] + xvals[-1]) / 2.0
-            # print "binary: ", xvals[0], xvals[-1]
-            return
-
-        x = numpy.arange(numpy.product(numpy.shape(h)))
-        w0 = numpy.cumsum(h)
-        w1 = 1 - w0
-        eps = 1e-10
-        m0 = numpy.cumsum(x * h) / (w0 + eps)
-        mt = m0[-1]
-        m1 = (mt - m0[0:-1] * w0[0:-1]) / w1[0:-1]
-        sB2 = w0[0:-1] * w1[0:-1] * ((m0[0:-1] - m1) ** 2)
-        if len(sB2) > 0:
-            v = max(sB2)
-            t = numpy.nonzero(sB2 == v)[0]
-            self._threshold = x0[t[0]]
+        self._thresholds = list(entry['thresholds'][key])
+        if self._thresholds:
+            self._threshold = self._thresholds[0]
         else:
-            p = numpy.where(h0 > 0)[0][0]
-            self._threshold = x0[p]
+            self._threshold = None
 
     def _GetStencilData(self):
         """Internal method to get voi stencil from
@@ -287,17 +374,37 @@ class ROIStatistics(object):
         return self._ExtentToStencilData(extent)
 
     def _ExtentToStencilData(self, extent):
+        """Internal method to build a box stencil covering an extent.
 
-        image = component.getUtility(ICurrentImage).GetRealImage()
+        The stencil is generated natively by vtkROIStencilSource and cached
+        by (extent, origin, spacing), so that repeated statistics, histogram
+        and threshold requests on the same ROI share one stencil."""
 
-        stencil = vtk.vtkImageStencilData()
-        stencil.SetOrigin(image.GetOrigin())
-        stencil.SetSpacing(image.GetSpacing())
-        stencil.SetExtent(extent)
-        stencil.AllocateExtents()
-        x0, x1, y0, y1, z0, z1 = extent
-        for k in range(z0, z1 + 1):
-            for j in range(y0, y1 + 1):
-                stencil.InsertNextExtent(x0, x1, j, k)
-
-        return stencil
+        image = component.getUtility(ICurrentImage).GetRealImage()
+        origin = image.GetOrigin()
+        spacing = image.GetSpacing()
+
+        key = (tuple(extent), tuple(origin), tuple(spacing))
+        if key == self._extentStencilKey:
+            return self._extentStencil
+
+        # pad the box by a quarter voxel so voxel centres on its faces are
+        # unambiguously inside
+        bounds = []
+        for i in range(3):
+            b0 = origin[i] + (extent[i * 2] - 0.25) * spacing[i]
+            b1 = origin[i] + (extent[i * 2 + 1] + 0.25) * spacing[i]
+            bounds.extend([min(b0, b1), max(b0, b1)])
+
+        source = vtk.vtkROIStencilSource()
+        source.SetOutputOrigin(origin)
+        source.SetOutputSpacing(spacing)
+        source.SetOutputWholeExtent(extent)
+        source.SetShapeToBox()
+        source.SetBounds(bounds)
+        source.Update()
+
+        self._extentStencilKey = key
+        self._extentStencil = source.GetOutput()
+
+        return self._extentStencil
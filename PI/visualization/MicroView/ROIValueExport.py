@@ -0,0 +1,201 @@
+# =========================================================================
+#
+# Copyright (c) 2000-2008 GE Healthcare
+# Copyright (c) 2011-2015 Parallax Innovations Inc.
+#
+# Use, modification and redistribution of the software, in source or
+# binary forms, are permitted provided that the following terms and
+# conditions are met:
+#
+# 1) Redistribution of the source code, in verbatim or modified
+#   form, must retain the above copyright notice, this license,
+#   the following disclaimer, and any notices that refer to this
+#   license and/or the following disclaimer.
+#
+# 2) Redistribution in binary form must include the above copyright
+#    notice, a copy of this license and the following disclaimer
+#   in the documentation or with other materials provided with the
+#   distribution.
+#
+# 3) Modified copies of the source code must be clearly marked as such,
+#   and must not be misrepresented as verbatim copies of the source code.
+#
+# EXCEPT WHEN OTHERWISE STATED IN WRITING BY THE COPYRIGHT HOLDERS AND/OR
+# OTHER PARTIES, THE COPYRIGHT HOLDERS AND/OR OTHER PARTIES PROVIDE THE
+# SOFTWARE "AS IS" WITHOUT EXPRESSED OR IMPLIED WARRANTY INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE.  IN NO EVENT UNLESS AGREED TO IN WRITING WILL
+# ANY COPYRIGHT HOLDER OR OTHER PARTY WHO MAY MODIFY AND/OR REDISTRIBUTE
+# THE SOFTWARE UNDER THE TERMS OF THIS LICENSE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, LOSS OF DATA OR DATA BECOMING INACCURATE OR LOSS OF PROFIT OR
+# BUSINESS INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE OR INABILITY TO
+# USE THE SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+#
+# =========================================================================
+
+#
+# This file represents a derivative work by Parallax Innovations Inc.
+
+"""
+Export the image values inside a region of interest.
+
+Voxels are visited slab by slab in x, y, z order, using the runs of the ROI
+stencil directly, so nothing the size of the image is ever allocated.  Three
+output formats are supported, chosen by file extension:
+
+   1) .npy: a NumPy array, (voxels,) or (voxels, components)
+   2) .raw: the same values as bare binary, described by a .json sidecar
+   3) .csv: one line per voxel, "x,y,z,value", formatted in large blocks.
+      Floating point values are written with enough digits to be read back
+      exactly
+"""
+
+import json
+import os
+
+import numpy
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+from zope import event
+
+from PI.visualization.common.events import ProgressEvent
+
+# lines of CSV formatted at a time
+CSV_BLOCK_SIZE = 65536
+
+# significant digits that round-trip floating point values, by size in bytes
+_float_digits = {2: 5, 4: 9, 8: 17}
+
+
+def stencil_runs(stencil, extent, y, z):
+    """The [x0, x1] runs of the stencil on row (y, z), clipped to extent.
+
+    A stencil of None covers the whole row."""
+
+    if stencil is None:
+        return [(extent[0], extent[1])]
+
+    runs = []
+    r1 = vtk.mutable(0)
+    r2 = vtk.mutable(0)
+    it = vtk.mutable(0)
+    while stencil.GetNextExtent(r1, r2, extent[0], extent[1], y, z, it):
+        if r1 <= r2:
+            runs.append((int(r1), int(r2)))
+    return runs
+
+
+def _slab_runs(stencil, extent, z):
+    """The stencil runs of slice z, as an array of (y, x0, x1) rows"""
+
+    runs = [(y, r1, r2) for y in range(extent[2], extent[3] + 1)
+            for r1, r2 in stencil_runs(stencil, extent, y, z)]
+    return numpy.array(runs, dtype='i').reshape(-1, 3)
+
+
+def _expand_runs(runs):
+    """Index arrays (y, x) of the voxels covered by runs, in raster order"""
+
+    lengths = runs[:, 2] - runs[:, 1] + 1
+    ys = numpy.repeat(runs[:, 0], lengths)
+    # x restarts at each run's x0
+    starts = numpy.cumsum(lengths) - lengths
+    xs = numpy.arange(lengths.sum()) - numpy.repeat(starts - runs[:, 1], lengths)
+    return ys, xs
+
+
+def _format_csv(fmt, x, y, z, values):
+    """Format a block of voxels as CSV text"""
+
+    columns = numpy.column_stack((x, y, numpy.repeat(z, len(x)), values))
+    return ((fmt + '\n') * len(columns)) % tuple(columns.ravel().tolist())
+
+
+def export_roi_values(image, stencil, filename, title="Exporting image values..."):
+    """Write the values of the voxels of image inside stencil to filename.
+
+    image must be up to date.  Returns the number of voxels written."""
+
+    whole = image.GetExtent()
+    nc = image.GetNumberOfScalarComponents()
+    arr = vtk_to_numpy(image.GetPointData().GetScalars()).reshape(
+        whole[5] - whole[4] + 1, whole[3] - whole[2] + 1, whole[1] - whole[0] + 1, nc)
+
+    # only visit the part of the image the stencil covers
+    extent = list(whole)
+    if stencil is not None:
+        s = stencil.GetExtent()
+        for i in range(0, 6, 2):
+            extent[i] = max(whole[i], s[i])
+            extent[i + 1] = min(whole[i + 1], s[i + 1])
+
+    mode = os.path.splitext(filename)[1].lower()
+    if mode not in ('.npy', '.raw', '.csv'):
+        raise ValueError("Unsupported export format '%s'" % mode)
+
+    # find the runs first, so binary formats know how many voxels follow
+    runs = []
+    count = 0
+    for z in range(extent[4], extent[5] + 1):
+        slab_runs = _slab_runs(stencil, extent, z)
+        runs.append((z, slab_runs))
+        count += int((slab_runs[:, 2] - slab_runs[:, 1] + 1).sum())
+        event.notify(ProgressEvent(title, 0.1 * (z - extent[4] + 1) / (extent[5] - extent[4] + 1)))
+
+    def slabs():
+        for z, slab_runs in runs:
+            ys, xs = _expand_runs(slab_runs)
+            values = arr[z - whole[4], ys - whole[2], xs - whole[0]]
+            if nc == 1:
+                values = values[:, 0]
+            yield z, ys, xs, values
+
+    def progress(z):
+        event.notify(ProgressEvent(title, 0.1 + 0.9 * (z - extent[4] + 1) / (extent[5] - extent[4] + 1)))
+
+    shape = (count,) if nc == 1 else (count, nc)
+
+    with open(filename, 'wb') as _f:
+
+        if mode == '.npy':
+            numpy.lib.format.write_array_header_1_0(
+                _f, {'descr': numpy.lib.format.dtype_to_descr(arr.dtype),
+                     'fortran_order': False, 'shape': shape})
+
+        if mode in ('.npy', '.raw'):
+            for z, ys, xs, values in slabs():
+                values.tofile(_f)
+                progress(z)
+
+        else:
+            if arr.dtype.kind in 'iub':
+                value_fmt = '%d'
+            else:
+                value_fmt = '%.{0}g'.format(_float_digits.get(arr.dtype.itemsize, 17))
+            fmt = ','.join(['%d'] * 3 + [value_fmt] * nc)
+            _f.write('x,y,z,' + ','.join(['value'] if nc == 1 else ['value%d' % i for i in range(nc)]) + '\n')
+
+            written = 0
+            for z, ys, xs, values in slabs():
+                for i in range(0, len(xs), CSV_BLOCK_SIZE):
+                    s = slice(i, i + CSV_BLOCK_SIZE)
+                    _f.write(_format_csv(fmt, xs[s], ys[s], z, values[s]))
+                    written += len(xs[s])
+                    event.notify(ProgressEvent(title, 0.1 + 0.9 * float(written) / max(count, 1)))
+
+    if mode == '.raw':
+        sidecar = {
+            'dtype': numpy.lib.format.dtype_to_descr(arr.dtype),
+            'shape': shape,
+            'extent': whole,
+            'spacing': image.GetSpacing(),
+            'origin': image.GetOrigin(),
+            'order': 'x fastest, then y, then z; voxels inside the region only',
+        }
+        with open(filename + '.json', 'w') as _f:
+            json.dump(sidecar, _f, indent=2)
+
+    event.notify(ProgressEvent(title, 1.0))
+
+    return count
@@ -0,0 +1,448 @@
+# =========================================================================
+#
+# Copyright (c) 2000-2008 GE Healthcare
+# Copyright (c) 2011-2015 Parallax Innovations Inc.
+#
+# Use, modification and redistribution of the software, in source or
+# binary forms, are permitted provided that the following terms and
+# conditions are met:
+#
+# 1) Redistribution of the source code, in verbatim or modified
+#   form, must retain the above copyright notice, this license,
+#   the following disclaimer, and any notices that refer to this
+#   license and/or the following disclaimer.
+#
+# 2) Redistribution in binary form must include the above copyright
+#    notice, a copy of this license and the following disclaimer
+#   in the documentation or with other materials provided with the
+#   distribution.
+#
+# 3) Modified copies of the source code must be clearly marked as such,
+#   and must not be misrepresented as verbatim copies of the source code.
+#
+# EXCEPT WHEN OTHERWISE STATED IN WRITING BY THE COPYRIGHT HOLDERS AND/OR
+# OTHER PARTIES, THE COPYRIGHT HOLDERS AND/OR OTHER PARTIES PROVIDE THE
+# SOFTWARE "AS IS" WITHOUT EXPRESSED OR IMPLIED WARRANTY INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE.  IN NO EVENT UNLESS AGREED TO IN WRITING WILL
+# ANY COPYRIGHT HOLDER OR OTHER PARTY WHO MAY MODIFY AND/OR REDISTRIBUTE
+# THE SOFTWARE UNDER THE TERMS OF THIS LICENSE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, LOSS OF DATA OR DATA BECOMING INACCURATE OR LOSS OF PROFIT OR
+# BUSINESS INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE OR INABILITY TO
+# USE THE SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+#
+# =========================================================================
+
+#
+# This file represents a derivative work by Parallax Innovations Inc.
+
+"""
+Parallel decoding of 2D image stacks.
+
+The slices of a stack are decoded on a thread pool, each one straight into
+its plane of a single preallocated volume, which is then handed to VTK
+through a vtkImageImport without being copied again.  The slices are decoded
+by code that releases the interpreter lock while it works, so that they are
+really decoded side by side: PIL for TIFF, PNG, JPEG and BMP files
+(ImageStackLoader), and numpy for the pixel data of uncompressed DICOM files
+(DICOMStackLoader).
+
+Neither decoder is bound to agree with the VTK reader that would otherwise
+read the stack -- on row order, slice order or rescaling -- so a few slices
+are read with that reader first, and the stack is only decoded if they can
+be reproduced exactly.  Otherwise Load() raises ValueError, and the caller
+should fall back to the reader.
+"""
+
+import abc
+import multiprocessing
+import os
+import struct
+from multiprocessing.pool import ThreadPool
+
+import dicom
+import numpy
+import vtk
+from PIL import Image
+from vtk.util.numpy_support import vtk_to_numpy, get_vtk_array_type
+from zope import event
+
+from PI.visualization.common.events import ProgressEvent
+
+# slice readers, by file extension
+_slice_readers = {
+    '.tif': vtk.vtkTIFFReader,
+    '.tiff': vtk.vtkTIFFReader,
+    '.png': vtk.vtkPNGReader,
+    '.jpg': vtk.vtkJPEGReader,
+    '.jpeg': vtk.vtkJPEGReader,
+    '.bmp': vtk.vtkBMPReader,
+}
+
+# PIL image modes that map straight onto an array
+_image_modes = ('L', 'I;16', 'I;16B', 'I', 'F', 'RGB', 'RGBA')
+
+# uncompressed little endian transfer syntaxes, and whether their VRs are explicit
+_dicom_transfer_syntaxes = {
+    '1.2.840.10008.1.2': False,
+    '1.2.840.10008.1.2.1': True,
+}
+
+
+def _ImageToArray(image):
+    """The scalars of a single-slice vtkImageData, as a (y, x, components) array"""
+
+    x0, x1, y0, y1, z0, z1 = image.GetExtent()
+    scalars = vtk_to_numpy(image.GetPointData().GetScalars())
+    return scalars.reshape(z1 - z0 + 1, y1 - y0 + 1, x1 - x0 + 1,
+                           image.GetNumberOfScalarComponents())
+
+
+class ParallelStackLoader(object):
+
+    """Decode a stack of single-slice files into one volume, in parallel.
+
+    Subclasses decode the files, and read slices with the reference reader.
+    A decoded file can become a slice in more than one way -- flipped or
+    not, for instance -- so each candidate slice order and conversion is
+    checked against the reference, and the first one that reproduces it is
+    used for the whole stack."""
+
+    __metaclass__ = abc.ABCMeta
+
+    max_workers = multiprocessing.cpu_count()
+
+    def __init__(self, filenames, title="Reading slices..."):
+        self._filenames = list(filenames)
+        self._title = title
+
+    @abc.abstractmethod
+    def _DecodeFile(self, i):
+        """Decode file i, as a (y, x, components) array.  Runs on a worker thread."""
+
+    @abc.abstractmethod
+    def _ReadReferenceSlice(self, z):
+        """Read slice z with the reference reader, as a (y, x, components) array"""
+
+    @abc.abstractmethod
+    def _GetGeometry(self):
+        """Returns the volume's extent, spacing and origin"""
+
+    def _GetOrders(self):
+        """Yields candidate lists of the file to use for each slice"""
+        yield range(len(self._filenames))
+
+    def _GetConversions(self):
+        """Yields candidate functions that turn decoded file i into a slice"""
+        yield lambda arr, i: arr[::-1]
+        yield lambda arr, i: arr
+
+    @staticmethod
+    def _Matches(arr, reference):
+        if arr.shape != reference.shape:
+            return False
+        arr = arr.astype(reference.dtype)
+        if reference.dtype.kind == 'f':
+            return numpy.allclose(arr, reference, rtol=1e-5, atol=0.0)
+        return numpy.array_equal(arr, reference)
+
+    def Load(self):
+        """Decode all slices, returning a vtkImageImport that produces the volume.
+
+        Raises ValueError if the slices can't be decoded as the reference
+        reader would decode them, or don't all have the same size.
+        """
+
+        nz = len(self._filenames)
+        checked = sorted(set([0, nz // 2, nz - 1]))
+        references = dict((z, self._ReadReferenceSlice(z)) for z in checked)
+
+        decoded = {}
+        order = convert = None
+        for _order in self._GetOrders():
+            for _convert in self._GetConversions():
+                for z in checked:
+                    if _order[z] not in decoded:
+                        decoded[_order[z]] = self._DecodeFile(_order[z])
+                if all(self._Matches(_convert(decoded[_order[z]], _order[z]), references[z])
+                       for z in checked):
+                    order, convert = _order, _convert
+                    break
+            if order is not None:
+                break
+        if order is None:
+            raise ValueError("the decoded slices don't match those read by the reader")
+
+        first = references[checked[0]]
+        volume = numpy.empty((nz,) + first.shape, dtype=first.dtype)
+
+        def read(z):
+            i = order[z]
+            arr = decoded.pop(i, None)
+            if arr is None:
+                arr = self._DecodeFile(i)
+            arr = convert(arr, i)
+            if arr.shape != first.shape:
+                raise ValueError("'%s' doesn't match the size of '%s'" % (
+                    self._filenames[i], self._filenames[order[0]]))
+            volume[z] = arr
+
+        pool = ThreadPool(max(1, min(self.max_workers, nz)))
+        try:
+            for n, _ in enumerate(pool.imap_unordered(read, range(nz))):
+                event.notify(ProgressEvent(self._title, float(n + 1) / nz))
+        finally:
+            pool.terminate()
+
+        extent, spacing, origin = self._GetGeometry()
+
+        importer = vtk.vtkImageImport()
+        importer.SetImportVoidPointer(volume)
+        importer.SetDataScalarType(get_vtk_array_type(volume.dtype))
+        importer.SetNumberOfScalarComponents(first.shape[2])
+        importer.SetDataExtent(extent)
+        importer.SetWholeExtent(extent)
+        importer.SetDataSpacing(spacing)
+        importer.SetDataOrigin(origin)
+
+        # the importer doesn't own the memory, so keep the volume alive for
+        # as long as the importer is
+        importer._buffer = volume
+
+        return importer
+
+
+class ImageStackLoader(ParallelStackLoader):
+
+    """Decode a series of 2D image files (TIFF, PNG, JPEG or BMP) with PIL."""
+
+    def __init__(self, filenames, title="Reading slices...", spacing=(1.0, 1.0, 1.0)):
+        ParallelStackLoader.__init__(self, filenames, title)
+        self._spacing = tuple(spacing)
+        self._shape = None
+
+    @staticmethod
+    def CanLoad(filenames):
+        """True if every file exists and is of a type we can decode slice by slice."""
+        filenames = list(filenames)
+        if len(filenames) < 2:
+            return False
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() not in _slice_readers:
+                return False
+            if not os.path.exists(filename):
+                return False
+        return True
+
+    def _DecodeFile(self, i):
+
+        filename = self._filenames[i]
+        image = Image.open(filename)
+        if getattr(image, 'n_frames', 1) != 1:
+            raise ValueError("'%s' isn't a single slice" % filename)
+        if image.mode not in _image_modes:
+            raise ValueError("'%s' is a %s image" % (filename, image.mode))
+
+        # PIL decodes without holding the interpreter lock
+        image.load()
+        arr = numpy.asarray(image)
+        if arr.ndim == 2:
+            arr = arr[:, :, numpy.newaxis]
+
+        return arr
+
+    def _ReadReferenceSlice(self, z):
+
+        filename = self._filenames[z]
+        reader = _slice_readers[os.path.splitext(filename)[1].lower()]()
+        reader.SetFileName(filename)
+        reader.Update()
+
+        arr = _ImageToArray(reader.GetOutput())
+        if arr.shape[0] != 1:
+            raise ValueError("'%s' isn't a single slice" % filename)
+        self._shape = arr.shape[1:]
+
+        return numpy.array(arr[0])
+
+    def _GetGeometry(self):
+        ny, nx, nc = self._shape
+        return (0, nx - 1, 0, ny - 1, 0, len(self._filenames) - 1), self._spacing, (0.0, 0.0, 0.0)
+
+
+class DICOMStackLoader(ParallelStackLoader):
+
+    """Decode the pixel data of a series of uncompressed DICOM files with numpy.
+
+    The reference is the reader that has already been given the same files,
+    which also provides the volume's geometry.  Rescaling is applied, per
+    slice, if that is what the reader does."""
+
+    def __init__(self, filenames, headers, port, title="Reading slices..."):
+        ParallelStackLoader.__init__(self, filenames, title)
+        self._headers = list(headers)
+
+        # hold on to the producer itself, as LazyImageSource does
+        self._producer = port.GetProducer()
+        self._index = port.GetIndex()
+
+        first = self._headers[0]
+        self._rows = int(first.Rows)
+        self._columns = int(first.Columns)
+        self._dtype = numpy.dtype('<%s%d' % ('i' if first.PixelRepresentation else 'u',
+                                             first.BitsAllocated // 8))
+
+        self._rescale = []
+        for ds in self._headers:
+            try:
+                slope = float(ds.RescaleSlope)
+                intercept = float(ds.RescaleIntercept)
+            except (AttributeError, ValueError):
+                slope, intercept = 1.0, 0.0
+            self._rescale.append((slope, intercept))
+
+    @staticmethod
+    def CanLoad(headers):
+        """True if every header is from a single-frame, uncompressed greyscale
+        file, and they all have the same size and pixel type."""
+
+        headers = list(headers)
+        if len(headers) < 2:
+            return False
+
+        first = headers[0]
+        for ds in headers:
+            if ds is None:
+                return False
+            try:
+                syntax = ds.file_meta.TransferSyntaxUID
+            except AttributeError:
+                return False
+            if syntax not in _dicom_transfer_syntaxes:
+                return False
+            if ds.get('SamplesPerPixel', 1) != 1 or int(ds.get('NumberOfFrames', 1) or 1) != 1:
+                return False
+            if ds.get('BitsAllocated') not in (8, 16, 32):
+                return False
+            for tag in ('Rows', 'Columns', 'BitsAllocated', 'PixelRepresentation'):
+                if ds.get(tag) != first.get(tag):
+                    return False
+
+        return True
+
+    def _GetOrders(self):
+        """The files sorted along the slice normal, either way round"""
+
+        try:
+            orientation = [float(v) for v in self._headers[0].ImageOrientationPatient]
+            normal = numpy.cross(orientation[:3], orientation[3:])
+            positions = [numpy.dot([float(v) for v in ds.ImagePositionPatient], normal)
+                         for ds in self._headers]
+            order = sorted(range(len(self._headers)), key=positions.__getitem__)
+        except (AttributeError, ValueError, TypeError):
+            order = range(len(self._headers))
+
+        yield order
+        yield order[::-1]
+
+    def _GetConversions(self):
+        for flip in (True, False):
+            for rescale in (None, 'exact', 'round'):
+                yield self._MakeConversion(flip, rescale)
+
+    def _MakeConversion(self, flip, rescale):
+
+        def convert(arr, i):
+            if flip:
+                arr = arr[::-1]
+            if rescale is not None:
+                slope, intercept = self._rescale[i]
+                arr = arr * slope + intercept
+                if rescale == 'round':
+                    arr = numpy.rint(arr)
+            return arr
+
+        return convert
+
+    @staticmethod
+    def _IsPixelDataHeader(f, position, length, explicit):
+        if position < 0:
+            return False
+        f.seek(position)
+        if explicit:
+            header = f.read(12)
+            return len(header) == 12 and header[:4] == b'\xe0\x7f\x10\x00' and \
+                header[4:6] in (b'OW', b'OB') and struct.unpack('<I', header[8:])[0] == length
+        header = f.read(8)
+        return len(header) == 8 and header[:4] == b'\xe0\x7f\x10\x00' and \
+            struct.unpack('<I', header[4:])[0] == length
+
+    def _FindPixelData(self, f, explicit):
+        """Returns the offset of the pixel data in an open file"""
+
+        nbytes = self._rows * self._columns * self._dtype.itemsize
+        length = nbytes + (nbytes & 1)
+        header = 12 if explicit else 8
+
+        # the pixel data is nearly always the last element
+        f.seek(0, os.SEEK_END)
+        offset = f.tell() - length
+        if self._IsPixelDataHeader(f, offset - header, length, explicit):
+            return offset
+
+        # otherwise parse the header, which stops at the pixel data
+        f.seek(0)
+        dicom.read_file(f, stop_before_pixels=True, force=True)
+        offset = f.tell() + header
+        if self._IsPixelDataHeader(f, offset - header, length, explicit):
+            return offset
+
+        return None
+
+    def _DecodeFile(self, i):
+
+        filename = self._filenames[i]
+        explicit = _dicom_transfer_syntaxes[self._headers[i].file_meta.TransferSyntaxUID]
+        count = self._rows * self._columns
+
+        with open(filename, 'rb') as f:
+            offset = self._FindPixelData(f, explicit)
+            if offset is None:
+                raise ValueError("Unable to find the pixel data in '%s'" % filename)
+            f.seek(offset)
+            # numpy reads without holding the interpreter lock
+            arr = numpy.fromfile(f, dtype=self._dtype, count=count)
+
+        if arr.size != count:
+            raise ValueError("'%s' is truncated" % filename)
+
+        return arr.reshape(self._rows, self._columns, 1)
+
+    def _GetWholeExtent(self):
+        info = self._producer.GetOutputInformation(self._index)
+        return info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+
+    def _ReadReferenceSlice(self, z):
+
+        self._producer.UpdateInformation()
+        e = self._GetWholeExtent()
+        if (e[1] - e[0] + 1, e[3] - e[2] + 1, e[5] - e[4] + 1) != \
+                (self._columns, self._rows, len(self._filenames)):
+            raise ValueError("the reader's extent doesn't match the files")
+
+        self._producer.SetUpdateExtent(self._index, (e[0], e[1], e[2], e[3], e[4] + z, e[4] + z))
+        self._producer.Update()
+        image = self._producer.GetOutputDataObject(self._index)
+        z0 = image.GetExtent()[4]
+        arr = numpy.array(_ImageToArray(image)[e[4] + z - z0])
+
+        # don't leave the reader asking for a single slice
+        self._producer.SetUpdateExtent(self._index, e)
+
+        return arr
+
+    def _GetGeometry(self):
+        info = self._producer.GetOutputInformation(self._index)
+        return (self._GetWholeExtent(), info.Get(vtk.vtkDataObject.SPACING()),
+                info.Get(vtk.vtkDataObject.ORIGIN()))
@@ -204,7 +204,8 @@ class VTKPlotWindow(BasePlotWindow.BasePlotWindow):
         This routine posts an AutoThresholdCommandEvent command in order to request a new calculation of an
         optimal Otsu threshold.
         """
-        event.notify(AutoThresholdCommandEvent())
+        event.notify(AutoThresholdCommandEvent(
+            self.toolbar.GetThresholdClasses()))
 
     def SetInputConnection(self, algorithm):
 
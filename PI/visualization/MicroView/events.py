@@ -119,9 +119,16 @@ class OrthoCenterChangeEvent(BaseEvent):
 class AutoThresholdCommandEvent(BaseEvent):
 
     """
-    Command event: request an updated Otsu threshold for the current image
+    Command event: request an updated Otsu threshold for the current image.
+    More than two classes requests multi-level Otsu thresholds.
     """
 
+    def __init__(self, classes=2):
+        self._classes = classes
+
+    def GetNumberOfClasses(self):
+        return self._classes
+
 
 class BackgroundColourChangeEvent(BaseEvent):
 
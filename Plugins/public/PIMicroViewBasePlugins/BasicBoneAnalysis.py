@@ -48,6 +48,8 @@ a region of interest.
 
 import StringIO
 import datetime
+import math
+import struct
 import tempfile
 import os
 import logging
@@ -79,6 +81,7 @@ class BasicBoneAppState(object):
         self.UpperExclusion = '65535'
         self.bVerboseOutput = False
         self.bEnablePurify = False
+        self.bEnableStreaming = False
 
 
 class BasicBoneAnalysis(MicroViewPlugIn.MicroViewPlugIn):
@@ -94,6 +97,9 @@ class BasicBoneAnalysis(MicroViewPlugIn.MicroViewPlugIn):
     __managergroup__ = "Applications"
     __tabname__ = "Bone"
 
+    # number of voxels processed at a time in streaming mode
+    _slab_voxel_count = 16 * 1024 * 1024
+
     def __init__(self, parent):
 
         MicroViewPlugIn.MicroViewPlugIn.__init__(self, parent)
@@ -212,6 +218,7 @@ class BasicBoneAnalysis(MicroViewPlugIn.MicroViewPlugIn):
 
         state.bVerboseOutput = self.advanced_options_dlg.m_checkBoxEnableVerbose.GetValue()
         state.bEnablePurify = self.advanced_options_dlg.m_checkBoxEnablePurify.GetValue()
+        state.bEnableStreaming = self.advanced_options_dlg.m_checkBoxEnableStreaming.GetValue()
 
     def updateGUIState(self):
 
@@ -231,6 +238,8 @@ class BasicBoneAnalysis(MicroViewPlugIn.MicroViewPlugIn):
             state.bVerboseOutput)
         self.advanced_options_dlg.m_checkBoxEnablePurify.SetValue(
             state.bEnablePurify)
+        self.advanced_options_dlg.m_checkBoxEnableStreaming.SetValue(
+            state.bEnableStreaming)
 
     def onActivateROI(self, evt):
         """Activate a ROI plugin"""
@@ -382,6 +391,8 @@ class BasicBoneAnalysis(MicroViewPlugIn.MicroViewPlugIn):
                          {True: 'On', False: 'Off'}[state.bVerboseOutput])
             outstr.write("# Enable Purify: %s\n" %
                          {True: 'On', False: 'Off'}[state.bEnablePurify])
+            outstr.write("# Streaming Mode: %s\n" %
+                         {True: 'On', False: 'Off'}[state.bEnableStreaming])
             outstr.write('#############################################\n')
 
             self._HeaderOutStr = outstr.getvalue()
@@ -671,41 +682,10 @@ class BasicBoneAnalysis(MicroViewPlugIn.MicroViewPlugIn):
         origin = self._Origin
         spacing = self._Spacing
 
-        # --- generate a mask from stencil ----
-        self.__stencil_data.Update()
-        stencil_image = vtk.vtkImageStencilToImage()
-        stencil_image.SetInput(self.__stencil_data)
-        stencil_image.SetInsideValue(255)
-        stencil_image.SetOutsideValue(0)
-        stencil_image.SetOutputScalarTypeToUnsignedChar()
-        stencil_image.Update()
-
-        # --- image purify -----
-        event.notify(ProgressEvent("Stereology: Purify...", 0.2))
-
-        roi_image_reslice = self.GetROIImage()
-
-        # optionally create a purification filter
-        if state.bEnablePurify:
-            purify = _MicroView.vtkImagePurify()
-            purify.SetInputConnection(roi_image_reslice.GetOutputPort())
-            purify.SetThreshold(self._Threshold)
-            purify.UpdateInformation()
-
-        # --- Create an object to calculate stereology parameters
-        stereology = _MicroView.vtkImageStereology()
-        if state.bEnablePurify:
-            stereology.SetInputConnection(purify.GetOutputPort())
-            stereology.SetThreshold(1)
+        if state.bEnableStreaming:
+            stereology = self.StreamingStereology()
         else:
-            stereology.SetInputConnection(roi_image_reslice.GetOutputPort())
-            stereology.SetThreshold(self._Threshold)
-
-        stereology.SetImageMask(stencil_image.GetOutput())
-
-        event.notify(ProgressEvent("Stereology...", 0.4))
-
-        stereology.Update()
+            stereology = self.WholeVolumeStereology()
 
         event.notify(ProgressEvent("Stereology...", 0.8))
 
@@ -796,6 +776,171 @@ class BasicBoneAnalysis(MicroViewPlugIn.MicroViewPlugIn):
         # normal status
         return 0
 
+    def WholeVolumeStereology(self):
+        """Compute stereology over the whole ROI in a single pass"""
+
+        state = self._app_states[self._current_image_index]
+
+        # --- generate a mask from stencil ----
+        self.__stencil_data.Update()
+        stencil_image = vtk.vtkImageStencilToImage()
+        stencil_image.SetInput(self.__stencil_data)
+        stencil_image.SetInsideValue(255)
+        stencil_image.SetOutsideValue(0)
+        stencil_image.SetOutputScalarTypeToUnsignedChar()
+        stencil_image.Update()
+
+        # --- image purify -----
+        event.notify(ProgressEvent("Stereology: Purify...", 0.2))
+
+        roi_image_reslice = self.GetROIImage()
+
+        # optionally create a purification filter
+        if state.bEnablePurify:
+            purify = _MicroView.vtkImagePurify()
+            purify.SetInputConnection(roi_image_reslice.GetOutputPort())
+            purify.SetThreshold(self._Threshold)
+            purify.UpdateInformation()
+
+        # --- Create an object to calculate stereology parameters
+        stereology = _MicroView.vtkImageStereology()
+        if state.bEnablePurify:
+            stereology.SetInputConnection(purify.GetOutputPort())
+            stereology.SetThreshold(1)
+        else:
+            stereology.SetInputConnection(roi_image_reslice.GetOutputPort())
+            stereology.SetThreshold(self._Threshold)
+
+        stereology.SetImageMask(stencil_image.GetOutput())
+
+        event.notify(ProgressEvent("Stereology...", 0.4))
+
+        stereology.Update()
+
+        return stereology
+
+    def GetSlabExtents(self, extent):
+        """Split the interior of an extent into z-slabs for streaming.
+
+        Each slab extent includes one slice of overlap on either side, since
+        stereology uses the outermost layer of its input only as neighbours"""
+
+        x0, x1, y0, y1, z0, z1 = extent
+        slice_size = max((x1 - x0 + 1) * (y1 - y0 + 1), 1)
+        slab_depth = max(self._slab_voxel_count / slice_size, 1)
+
+        slabs = []
+        for z in range(z0 + 1, z1, slab_depth):
+            slabs.append((x0, x1, y0, y1, z - 1, min(z + slab_depth, z1)))
+
+        return slabs
+
+    def GetStreamedPurifiedImage(self, masked_image):
+        """Purify the ROI for streaming stereology.
+
+        Purify has to see the whole ROI at once, so the stencilled image is
+        first thresholded into an 8-bit binary volume, one slab at a time"""
+
+        image = component.getUtility(ICurrentImage)
+
+        # match the comparison vtkImagePurify would have made against the
+        # original image: its threshold is single precision, and
+        # vtkImageThreshold truncates thresholds for integer images
+        threshold = struct.unpack('f', struct.pack('f', self._Threshold))[0]
+        if image.GetScalarType() not in (vtk.VTK_FLOAT, vtk.VTK_DOUBLE):
+            threshold = math.ceil(threshold)
+
+        binary = vtk.vtkImageThreshold()
+        binary.SetInputConnection(masked_image.GetOutputPort())
+        binary.ThresholdByUpper(threshold)
+        binary.SetInValue(1)
+        binary.SetOutValue(0)
+        binary.SetOutputScalarTypeToUnsignedChar()
+
+        extent = self.__stencil_data.GetExtent()
+        clip = vtk.vtkImageClip()
+        clip.SetInputConnection(binary.GetOutputPort())
+        clip.SetOutputWholeExtent(extent)
+        clip.ClipDataOn()
+
+        streamer = vtk.vtkImageDataStreamer()
+        streamer.SetInputConnection(clip.GetOutputPort())
+        streamer.SetNumberOfStreamDivisions(len(self.GetSlabExtents(extent)))
+
+        purify = _MicroView.vtkImagePurify()
+        purify.SetInputConnection(streamer.GetOutputPort())
+        purify.SetThreshold(1)
+        purify.Update()
+
+        return purify
+
+    def StreamingStereology(self):
+        """Compute stereology one z-slab at a time.
+
+        The stencil is applied directly to the image, slab by slab, rather
+        than resampling the whole ROI into a new image.  Each slab's counts
+        are added up by vtkImageStereology, so the results are identical to
+        those of a single pass over the whole ROI"""
+
+        state = self._app_states[self._current_image_index]
+        image = component.getUtility(ICurrentImage)
+        minV, maxV = image.GetScalarRange()
+
+        self.__stencil_data.Update()
+        extent = self.__stencil_data.GetExtent()
+
+        masked_image = vtk.vtkImageStencil()
+        masked_image.SetInputConnection(image.GetOutputPort())
+        masked_image.SetBackgroundValue(minV)
+
+        stencil_image = vtk.vtkImageStencilToImage()
+        stencil_image.SetInsideValue(255)
+        stencil_image.SetOutsideValue(0)
+        stencil_image.SetOutputScalarTypeToUnsignedChar()
+
+        # VTK-6
+        if vtk.vtkVersion().GetVTKMajorVersion() > 5:
+            masked_image.SetStencilData(self.__stencil_data)
+            stencil_image.SetInputData(self.__stencil_data)
+        else:
+            masked_image.SetStencil(self.__stencil_data)
+            stencil_image.SetInput(self.__stencil_data)
+
+        # optionally purify the image
+        if state.bEnablePurify:
+            event.notify(ProgressEvent("Stereology: Purify...", 0.2))
+            source = self.GetStreamedPurifiedImage(masked_image)
+            threshold = 1
+        else:
+            source = masked_image
+            threshold = self._Threshold
+
+        image_clip = vtk.vtkImageClip()
+        image_clip.SetInputConnection(source.GetOutputPort())
+        image_clip.ClipDataOn()
+
+        mask_clip = vtk.vtkImageClip()
+        mask_clip.SetInputConnection(stencil_image.GetOutputPort())
+        mask_clip.ClipDataOn()
+
+        stereology = _MicroView.vtkImageStereology()
+        stereology.SetInputConnection(image_clip.GetOutputPort())
+        stereology.SetThreshold(threshold)
+        stereology.SetImageMask(mask_clip.GetOutput())
+        stereology.AccumulateOn()
+        stereology.ResetAccumulation()
+
+        slabs = self.GetSlabExtents(extent)
+        for i, slab in enumerate(slabs):
+            event.notify(ProgressEvent("Stereology: slab {0} of {1}...".format(
+                i + 1, len(slabs)), 0.4 + 0.4 * i / len(slabs)))
+            image_clip.SetOutputWholeExtent(slab)
+            mask_clip.SetOutputWholeExtent(slab)
+            mask_clip.Update()
+            stereology.Update()
+
+        return stereology
+
     def SaveResults(self):
         logger = logging.getLogger('results')
 
@@ -93,6 +93,10 @@ class BasicBoneAnalysisAdvancedOptionsDialog (wx.Dialog):
             self.m_panel24, wx.ID_ANY, u"Enable purify algorithm", wx.DefaultPosition, wx.DefaultSize, 0)
         bSizer93.Add(self.m_checkBoxEnablePurify, 0, wx.ALL, 5)
 
+        self.m_checkBoxEnableStreaming = wx.CheckBox(
+            self.m_panel24, wx.ID_ANY, u"Low memory (streaming) mode", wx.DefaultPosition, wx.DefaultSize, 0)
+        bSizer93.Add(self.m_checkBoxEnableStreaming, 0, wx.ALL, 5)
+
         self.m_panel24.SetSizer(bSizer93)
         self.m_panel24.Layout()
         bSizer93.Fit(self.m_panel24)
@@ -69,6 +69,7 @@ import vtkAtamai.SurfaceObjectFactory
 from vtkEVS import EVSFileDialog
 
 from PI.visualization.vtkMultiIO import vtkLoadWriters
+from PI.visualization.common import MicroViewSettings
 from PI.visualization.common.events import ProgressEvent
 from PI.visualization.MicroView import MicroViewPlugIn
 
@@ -78,6 +79,7 @@ from PI.visualization.MicroView.events import ROIEnabledEvent, CurrentImageChang
     ROIModelModifiedEvent, CurrentImageClosingEvent
 
 import IsosurfaceGUIC
+import IsoSurfaceEngine
 
 
 class IsoSurfaceDisplayState(object):
@@ -116,6 +118,16 @@ class IsoSurfaceDisplay(MicroViewPlugIn.MicroViewPlugIn):
     __managergroup__ = None
     __tabname__ = "Isosurface"
 
+    # resample factor of the quick preview shown while the surface is refined
+    preview_resample_factor = 0.25
+
+    # smaller blocks are used while refining, so that the refinement can be
+    # abandoned quickly when the parameters change
+    refine_block_voxel_count = 128 * 128 * 128
+
+    # milliseconds between checks on the refinement
+    refine_poll_interval = 50
+
     def __init__(self, parent):
 
         MicroViewPlugIn.MicroViewPlugIn.__init__(self, parent)
@@ -136,6 +148,12 @@ class IsoSurfaceDisplay(MicroViewPlugIn.MicroViewPlugIn):
 
         self._transform = None
 
+        # finished surfaces, the surface being refined, and a counter used
+        # to cancel refinement
+        self._surface_cache = IsoSurfaceEngine.SurfaceCache()
+        self._refine_engine = None
+        self._refine_generation = 0
+
         # create remaining gui
         self.CreateGUI()
 
@@ -320,13 +338,13 @@ class IsoSurfaceDisplay(MicroViewPlugIn.MicroViewPlugIn):
         # remove any old surface - frees a lot of memory!
         if not self._app_states[self._current_image_index]._disconnected:
             self.HideGeometry()
-        self._BuildPipeline()
+        complete = self._BuildPipeline()
         self.Render()
 
-        # update GUI
+        # update GUI - saving waits until the surface has been refined
         self.gui.m_buttonUpdate.Enable(False)
         self.gui.m_buttonClear.Enable(True)
-        self.gui.m_buttonSaveSurface.Enable(True)
+        self.gui.m_buttonSaveSurface.Enable(complete)
 
     def GetArea(self):
         """GetArea - returns the surface area of the current polygon"""
@@ -362,7 +380,7 @@ class IsoSurfaceDisplay(MicroViewPlugIn.MicroViewPlugIn):
 
         connection = self._app_states[
             self._current_image_index].GetFactory().GetInputConnection()
-        object = connection.GetProducer().GetOutput()
+        object = connection.GetProducer().GetOutputDataObject(connection.GetIndex())
 
         # determine number of connected components
         _f = vtk.vtkPolyDataConnectivityFilter()
@@ -411,6 +429,9 @@ class IsoSurfaceDisplay(MicroViewPlugIn.MicroViewPlugIn):
 
         self._app_states[self._current_image_index]._disconnected = True
 
+        # cancel any refinement still in progress
+        self._CancelRefinement()
+
         try:
             self.GetMicroView().pane3D.DisconnectActorFactory(
                 self._app_states[self._current_image_index].GetFactory())
@@ -427,28 +448,24 @@ class IsoSurfaceDisplay(MicroViewPlugIn.MicroViewPlugIn):
         self.gui.m_staticTextRegionCount.SetLabel('')
 
     def _BuildPipeline(self):
-        """_BuildPipeline - Builds the visualization pipeline"""
+        """_BuildPipeline - Builds the visualization pipeline
+
+        A surface that was generated before with the same parameters is
+        taken from the cache.  Otherwise a coarse preview is generated first,
+        and the full resolution surface is refined in between GUI events."""
 
         image = component.getUtility(ICurrentImage)
 
         # update image (VTK-6 compatible)
         image.Update()
 
-        # image reslice object
-        reslice = vtk.vtkImageReslice()
-        reslice.SetInterpolationModeToCubic()
-        reslice.ReleaseDataFlagOn()
-        reslice.SetInputConnection(image.GetOutputPort())
-        if self._transform:
-            reslice.SetTransform(self._transform)
-
-        # get extents, spacings, etc
-        in_extent = image.GetExtent()
-        in_spacing = image.GetSpacing()
-        in_origin = image.GetOrigin()
+        # cancel any refinement still in progress
+        self._CancelRefinement()
 
         # get stencil data
         stencil_data = image.GetStencilData()
+        if not self.gui.m_checkBoxClipping.GetValue():
+            stencil_data = None
 
         # Set image resample factor
         f = self.gui.m_sliderSurfaceQuality.GetValue() / 100.0
@@ -458,103 +475,192 @@ class IsoSurfaceDisplay(MicroViewPlugIn.MicroViewPlugIn):
         # Set surface decimation factor
         decf = self.gui.m_sliderDecimationFactor.GetValue() / 100.0
 
+        threshold = float(self.gui.m_textCtrlImageThreshold.GetValue())
+        smoothing = bool(self.gui.m_checkBoxImageSmoothing.GetValue())
+
+        self.UpdateSurfaceCacheBudget()
+
+        key = self._GetSurfaceKey(image, stencil_data, threshold, smoothing, f, decf)
+        surface = self._surface_cache.Get(key)
+        if surface is not None:
+            self._ShowSurface(surface)
+            self.UpdateMathValues()
+            return True
+
+        engine = self._CreateSurfaceEngine(
+            image, stencil_data, threshold, smoothing, f, decf)
+
+        if f <= self.preview_resample_factor:
+            # already coarse enough to generate in one go
+            with wx.BusyCursor():
+                event.notify(ProgressEvent("Generating surface...", 0.0))
+                engine.Update()
+            surface = self._SurfaceFromEngine(engine)
+            self._surface_cache.Put(key, surface)
+            self._ShowSurface(surface)
+            self.UpdateMathValues()
+            return True
+
+        preview_key = self._GetSurfaceKey(
+            image, stencil_data, threshold, smoothing, self.preview_resample_factor, decf)
+        preview = self._surface_cache.Get(preview_key)
+        if preview is None:
+            preview_engine = self._CreateSurfaceEngine(
+                image, stencil_data, threshold, smoothing, self.preview_resample_factor, decf,
+                title="Generating preview surface...")
+            with wx.BusyCursor():
+                event.notify(ProgressEvent("Generating preview surface...", 0.0))
+                preview_engine.Update()
+            preview = self._SurfaceFromEngine(preview_engine)
+            self._surface_cache.Put(preview_key, preview)
+        self._ShowSurface(preview)
+
+        # refine in the background
+        engine.block_voxel_count = self.refine_block_voxel_count
+        engine.Start()
+        self._refine_engine = engine
+        wx.CallLater(self.refine_poll_interval, self._RefineSurface, engine, key,
+                     self._current_image_index, self._refine_generation)
+
+        return False
+
+    def _CancelRefinement(self):
+        """Stop refining the surface, so that the engine's workers don't
+        compete with whatever replaces it"""
+
+        self._refine_generation += 1
+        if self._refine_engine is not None:
+            self._refine_engine.Abort()
+            self._refine_engine = None
+
+    def _RefineSurface(self, engine, key, image_index, generation):
+        """Check on the full resolution surface, rescheduling until it is done.
+        The blocks are contoured on the engine's own threads, so this never
+        waits for them."""
+
+        # superseded, or the image changed under us
+        if generation != self._refine_generation or image_index != self._current_image_index:
+            engine.Abort()
+            return
+
+        try:
+            done = engine.Step()
+        except:
+            logging.exception("IsoSurfaceDisplay")
+            self._CancelRefinement()
+            return
+
+        if not done:
+            wx.CallLater(self.refine_poll_interval, self._RefineSurface,
+                         engine, key, image_index, generation)
+            return
+
+        self._refine_engine = None
+
+        surface = self._SurfaceFromEngine(engine)
+        self._surface_cache.Put(key, surface)
+        self._ShowSurface(surface)
+        self.UpdateMathValues()
+        self.Render()
+
+        self.gui.m_buttonSaveSurface.Enable(True)
+
+    def UpdateSurfaceCacheBudget(self):
+
+        config = MicroViewSettings.MicroViewSettings.getObject()
+        try:
+            budget = int(config.IsoSurfaceCacheMemoryBudget) * 1024 * 1024
+        except:
+            # in megabytes
+            config.IsoSurfaceCacheMemoryBudget = IsoSurfaceEngine.DEFAULT_MEMORY_BUDGET / (1024 * 1024)
+            budget = IsoSurfaceEngine.DEFAULT_MEMORY_BUDGET
+        self._surface_cache.SetMemoryBudget(budget)
+
+    def _GetSurfaceKey(self, image, stencil_data, threshold, smoothing, f, decf):
+        """The parameters that determine a surface, as a cache key"""
+
+        roi = None
+        if stencil_data:
+            roi = (stencil_data.GetMTime(), tuple(stencil_data.GetExtent()))
+
+        transform = None
+        if self._transform:
+            transform = self._transform.GetMTime()
+
+        return (self._current_image_index, image.GetRealImage().GetMTime(), transform,
+                roi, threshold, smoothing, f, decf)
+
+    def _CreateSurfaceEngine(self, image, stencil_data, threshold, smoothing, f, decf,
+                             title="Generating surface..."):
+        """Set up the chunked surface engine, which reslices, resamples and
+        smooths the image a block at a time as it contours it"""
+
+        engine = IsoSurfaceEngine.ChunkedSurfaceEngine(title)
+        engine.SetInputData(image.GetRealImage())
+        if self._transform:
+            engine.SetTransform(self._transform)
+
+        # get extents, spacings, etc
+        in_extent = image.GetExtent()
+        in_spacing = image.GetSpacing()
+        in_origin = image.GetOrigin()
+
         # Enable/Disable stencil usage
-        if self.gui.m_checkBoxClipping.GetValue() is True and stencil_data:
-            if vtk.vtkVersion().GetVTKMajorVersion() > 5:
-                reslice.SetStencilData(stencil_data)
-            else:
-                reslice.SetStencil(stencil_data)
-            reslice.SetBackgroundLevel(image.GetScalarRange()[0])
+        if stencil_data:
+            engine.SetStencilData(stencil_data, image.GetScalarRange()[0])
             ext = stencil_data.GetExtent()
         else:
             ext = in_extent
-            if vtk.vtkVersion().GetVTKMajorVersion() > 5:
-                reslice.SetStencilData(None)
-            else:
-                reslice.SetStencil(None)
 
         # expand extent slightly - account for downsampling later too
         fudge = int(math.ceil(1.0 / f))
         ext = [ext[0] - fudge, ext[1] + fudge, ext[
             2] - fudge, ext[3] + fudge, ext[4] - fudge, ext[5] + fudge]
 
-        reslice.SetOutputExtent(ext)
+        engine.SetOutputExtent(ext)
 
         # set default origin/spacing -- these two lines work...
-        reslice.SetOutputSpacing(in_spacing)
-        reslice.SetOutputOrigin(in_origin)
-
-        # do we need to downsample the image?
-        if (f < 1.0):
-            resample = vtk.vtkImageResample()
-            resample.SetInputConnection(reslice.GetOutputPort())
-            resample.ReleaseDataFlagOn()
-            for i in range(3):
-                resample.SetAxisMagnificationFactor(i, f)
-            obj = resample
-        else:
-            obj = reslice
-
-        # do we need to smooth the image?
-        if (self.gui.m_checkBoxImageSmoothing.GetValue() == True):
-            smooth = vtk.vtkImageGaussianSmooth()
-            smooth.SetStandardDeviation(1.0)
-            smooth.ReleaseDataFlagOn()
-            smooth.SetInputConnection(obj.GetOutputPort())
-            obj = smooth
-
-        clip = vtk.vtkImageClip()
-        clip.SetInputConnection(obj.GetOutputPort())
-
-        # setup contour filter
-        cf = vtk.vtkMarchingCubes()
-        cf.SetNumberOfContours(1)
-        val = float(self.gui.m_textCtrlImageThreshold.GetValue())
-        cf.SetValue(0, val)
-        cf.SetComputeScalars(0)
-        cf.SetComputeNormals(0)
-        cf.SetInputConnection(clip.GetOutputPort())
-
-        # decimate surface
-        decimate = vtk.vtkDecimatePro()
-        decimate.SetInputConnection(cf.GetOutputPort())
-        decimate.PreserveTopologyOn()
-        decimate.SetTargetReduction(decf)
-
-        # To cut down on memory consumption, we use the clip object
-        # to process the image a chunk at a time.  By default we
-        # use 20 chunks -- but if the chunks are too small, we'll adjust this
-        # number
-
-        clip.UpdateInformation()
-        ext = clip.GetInput().GetExtent()
-
-        # main processing loop
-        with wx.BusyCursor():
-            event.notify(ProgressEvent("Generating surface...", 0.0))
-            clip.SetOutputWholeExtent(ext[0], ext[
-                                      1], ext[2], ext[3], ext[4], ext[5])
-            decimate.Update()
-            event.notify(ProgressEvent("Generating surface...", 1.0))
+        engine.SetOutputSpacing(in_spacing)
+        engine.SetOutputOrigin(in_origin)
+
+        # downsample the image if f < 1.0, and smooth it if asked to
+        engine.SetResampleFactor(f)
+        engine.SetSmoothing(smoothing)
+
+        engine.SetValue(threshold)
+        engine.SetTargetReduction(decf)
+
+        return engine
+
+    @staticmethod
+    def _SurfaceFromEngine(engine):
+        """Detach the finished surface from the engine, so the engine and its
+        blocks can be freed"""
+
+        surface = vtk.vtkPolyData()
+        surface.ShallowCopy(engine.GetOutput())
+
+        return surface
+
+    def _ShowSurface(self, surface):
+        """Display a surface in the 3D view"""
+
+        state = self._app_states[self._current_image_index]
+
+        producer = vtk.vtkTrivialProducer()
+        producer.SetOutput(surface)
 
         # Create the rendered Geometry
-        if not self._app_states[self._current_image_index].GetFactory():
-            self._app_states[
-                self._current_image_index].SetFactory(vtkAtamai.SurfaceObjectFactory.SurfaceObjectFactory())
-            self._app_states[self._current_image_index].GetFactory().SetInputConnection(
-                decimate.GetOutputPort())
-            self._app_states[self._current_image_index].GetFactory().SetBackfaceProperty(
-                self._app_states[self._current_image_index].GetFactory().GetProperty())
-            self._app_states[
-                self._current_image_index].GetFactory().NormalGenerationOn()
+        if not state.GetFactory():
+            state.SetFactory(vtkAtamai.SurfaceObjectFactory.SurfaceObjectFactory())
+            state.GetFactory().SetBackfaceProperty(state.GetFactory().GetProperty())
+            state.GetFactory().NormalGenerationOn()
+        state.GetFactory().SetInputConnection(producer.GetOutputPort())
         self.SetSurfaceColor()
 
-        self.GetMicroView().pane3D.ConnectActorFactory(
-            self._app_states[self._current_image_index].GetFactory())
-        self._app_states[self._current_image_index]._disconnected = False
-
-        # Update math values
-        self.UpdateMathValues()
+        if state._disconnected:
+            self.GetMicroView().pane3D.ConnectActorFactory(state.GetFactory())
+            state._disconnected = False
 
     def CreateGUI(self):
 
@@ -584,6 +690,9 @@ class IsoSurfaceDisplay(MicroViewPlugIn.MicroViewPlugIn):
 
     def OnPluginClose(self):
 
+        # cancel any refinement still in progress
+        self._CancelRefinement()
+
         for num in self._app_states:
 
             factory = self._app_states[num].GetFactory()
@@ -0,0 +1,271 @@
+# =========================================================================
+#
+# Copyright (c) 2000-2008 GE Healthcare
+# Copyright (c) 2011-2015 Parallax Innovations Inc.
+#
+# Use, modification and redistribution of the software, in source or
+# binary forms, are permitted provided that the following terms and
+# conditions are met:
+#
+# 1) Redistribution of the source code, in verbatim or modified
+#   form, must retain the above copyright notice, this license,
+#   the following disclaimer, and any notices that refer to this
+#   license and/or the following disclaimer.
+#
+# 2) Redistribution in binary form must include the above copyright
+#    notice, a copy of this license and the following disclaimer
+#   in the documentation or with other materials provided with the
+#   distribution.
+#
+# 3) Modified copies of the source code must be clearly marked as such,
+#   and must not be misrepresented as verbatim copies of the source code.
+#
+# EXCEPT WHEN OTHERWISE STATED IN WRITING BY THE COPYRIGHT HOLDERS AND/OR
+# OTHER PARTIES, THE COPYRIGHT HOLDERS AND/OR OTHER PARTIES PROVIDE THE
+# SOFTWARE "AS IS" WITHOUT EXPRESSED OR IMPLIED WARRANTY INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE.  IN NO EVENT UNLESS AGREED TO IN WRITING WILL
+# ANY COPYRIGHT HOLDER OR OTHER PARTY WHO MAY MODIFY AND/OR REDISTRIBUTE
+# THE SOFTWARE UNDER THE TERMS OF THIS LICENSE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, LOSS OF DATA OR DATA BECOMING INACCURATE OR LOSS OF PROFIT OR
+# BUSINESS INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE OR INABILITY TO
+# USE THE SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+#
+# =========================================================================
+
+#
+# This file represents a derivative work by Parallax Innovations Inc.
+
+"""
+Chunked, multi-core isosurface extraction.
+
+ChunkedSurfaceEngine splits the image into blocks that share one plane of
+voxels with their neighbours, so that every marching cubes cell belongs to
+exactly one block.  The blocks are resliced, resampled, smoothed, contoured
+and decimated on native worker threads by vtkImageChunkedSurfaceGenerator,
+which doesn't hold the Python interpreter lock, so the work is spread over
+all of the processors and the GUI thread stays free.  The decimation leaves
+the open boundary of each block's surface alone, so the vertices on a shared
+plane are identical on both sides and the blocks can be stitched back
+together by merging coincident points.  The engine can be polled a step at
+a time, so that a caller can interleave it with GUI events.
+
+SurfaceCache keeps finished surfaces, so that going back to a set of
+parameters that was used before doesn't regenerate the surface.
+"""
+
+import collections
+import math
+import multiprocessing
+import time
+
+from zope import event
+
+from PI.visualization.common.events import ProgressEvent
+from PI.visualization.MicroView import _MicroView
+
+
+# in bytes
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+
+
+class SurfaceCache(object):
+
+    """A least-recently-used cache of surfaces, bounded by total size in bytes."""
+
+    def __init__(self, budget=DEFAULT_MEMORY_BUDGET):
+        self._surfaces = collections.OrderedDict()
+        self._budget = budget
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    def GetMemoryBudget(self):
+        return self._budget
+
+    def SetMemoryBudget(self, budget):
+        self._budget = budget
+        self._Evict()
+
+    def GetMemoryUsage(self):
+        return self._nbytes
+
+    def Get(self, key):
+        """Return the cached surface, or None, marking it as most recently used."""
+        surface = self._surfaces.pop(key, None)
+        if surface is not None:
+            self._surfaces[key] = surface
+        return surface
+
+    def Put(self, key, surface):
+        old = self._surfaces.pop(key, None)
+        if old is not None:
+            self._nbytes -= self._SizeOf(old)
+        self._surfaces[key] = surface
+        self._nbytes += self._SizeOf(surface)
+        self._Evict()
+
+    def Clear(self):
+        self._surfaces.clear()
+        self._nbytes = 0
+
+    def _Evict(self):
+        # always keep the most recent surface, even if it alone is over budget
+        while self._nbytes > self._budget and len(self._surfaces) > 1:
+            key, surface = self._surfaces.popitem(last=False)
+            self._nbytes -= self._SizeOf(surface)
+
+    @staticmethod
+    def _SizeOf(surface):
+        return surface.GetActualMemorySize() * 1024
+
+
+class ChunkedSurfaceEngine(object):
+
+    """Extract and decimate an isosurface block by block."""
+
+    max_workers = multiprocessing.cpu_count()
+
+    # voxels per block
+    block_voxel_count = 256 * 256 * 256
+
+    # seconds between polls, when waiting for the surface
+    poll_interval = 0.05
+
+    def __init__(self, title="Generating surface..."):
+
+        self._title = title
+        self._blocks = []
+        self._completed = 0
+
+        self._generator = _MicroView.vtkImageChunkedSurfaceGenerator()
+
+    def SetInputData(self, image):
+        """Set the image to contour.  It mustn't change until the surface is done."""
+        self._generator.SetInputData(image)
+
+    def SetStencilData(self, stencil, background=0.0):
+        """Only contour inside the stencil, setting the voxels outside it to background"""
+        self._generator.SetStencilData(stencil)
+        self._generator.SetBackgroundLevel(background)
+
+    def SetTransform(self, transform):
+        self._generator.SetTransform(transform)
+
+    def SetOutputExtent(self, extent):
+        """Set the extent to reslice the image onto, before it is resampled"""
+        self._generator.SetOutputExtent(extent)
+
+    def SetOutputSpacing(self, spacing):
+        self._generator.SetOutputSpacing(spacing)
+
+    def SetOutputOrigin(self, origin):
+        self._generator.SetOutputOrigin(origin)
+
+    def SetResampleFactor(self, factor):
+        """Set the magnification to resample the image by, if less than one"""
+        self._generator.SetResampleFactor(factor)
+
+    def SetSmoothing(self, smoothing):
+        """Smooth the image with a Gaussian before contouring"""
+        self._generator.SetSmoothing(int(smoothing))
+
+    def SetValue(self, value):
+        """Set the iso-value"""
+        self._generator.SetValue(value)
+
+    def SetTargetReduction(self, reduction):
+        """Set the fraction of triangles decimation should try to remove"""
+        self._generator.SetTargetReduction(reduction)
+
+    def GetOutput(self):
+        return self._generator.GetOutput()
+
+    def GetInputWholeExtent(self):
+        """The extent of the image that is contoured, once it has been resampled"""
+
+        self._generator.UpdateInformation()
+        return tuple(self._generator.GetWholeExtent())
+
+    def GetBlockExtents(self, extent):
+        """Split an extent into blocks for contouring.
+
+        Neighbouring blocks overlap by one plane of voxels.  The volume is cut
+        into z-slabs first, and each slab into rows along y only if a slab
+        of two slices would be larger than a block.  There are at least as many blocks as
+        workers, where the image is deep enough."""
+
+        x0, x1, y0, y1, z0, z1 = extent
+        nx, ny, nz = x1 - x0 + 1, y1 - y0 + 1, z1 - z0 + 1
+
+        slice_size = max(nx * ny, 1)
+        if slice_size * 2 <= self.block_voxel_count:
+            rows = ny
+            depth = self.block_voxel_count / slice_size
+            # keep every worker busy
+            depth = min(depth, max((nz - 1 + self.max_workers - 1) / self.max_workers, 1) + 1)
+        else:
+            rows = depth = max(int(math.sqrt(self.block_voxel_count / nx)), 2)
+
+        def splits(lo, hi, size):
+            if hi <= lo:
+                return [(lo, hi)]
+            return [(i, min(i + size - 1, hi)) for i in range(lo, hi, size - 1)]
+
+        blocks = []
+        for za, zb in splits(z0, z1, depth):
+            for ya, yb in splits(y0, y1, rows):
+                blocks.append((x0, x1, ya, yb, za, zb))
+
+        return blocks
+
+    def Start(self):
+        """Begin generating the surface in the background.  Poll Step() until
+        it returns True."""
+
+        self.Abort()
+
+        self._blocks = self.GetBlockExtents(self.GetInputWholeExtent())
+        self._completed = 0
+
+        self._generator.RemoveAllBlocks()
+        for extent in self._blocks:
+            self._generator.AddBlock(*extent)
+        self._generator.SetNumberOfThreads(max(1, min(self.max_workers, len(self._blocks))))
+        self._generator.Start()
+
+    def Step(self):
+        """Report the progress made so far, without waiting for the workers.
+        Returns True once the surface is complete."""
+
+        if not self._generator.IsDone():
+            if not self._generator.IsRunning():
+                raise RuntimeError("%s: the surface generator isn't running" % self._title)
+            completed = self._generator.GetNumberOfCompletedBlocks()
+            if completed != self._completed:
+                self._completed = completed
+                event.notify(ProgressEvent(self._title, 0.9 * completed / len(self._blocks)))
+            return False
+
+        # the workers have finished, so this doesn't block
+        self._generator.Wait()
+        event.notify(ProgressEvent(self._title, 1.0))
+        return True
+
+    def IsRunning(self):
+        return bool(self._generator.IsRunning())
+
+    def Abort(self):
+        """Stop generating the surface, discarding any blocks done so far.
+        Waits for the workers to finish the blocks they are working on."""
+
+        self._generator.Abort()
+
+    def Update(self):
+        """Generate the surface, reporting progress as blocks are finished"""
+
+        self.Start()
+        while not self.Step():
+            time.sleep(self.poll_interval)
@@ -50,6 +50,80 @@ class StandardROIToolState(object):
         return self.__orthoplanes_observer
 
 
+class ROIStencilScheduler(object):
+
+    """Coalesces bursts of ROI modifications into a single stencil update.
+
+    The ROI outline follows every modification, but rebuilding the stencil is
+    deferred until modifications have stopped arriving for delay_ms
+    milliseconds, or until an interaction such as a slider drag has ended.
+    During an interaction the wait is stretched to interaction_delay_ms
+    rather than suspended, so an update still happens if the end of the
+    interaction is never reported.
+    """
+
+    delay_ms = 150
+    interaction_delay_ms = 1000
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._timer = None
+        self._pending = None
+        self._interacting = False
+
+    def Schedule(self, image_index):
+        """Request a stencil update for the given image"""
+
+        # don't let an update for another image be swallowed
+        if self._pending is not None and self._pending != image_index:
+            self.Flush()
+
+        self._pending = image_index
+        self._Restart()
+
+    def _Restart(self):
+        delay = self.interaction_delay_ms if self._interacting else self.delay_ms
+        if self._timer is None:
+            self._timer = wx.CallLater(delay, self.Flush)
+        else:
+            self._timer.Restart(delay)
+
+    def BeginInteraction(self):
+        """Hold back updates until EndInteraction() is called, or until the
+        interaction has paused for interaction_delay_ms"""
+        if self._interacting:
+            return
+        self._interacting = True
+        if self._pending is not None:
+            self._Restart()
+
+    def EndInteraction(self):
+        self._interacting = False
+        self.Flush()
+
+    def Flush(self):
+        """Perform any pending update now"""
+
+        if self._timer is not None:
+            self._timer.Stop()
+        self._interacting = False
+
+        image_index, self._pending = self._pending, None
+        if image_index is not None:
+            self._callback(image_index)
+
+    def Cancel(self, image_index=None):
+        """Discard the pending update, or only the one for image_index"""
+
+        if image_index is not None and image_index != self._pending:
+            return
+
+        if self._timer is not None:
+            self._timer.Stop()
+        self._pending = None
+        self._interacting = False
+
+
 class ROIController(object):
 
     """Contains GUI interaction code for the Standard ROI plugin.
@@ -67,6 +141,9 @@ class ROIController(object):
         self.bIgnoreGUIEvents = False
         self.bArbitraryOrientation = False
 
+        # stencils are rebuilt once a burst of modifications has settled
+        self._stencil_updates = ROIStencilScheduler(self.onStencilUpdateDue)
+
         # These next four variables are used to eat duplicate GUI events
         self._oldSizes = None
         self._oldCenters = None
@@ -151,6 +228,12 @@ class ROIController(object):
         gui.m_sliderCenterZ.Bind(
             wx.EVT_SLIDER, lambda evt: self.onSetCenter(2, evt))
 
+        # only the ROI outline follows a slider while it's being dragged
+        for slider in (gui.m_sliderSizeX, gui.m_sliderSizeY, gui.m_sliderSizeZ,
+                       gui.m_sliderCenterX, gui.m_sliderCenterY, gui.m_sliderCenterZ):
+            slider.Bind(wx.EVT_SCROLL_THUMBTRACK, self.onSliderThumbTrack)
+            slider.Bind(wx.EVT_SCROLL_THUMBRELEASE, self.onSliderThumbRelease)
+
         # 5 - register zope event handlers
         component.provideHandler(self.onROIKeyEvent)
         component.provideHandler(self.onModelModifiedEvent)
@@ -171,6 +254,9 @@ class ROIController(object):
 
     def OnPluginClose(self):
 
+        # forget any stencil update that hasn't happened yet
+        self._stencil_updates.Cancel()
+
         # stop listening
         self.removeObservers()
 
@@ -207,7 +293,10 @@ class ROIController(object):
         return self._plugin
 
     def SetROIType(self, roi_type):
-        return self.GetModel().setModelROIType(roi_type)
+        retval = self.GetModel().setModelROIType(roi_type)
+        # callers expect the stencil to be up to date on return
+        self._stencil_updates.Flush()
+        return retval
 
     def GetROIType(self, image_index=None):
         return self.GetModel(image_index).getModelROIType()
@@ -215,9 +304,19 @@ class ROIController(object):
     def GetROIBounds(self, image_index=None):
         return self.GetModel(image_index).getModelROIBounds()
 
+    def SetROIBounds(self, bounds, image_index=None):
+        retval = self.GetModel(image_index).setModelROIBounds(bounds)
+        self._stencil_updates.Flush()
+        return retval
+
     def GetROIExtent(self, image_index=None):
         return self.GetModel(image_index).getModelROIExtent()
 
+    def SetROIExtent(self, extent, image_index=None):
+        retval = self.GetModel(image_index).setModelROIExtent(extent)
+        self._stencil_updates.Flush()
+        return retval
+
     def GetROIStencil(self, image_index=None):
         return self.GetModel(image_index).getModelROIStencil()
 
@@ -234,10 +333,14 @@ class ROIController(object):
         return self.GetModel(image_index).getModelROISizeInMillimeters()
 
     def SetModelROICenterInPixels(self, center, image_index=None):
-        return self.GetModel(image_index).setModelROICenterInPixels(center)
+        retval = self.GetModel(image_index).setModelROICenterInPixels(center)
+        self._stencil_updates.Flush()
+        return retval
 
     def SetModelROICenterInMillimeters(self, center, image_index=None):
-        return self.GetModel(image_index).setModelROICenterInMillimeters(center)
+        retval = self.GetModel(image_index).setModelROICenterInMillimeters(center)
+        self._stencil_updates.Flush()
+        return retval
 
 ################### VTK Related code ##########################
 
@@ -302,6 +405,7 @@ class ROIController(object):
 
         # save current gui state
         if self._current_image_index is not None:
+            self._stencil_updates.Flush()
             self.saveCurrentGUIState()
 
         self._current_image_index = evt.GetCurrentImageIndex()
@@ -421,10 +525,12 @@ class ROIController(object):
 
     @component.adapter(CurrentImageClosingEvent)
     def onCurrentImageClosingEvent(self, evt):
+        self._stencil_updates.Cancel(self.GetCurrentImageIndex())
         self.resetGUI()
 
     @component.adapter(NotebookPageChangingEvent)
     def OnNotebookPageChangingEvent(self, evt):
+        self._stencil_updates.Flush()
         self.resetGUI()
 
     def resetGUI(self):
@@ -523,6 +629,7 @@ class ROIController(object):
 
         model.clearROIControlPoints()
         view.DisableROI()
+        self._stencil_updates.Cancel(image_index)
 
         # check to see whether we're the current stencil
         if image.GetStencilDataOwner() == "StandardROITool":
@@ -567,7 +674,9 @@ class ROIController(object):
         """
         bounds = tuple(self.GetVTKView().GetCube().GetROIBounds())
         self.GetModel().setModelROIBounds(bounds)
-        self.send_modified_notification(evt)
+
+        # the interaction is over, so don't wait for the stencil
+        self._stencil_updates.Flush()
 
     def updateStencilData(self):
         """feed model stencil into current image"""
@@ -648,14 +757,22 @@ class ROIController(object):
 
     def send_modified_notification(self, evt):
 
-        # update image with stencil from the current model
+        # update image with stencil from the current model, once the burst
+        # of modifications this belongs to has settled
         if evt:
-            self.updateStencilData()
+            self._stencil_updates.Schedule(self.GetCurrentImageIndex())
+
+    def onStencilUpdateDue(self, image_index):
+
+        # the image may have been closed or switched in the meantime
+        if image_index != self.GetCurrentImageIndex() or image_index not in self._app_states:
+            return
+
+        self.updateStencilData()
 
         # notify everyone external that ROI has changed
-        if evt:
-            event.notify(
-                ROIModifiedEvent(self._plugin.GetShortName(), self.GetCurrentImageIndex()))
+        event.notify(
+            ROIModifiedEvent(self._plugin.GetShortName(), image_index))
 
     @component.adapter(ROIModelLinkingChangeEvent)
     def onModelLinkingChangeEvent(self, evt):
@@ -759,6 +876,14 @@ class ROIController(object):
         else:
             self.GetModel().setModelROICenterInPixels(center)
 
+    def onSliderThumbTrack(self, evt):
+        self._stencil_updates.BeginInteraction()
+        evt.Skip()
+
+    def onSliderThumbRelease(self, evt):
+        self._stencil_updates.EndInteraction()
+        evt.Skip()
+
     def onSetSize(self, index, evt):
         """Call back function for the size scale bars."""
 
@@ -1016,6 +1141,7 @@ class ROIController(object):
     def SetPoints(self, point1, point2):
         self.GetModel().setModelROIControlPoint(0, point1)
         self.GetModel().setModelROIControlPoint(1, point2)
+        self._stencil_updates.Flush()
 
     def SetOrthoCenterAsPoint(self, index, evt):
         """Callback function of control-keypress-7"""
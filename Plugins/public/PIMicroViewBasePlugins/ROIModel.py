@@ -3,6 +3,7 @@ import math
 import numpy
 import vtk
 from zope import event
+from PI.visualization.MicroView import _MicroView
 from PI.visualization.MicroView.events import ROIModelTypeChangeEvent, ROIModelOrientationChangeEvent, \
     ROIModelModifiedEvent, ROIModelLinkingChangeEvent, ROIModelControlPointChangeEvent
 
@@ -23,6 +24,7 @@ class ROIModel(object):
         self.__ROIOrientation = None
         self.__ROIControlPoints = (None, None)
         self._StencilGenerator = None
+        self._LastStencil = None
         self.__Transform = vtk.vtkTransform()
 
     def setTransform(self, t):
@@ -490,11 +492,11 @@ class ROIModel(object):
         ]
 
         b_t = [1e38, -1e38, 1e38, -1e38, 1e38, -1e38]
-        is_identity = True
 
-        # is transform identity?
-        is_identity = self.__Transform.GetMatrix().Determinant() == 1.0
-        #is_identity = False
+        # is transform identity?  (a rotation has a determinant of 1 too)
+        m = self.__Transform.GetMatrix()
+        is_identity = all(m.GetElement(i, j) == float(i == j)
+                          for i in range(4) for j in range(4))
 
         for i in range(8):
             i2 = _index[i]
@@ -524,9 +526,28 @@ class ROIModel(object):
         # make sure we're dealing with ints
         e_t = map(int, e_t)
 
+        # if the ROI has only been moved by whole voxels since the last
+        # stencil was made, shifting that stencil gives the same result
+        key = (roi_type, roi_orientation,
+               (b[1] - b[0], b[3] - b[2], b[5] - b[4]),
+               tuple(self.getImageSpacing()), tuple(self.getImageOrigin()),
+               tuple(m.GetElement(i, j) for i in range(3) for j in range(3)))
+        corner = self.__Transform.TransformPoint(b[0], b[2], b[4])
+
+        stencil = self._TranslateLastStencil(key, corner, e_t)
+        if stencil is not None:
+            self._LastStencil = (key, corner, e_t, stencil)
+            return stencil
+
+        # the analytic source needs a rebuilt _MicroView module
+        is_analytic = is_identity or hasattr(_MicroView, 'vtkOrientedROIStencilSource')
+
         if is_identity:
             # fast, but limited to canonical objects
             self._StencilGenerator = vtk.vtkROIStencilSource()
+        elif is_analytic:
+            # fast, intersects each row of voxels with the oriented shape
+            self._StencilGenerator = _MicroView.vtkOrientedROIStencilSource()
         else:
             # slow, but more generic
             self._StencilGenerator = vtk.vtkImplicitFunctionToImageStencil()
@@ -537,7 +558,7 @@ class ROIModel(object):
         # set extent of stencil - taking into account transformation
         self._StencilGenerator.SetOutputWholeExtent(e_t)
 
-        if is_identity:
+        if is_analytic:
             # use DG's fast routines
             if roi_type == 'box':
                 self._StencilGenerator.SetShapeToBox()
@@ -551,6 +572,8 @@ class ROIModel(object):
             elif roi_type == 'ellipsoid':
                 self._StencilGenerator.SetShapeToEllipsoid()
             self._StencilGenerator.SetBounds(b)
+            if not is_identity:
+                self._StencilGenerator.SetTransform(t1)
         else:
             # use JG's slow routines
             if roi_type == 'box':
@@ -630,4 +653,34 @@ class ROIModel(object):
         _t1 = time.time()
         self._StencilGenerator.Update()
         _t2 = time.time()
-        return self._StencilGenerator.GetOutput()
+
+        stencil = self._StencilGenerator.GetOutput()
+        self._LastStencil = (key, corner, e_t, stencil)
+        return stencil
+
+    def _TranslateLastStencil(self, key, corner, e_t):
+        """Returns the last stencil moved to extent e_t, or None if the ROI
+        has changed by more than a whole-voxel translation"""
+
+        # the translator needs a rebuilt _MicroView module
+        if self._LastStencil is None or not hasattr(_MicroView, 'vtkImageStencilTranslator'):
+            return None
+
+        last_key, last_corner, last_e_t, last_stencil = self._LastStencil
+        if key != last_key:
+            return None
+
+        spacing = key[3]
+        shift = []
+        for i in range(3):
+            s = (corner[i] - last_corner[i]) / spacing[i]
+            if abs(s - round(s)) > 1e-6:
+                return None
+            shift.append(int(round(s)))
+
+        if e_t != [last_e_t[i] + shift[i // 2] for i in range(6)]:
+            return None
+
+        stencil = vtk.vtkImageStencilData()
+        _MicroView.vtkImageStencilTranslator.Translate(last_stencil, shift[0], shift[1], shift[2], stencil)
+        return stencil
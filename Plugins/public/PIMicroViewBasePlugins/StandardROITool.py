@@ -153,12 +153,12 @@ class StandardROITool(MicroViewPlugIn.MicroViewPlugIn):
     @component.adapter(StandardROIChangeExtentCommandEvent)
     def onROIChangeExtentRequested(self, evt):
         """Someone external has requested that the standard ROI extent be changed"""
-        self.getController().GetModel().setModelROIExtent(evt.GetExtent())
+        self.getController().SetROIExtent(evt.GetExtent())
 
     @component.adapter(StandardROIChangeBoundsCommandEvent)
     def onROIChangeBoundsRequested(self, evt):
         """Someone external has requested that the standard ROI extent be changed"""
-        self.getController().GetModel().setModelROIBounds(evt.GetBounds())
+        self.getController().SetROIBounds(evt.GetBounds())
 
     def OnPluginClose(self):
 
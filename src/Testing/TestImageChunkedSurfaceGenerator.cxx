@@ -0,0 +1,129 @@
+/************************************************************************/
+/* TestImageChunkedSurfaceGenerator.cxx                                 */
+/*                                                                      */
+/* Contours a volume in several blocks on several threads, and checks   */
+/* that the stitched surface has exactly as many points and cells as    */
+/* the surface that one marching cubes pass makes of the whole volume.  */
+/*                                                                      */
+/************************************************************************/
+
+#include "vtkImageChunkedSurfaceGenerator.h"
+
+#include "vtkFloatArray.h"
+#include "vtkImageData.h"
+#include "vtkImageReslice.h"
+#include "vtkMarchingCubes.h"
+#include "vtkPointData.h"
+#include "vtkPolyData.h"
+#include "vtkVersion.h"
+
+#include <math.h>
+#include <stdlib.h>
+
+// two overlapping blobs, so that the surface crosses every block boundary
+static vtkImageData *MakeVolume(int n)
+{
+  vtkImageData *image = vtkImageData::New();
+  image->SetDimensions(n, n, n);
+#if VTK_MAJOR_VERSION > 5
+  image->AllocateScalars(VTK_FLOAT, 1);
+#else
+  image->SetScalarTypeToFloat();
+  image->SetNumberOfScalarComponents(1);
+  image->AllocateScalars();
+#endif
+
+  float *ptr = static_cast<float *>(image->GetScalarPointer());
+  for (int z = 0; z < n; z++)
+    {
+    for (int y = 0; y < n; y++)
+      {
+      for (int x = 0; x < n; x++)
+        {
+        double d1 = sqrt((x - 17.3)*(x - 17.3) + (y - 20.1)*(y - 20.1) + (z - 15.7)*(z - 15.7));
+        double d2 = 1.2*sqrt((x - 30.2)*(x - 30.2) + (y - 27.9)*(y - 27.9) + (z - 31.4)*(z - 31.4));
+        *ptr++ = static_cast<float>(d1 < d2 ? d1 : d2);
+        }
+      }
+    }
+
+  return image;
+}
+
+int main(int, char *[])
+{
+  const int n = 48;
+  const double value = 11.5;
+
+  vtkImageData *image = MakeVolume(n);
+
+  // the whole volume in one pass, through the same reslice as the generator
+  vtkImageReslice *reslice = vtkImageReslice::New();
+#if VTK_MAJOR_VERSION > 5
+  reslice->SetInputData(image);
+#else
+  reslice->SetInput(image);
+#endif
+  reslice->SetInterpolationModeToCubic();
+  reslice->SetOutputExtent(0, n - 1, 0, n - 1, 0, n - 1);
+  reslice->SetOutputSpacing(1.0, 1.0, 1.0);
+  reslice->SetOutputOrigin(0.0, 0.0, 0.0);
+
+  vtkMarchingCubes *contour = vtkMarchingCubes::New();
+  contour->SetInputConnection(reslice->GetOutputPort());
+  contour->SetValue(0, value);
+  contour->ComputeScalarsOff();
+  contour->ComputeNormalsOff();
+  contour->Update();
+  vtkPolyData *expected = contour->GetOutput();
+
+  // eight blocks, which overlap by one plane, on four threads
+  vtkImageChunkedSurfaceGenerator *generator = vtkImageChunkedSurfaceGenerator::New();
+  generator->SetInputData(image);
+  generator->SetOutputExtent(0, n - 1, 0, n - 1, 0, n - 1);
+  generator->SetOutputSpacing(1.0, 1.0, 1.0);
+  generator->SetOutputOrigin(0.0, 0.0, 0.0);
+  generator->SetValue(value);
+  generator->SetNumberOfThreads(4);
+  generator->UpdateInformation();
+
+  int xsplit[3] = { 0, 24, n - 1 };
+  int zsplit[5] = { 0, 12, 24, 36, n - 1 };
+  for (int i = 0; i < 2; i++)
+    {
+    for (int k = 0; k < 4; k++)
+      {
+      generator->AddBlock(xsplit[i], xsplit[i+1], 0, n - 1, zsplit[k], zsplit[k+1]);
+      }
+    }
+
+  generator->Start();
+  generator->Wait();
+
+  int status = EXIT_SUCCESS;
+  vtkPolyData *output = generator->GetOutput();
+  if (!generator->IsDone() ||
+      generator->GetNumberOfCompletedBlocks() != generator->GetNumberOfBlocks())
+    {
+    cerr << "Only " << generator->GetNumberOfCompletedBlocks() << " of "
+         << generator->GetNumberOfBlocks() << " blocks were contoured\n";
+    status = EXIT_FAILURE;
+    }
+  else if (expected->GetNumberOfPoints() == 0 ||
+           output->GetNumberOfPoints() != expected->GetNumberOfPoints() ||
+           output->GetNumberOfCells() != expected->GetNumberOfCells())
+    {
+    cerr << "Stitched surface has " << output->GetNumberOfPoints() << " points and "
+         << output->GetNumberOfCells() << " cells, expected "
+         << expected->GetNumberOfPoints() << " points and "
+         << expected->GetNumberOfCells() << " cells\n";
+    status = EXIT_FAILURE;
+    }
+
+  generator->Delete();
+  contour->Delete();
+  reslice->Delete();
+  image->Delete();
+
+  return status;
+}
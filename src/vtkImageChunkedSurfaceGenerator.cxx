@@ -0,0 +1,595 @@
+/************************************************************************/
+/* vtkImageChunkedSurfaceGenerator.cxx                                  */
+/*                                                                      */
+/* Contours an image a block at a time on worker threads.  Every worker */
+/* has a pipeline of its own, built on the main thread, and the workers */
+/* share nothing but the input's voxels, which they only read.          */
+/*                                                                      */
+/************************************************************************/
+
+#include "vtkImageChunkedSurfaceGenerator.h"
+
+#include "vtkAbstractTransform.h"
+#include "vtkAppendPolyData.h"
+#include "vtkCleanPolyData.h"
+#include "vtkDataArray.h"
+#include "vtkDecimatePro.h"
+#include "vtkExecutive.h"
+#include "vtkImageClip.h"
+#include "vtkImageData.h"
+#include "vtkImageGaussianSmooth.h"
+#include "vtkImageResample.h"
+#include "vtkImageReslice.h"
+#include "vtkImageStencilData.h"
+#include "vtkInformation.h"
+#include "vtkIntArray.h"
+#include "vtkLinearTransform.h"
+#include "vtkMarchingCubes.h"
+#include "vtkMutexLock.h"
+#include "vtkObjectFactory.h"
+#include "vtkPointData.h"
+#include "vtkPolyData.h"
+#include "vtkStreamingDemandDrivenPipeline.h"
+#include "vtkTransform.h"
+#include "vtkVersion.h"
+
+vtkStandardNewMacro(vtkImageChunkedSurfaceGenerator);
+
+vtkCxxSetObjectMacro(vtkImageChunkedSurfaceGenerator, StencilData, vtkImageStencilData);
+vtkCxxSetObjectMacro(vtkImageChunkedSurfaceGenerator, Transform, vtkAbstractTransform);
+
+//----------------------------------------------------------------------------
+// The filters that one worker pulls its blocks through.
+class vtkImageChunkedSurfaceGeneratorPipeline
+{
+public:
+  vtkImageChunkedSurfaceGenerator *Generator;
+  vtkImageData *Input;
+  vtkImageStencilData *Stencil;
+  vtkAbstractTransform *Transform;
+  vtkImageReslice *Reslice;
+  vtkImageResample *Resample;
+  vtkImageGaussianSmooth *Smooth;
+  vtkImageClip *Clip;
+  vtkMarchingCubes *Contour;
+  vtkDecimatePro *Decimate;
+  // the last image filter, and the last surface filter
+  vtkAlgorithm *Image;
+  vtkPolyDataAlgorithm *Surface;
+};
+
+//----------------------------------------------------------------------------
+vtkImageChunkedSurfaceGenerator::vtkImageChunkedSurfaceGenerator()
+{
+  this->Input = NULL;
+  this->StencilData = NULL;
+  this->Transform = NULL;
+  this->BackgroundLevel = 0.0;
+  for (int i = 0; i < 3; i++)
+    {
+    this->OutputExtent[2*i] = 0;
+    this->OutputExtent[2*i+1] = -1;
+    this->OutputSpacing[i] = 1.0;
+    this->OutputOrigin[i] = 0.0;
+    this->WholeExtent[2*i] = 0;
+    this->WholeExtent[2*i+1] = -1;
+    }
+  this->ResampleFactor = 1.0;
+  this->Smoothing = 0;
+  this->StandardDeviation = 1.0;
+  this->Value = 0.0;
+  this->TargetReduction = 0.0;
+
+  this->Blocks = vtkIntArray::New();
+  this->Blocks->SetNumberOfComponents(6);
+  this->BlockSurfaces = NULL;
+  this->NumberOfBlockSurfaces = 0;
+
+  this->Append = vtkAppendPolyData::New();
+  this->Append->ReleaseDataFlagOn();
+
+  // stitch the blocks together along their shared planes
+  this->Clean = vtkCleanPolyData::New();
+  this->Clean->SetInputConnection(this->Append->GetOutputPort());
+  this->Clean->PointMergingOn();
+  this->Clean->SetTolerance(0.0);
+
+  this->Output = vtkPolyData::New();
+
+  this->InputScalars = NULL;
+  this->Threader = vtkMultiThreader::New();
+  this->NumberOfThreads = this->Threader->GetNumberOfThreads();
+  this->Pipelines = NULL;
+  this->ThreadIds = NULL;
+  this->NumberOfPipelines = 0;
+
+  this->Lock = vtkMutexLock::New();
+  this->NextBlockId = 0;
+  this->CompletedBlocks = 0;
+  this->AbortFlag = 0;
+  this->Done = 0;
+}
+
+//----------------------------------------------------------------------------
+vtkImageChunkedSurfaceGenerator::~vtkImageChunkedSurfaceGenerator()
+{
+  this->Abort();
+
+  this->SetInputData(NULL);
+  this->SetStencilData(NULL);
+  this->SetTransform(NULL);
+  this->Blocks->Delete();
+  this->Append->Delete();
+  this->Clean->Delete();
+  this->Output->Delete();
+  this->Threader->Delete();
+  this->Lock->Delete();
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::SetInputData(vtkImageData *input)
+{
+  if (this->Input == input)
+    {
+    return;
+    }
+  if (this->Input)
+    {
+    this->Input->UnRegister(this);
+    }
+  this->Input = input;
+  if (this->Input)
+    {
+    this->Input->Register(this);
+    }
+  this->Modified();
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::AddBlock(int x0, int x1, int y0, int y1,
+                                               int z0, int z1)
+{
+  int extent[6] = {x0, x1, y0, y1, z0, z1};
+  this->Blocks->InsertNextTupleValue(extent);
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::RemoveAllBlocks()
+{
+  this->Blocks->Reset();
+}
+
+//----------------------------------------------------------------------------
+int vtkImageChunkedSurfaceGenerator::GetNumberOfBlocks()
+{
+  return this->Blocks->GetNumberOfTuples();
+}
+
+//----------------------------------------------------------------------------
+// Build a pipeline for one worker.  This must run on the main thread.  The
+// reference counts of VTK objects aren't safe to change from several
+// threads at once, so the workers don't share any of them: each one gets
+// its own copy of the stencil and transform, and an image of its own that
+// wraps the input's voxels without taking a reference to them.
+vtkImageChunkedSurfaceGeneratorPipeline *vtkImageChunkedSurfaceGenerator::NewPipeline()
+{
+  vtkImageChunkedSurfaceGeneratorPipeline *p = new vtkImageChunkedSurfaceGeneratorPipeline;
+  p->Generator = this;
+
+  p->Input = vtkImageData::New();
+  p->Input->CopyStructure(this->Input);
+  vtkDataArray *scalars = this->Input->GetPointData()->GetScalars();
+  if (scalars)
+    {
+    vtkDataArray *array = scalars->NewInstance();
+    array->SetNumberOfComponents(scalars->GetNumberOfComponents());
+    array->SetName(scalars->GetName());
+    array->SetVoidArray(scalars->GetVoidPointer(0),
+                        scalars->GetNumberOfTuples() * scalars->GetNumberOfComponents(), 1);
+    p->Input->GetPointData()->SetScalars(array);
+    array->Delete();
+#if VTK_MAJOR_VERSION <= 5
+    p->Input->SetScalarType(scalars->GetDataType());
+    p->Input->SetNumberOfScalarComponents(scalars->GetNumberOfComponents());
+#endif
+    }
+#if VTK_MAJOR_VERSION <= 5
+  p->Input->SetWholeExtent(p->Input->GetExtent());
+#endif
+
+  p->Reslice = vtkImageReslice::New();
+  p->Reslice->SetInterpolationModeToCubic();
+  p->Reslice->ReleaseDataFlagOn();
+  p->Reslice->SetNumberOfThreads(1);
+#if VTK_MAJOR_VERSION > 5
+  p->Reslice->SetInputData(p->Input);
+#else
+  p->Reslice->SetInput(p->Input);
+#endif
+  p->Reslice->SetOutputExtent(this->OutputExtent);
+  p->Reslice->SetOutputSpacing(this->OutputSpacing);
+  p->Reslice->SetOutputOrigin(this->OutputOrigin);
+
+  p->Stencil = NULL;
+  if (this->StencilData)
+    {
+    p->Stencil = vtkImageStencilData::New();
+    p->Stencil->DeepCopy(this->StencilData);
+#if VTK_MAJOR_VERSION > 5
+    p->Reslice->SetStencilData(p->Stencil);
+#else
+    p->Stencil->SetWholeExtent(p->Stencil->GetExtent());
+    p->Reslice->SetStencil(p->Stencil);
+#endif
+    p->Reslice->SetBackgroundLevel(this->BackgroundLevel);
+    }
+
+  p->Transform = NULL;
+  if (this->Transform)
+    {
+    vtkLinearTransform *linear = vtkLinearTransform::SafeDownCast(this->Transform);
+    if (linear)
+      {
+      // a linear transform is copied by its matrix alone, so that the copy
+      // doesn't share an input transform with the original
+      vtkTransform *transform = vtkTransform::New();
+      transform->SetMatrix(linear->GetMatrix());
+      p->Transform = transform;
+      }
+    else
+      {
+      p->Transform = this->Transform->MakeTransform();
+      p->Transform->DeepCopy(this->Transform);
+      }
+    p->Reslice->SetResliceTransform(p->Transform);
+    }
+
+  p->Image = p->Reslice;
+
+  p->Resample = NULL;
+  if (this->ResampleFactor < 1.0)
+    {
+    p->Resample = vtkImageResample::New();
+    p->Resample->SetInputConnection(p->Image->GetOutputPort());
+    p->Resample->ReleaseDataFlagOn();
+    p->Resample->SetNumberOfThreads(1);
+    for (int i = 0; i < 3; i++)
+      {
+      p->Resample->SetAxisMagnificationFactor(i, this->ResampleFactor);
+      }
+    p->Image = p->Resample;
+    }
+
+  p->Smooth = NULL;
+  if (this->Smoothing)
+    {
+    p->Smooth = vtkImageGaussianSmooth::New();
+    p->Smooth->SetInputConnection(p->Image->GetOutputPort());
+    p->Smooth->ReleaseDataFlagOn();
+    p->Smooth->SetNumberOfThreads(1);
+    p->Smooth->SetStandardDeviation(this->StandardDeviation);
+    p->Image = p->Smooth;
+    }
+
+  p->Clip = vtkImageClip::New();
+  p->Clip->SetInputConnection(p->Image->GetOutputPort());
+  p->Clip->ClipDataOn();
+
+  p->Contour = vtkMarchingCubes::New();
+  p->Contour->SetInputConnection(p->Clip->GetOutputPort());
+  p->Contour->SetNumberOfContours(1);
+  p->Contour->SetValue(0, this->Value);
+  p->Contour->ComputeScalarsOff();
+  p->Contour->ComputeNormalsOff();
+  p->Surface = p->Contour;
+
+  p->Decimate = NULL;
+  if (this->TargetReduction > 0.0)
+    {
+    // the vertices on the block's open boundary must survive decimation,
+    // or they won't line up with the neighbouring block
+    p->Decimate = vtkDecimatePro::New();
+    p->Decimate->SetInputConnection(p->Contour->GetOutputPort());
+    p->Decimate->PreserveTopologyOn();
+    p->Decimate->BoundaryVertexDeletionOff();
+    p->Decimate->SetTargetReduction(this->TargetReduction);
+    p->Surface = p->Decimate;
+    }
+
+  return p;
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::DeletePipeline(vtkImageChunkedSurfaceGeneratorPipeline *p)
+{
+  if (p->Decimate)
+    {
+    p->Decimate->Delete();
+    }
+  p->Contour->Delete();
+  p->Clip->Delete();
+  if (p->Smooth)
+    {
+    p->Smooth->Delete();
+    }
+  if (p->Resample)
+    {
+    p->Resample->Delete();
+    }
+  p->Reslice->Delete();
+  if (p->Transform)
+    {
+    p->Transform->Delete();
+    }
+  if (p->Stencil)
+    {
+    p->Stencil->Delete();
+    }
+  p->Input->Delete();
+  delete p;
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::UpdateInformation()
+{
+  if (!this->Input)
+    {
+    vtkErrorMacro("UpdateInformation: no input has been set");
+    return;
+    }
+
+  vtkImageChunkedSurfaceGeneratorPipeline *p = this->NewPipeline();
+  p->Image->UpdateInformation();
+  p->Image->GetExecutive()->GetOutputInformation(0)->Get(
+    vtkStreamingDemandDrivenPipeline::WHOLE_EXTENT(), this->WholeExtent);
+  this->DeletePipeline(p);
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::Start()
+{
+  this->Abort();
+
+  this->Output->Initialize();
+  this->NextBlockId = 0;
+  this->CompletedBlocks = 0;
+  this->AbortFlag = 0;
+  this->Done = 0;
+
+  if (!this->Input)
+    {
+    vtkErrorMacro("Start: no input has been set");
+    return;
+    }
+
+  int nblocks = this->GetNumberOfBlocks();
+  if (nblocks == 0)
+    {
+    this->Done = 1;
+    return;
+    }
+
+  // the append filter is connected up here, rather than on a worker
+  this->NumberOfBlockSurfaces = nblocks;
+  this->BlockSurfaces = new vtkPolyData *[nblocks];
+  for (int i = 0; i < nblocks; i++)
+    {
+    this->BlockSurfaces[i] = vtkPolyData::New();
+#if VTK_MAJOR_VERSION > 5
+    this->Append->AddInputData(this->BlockSurfaces[i]);
+#else
+    this->Append->AddInput(this->BlockSurfaces[i]);
+#endif
+    }
+
+  // keep the voxels alive even if the input is released while the
+  // workers are using them
+  this->InputScalars = this->Input->GetPointData()->GetScalars();
+  if (this->InputScalars)
+    {
+    this->InputScalars->Register(this);
+    }
+
+  this->NumberOfPipelines = (this->NumberOfThreads < nblocks ?
+                             this->NumberOfThreads : nblocks);
+  this->Pipelines = new vtkImageChunkedSurfaceGeneratorPipeline *[this->NumberOfPipelines];
+  this->ThreadIds = new int[this->NumberOfPipelines];
+  for (int i = 0; i < this->NumberOfPipelines; i++)
+    {
+    this->Pipelines[i] = this->NewPipeline();
+    }
+  for (int i = 0; i < this->NumberOfPipelines; i++)
+    {
+    this->ThreadIds[i] = this->Threader->SpawnThread(
+      &vtkImageChunkedSurfaceGenerator::WorkerThread, this->Pipelines[i]);
+    }
+}
+
+//----------------------------------------------------------------------------
+VTK_THREAD_RETURN_TYPE vtkImageChunkedSurfaceGenerator::WorkerThread(void *arg)
+{
+  vtkMultiThreader::ThreadInfo *info = static_cast<vtkMultiThreader::ThreadInfo *>(arg);
+  vtkImageChunkedSurfaceGeneratorPipeline *p =
+    static_cast<vtkImageChunkedSurfaceGeneratorPipeline *>(info->UserData);
+  vtkImageChunkedSurfaceGenerator *self = p->Generator;
+
+  int block;
+  while ((block = self->NextBlock()) >= 0)
+    {
+    self->ContourBlock(p, block);
+    if (self->FinishBlock())
+      {
+      self->Stitch();
+      }
+    }
+
+  return VTK_THREAD_RETURN_VALUE;
+}
+
+//----------------------------------------------------------------------------
+// Hand out the next block, or -1 if there are none left or the generator
+// has been aborted.
+int vtkImageChunkedSurfaceGenerator::NextBlock()
+{
+  int block = -1;
+
+  this->Lock->Lock();
+  if (!this->AbortFlag && this->NextBlockId < this->NumberOfBlockSurfaces)
+    {
+    block = this->NextBlockId++;
+    }
+  this->Lock->Unlock();
+
+  return block;
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::ContourBlock(vtkImageChunkedSurfaceGeneratorPipeline *p,
+                                                   int block)
+{
+  int extent[6];
+  this->Blocks->GetTupleValue(block, extent);
+
+  p->Clip->SetOutputWholeExtent(extent);
+  p->Surface->Update();
+
+  this->BlockSurfaces[block]->ShallowCopy(p->Surface->GetOutput());
+
+  // don't hold on to the block's voxels
+  p->Clip->GetOutput()->ReleaseData();
+}
+
+//----------------------------------------------------------------------------
+// Count a block as done, and return 1 if it was the last one.
+int vtkImageChunkedSurfaceGenerator::FinishBlock()
+{
+  this->Lock->Lock();
+  this->CompletedBlocks++;
+  int last = (!this->AbortFlag && this->CompletedBlocks == this->NumberOfBlockSurfaces);
+  this->Lock->Unlock();
+
+  return last;
+}
+
+//----------------------------------------------------------------------------
+// Merge the blocks into the output.  This runs on the worker that finished
+// the last block, once the others are no longer using the block surfaces.
+void vtkImageChunkedSurfaceGenerator::Stitch()
+{
+  this->Clean->Update();
+  this->Output->ShallowCopy(this->Clean->GetOutput());
+  this->Clean->GetOutput()->ReleaseData();
+
+  for (int i = 0; i < this->NumberOfBlockSurfaces; i++)
+    {
+    this->BlockSurfaces[i]->Initialize();
+    }
+
+  this->Lock->Lock();
+  this->Done = 1;
+  this->Lock->Unlock();
+}
+
+//----------------------------------------------------------------------------
+int vtkImageChunkedSurfaceGenerator::GetNumberOfCompletedBlocks()
+{
+  this->Lock->Lock();
+  int completed = this->CompletedBlocks;
+  this->Lock->Unlock();
+
+  return completed;
+}
+
+//----------------------------------------------------------------------------
+int vtkImageChunkedSurfaceGenerator::IsDone()
+{
+  this->Lock->Lock();
+  int done = this->Done;
+  this->Lock->Unlock();
+
+  return done;
+}
+
+//----------------------------------------------------------------------------
+int vtkImageChunkedSurfaceGenerator::IsRunning()
+{
+  return (this->NumberOfPipelines > 0);
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::Wait()
+{
+  this->JoinThreads();
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::Abort()
+{
+  this->Lock->Lock();
+  this->AbortFlag = 1;
+  this->Lock->Unlock();
+
+  this->JoinThreads();
+}
+
+//----------------------------------------------------------------------------
+// Wait for the workers to exit, then free their pipelines and the blocks.
+void vtkImageChunkedSurfaceGenerator::JoinThreads()
+{
+  for (int i = 0; i < this->NumberOfPipelines; i++)
+    {
+    this->Threader->TerminateThread(this->ThreadIds[i]);
+    }
+  for (int i = 0; i < this->NumberOfPipelines; i++)
+    {
+    this->DeletePipeline(this->Pipelines[i]);
+    }
+  delete [] this->Pipelines;
+  delete [] this->ThreadIds;
+  this->Pipelines = NULL;
+  this->ThreadIds = NULL;
+  this->NumberOfPipelines = 0;
+
+  this->Append->RemoveAllInputs();
+  for (int i = 0; i < this->NumberOfBlockSurfaces; i++)
+    {
+    this->BlockSurfaces[i]->Delete();
+    }
+  delete [] this->BlockSurfaces;
+  this->BlockSurfaces = NULL;
+  this->NumberOfBlockSurfaces = 0;
+
+  if (this->InputScalars)
+    {
+    this->InputScalars->UnRegister(this);
+    this->InputScalars = NULL;
+    }
+}
+
+//----------------------------------------------------------------------------
+void vtkImageChunkedSurfaceGenerator::PrintSelf(ostream& os, vtkIndent indent)
+{
+  this->Superclass::PrintSelf(os, indent);
+
+  os << indent << "Input: " << this->Input << "\n";
+  os << indent << "StencilData: " << this->StencilData << "\n";
+  os << indent << "Transform: " << this->Transform << "\n";
+  os << indent << "BackgroundLevel: " << this->BackgroundLevel << "\n";
+  os << indent << "OutputExtent: (" << this->OutputExtent[0];
+  for (int i = 1; i < 6; i++)
+    {
+    os << ", " << this->OutputExtent[i];
+    }
+  os << ")\n";
+  os << indent << "OutputSpacing: (" << this->OutputSpacing[0] << ", "
+     << this->OutputSpacing[1] << ", " << this->OutputSpacing[2] << ")\n";
+  os << indent << "OutputOrigin: (" << this->OutputOrigin[0] << ", "
+     << this->OutputOrigin[1] << ", " << this->OutputOrigin[2] << ")\n";
+  os << indent << "ResampleFactor: " << this->ResampleFactor << "\n";
+  os << indent << "Smoothing: " << this->Smoothing << "\n";
+  os << indent << "StandardDeviation: " << this->StandardDeviation << "\n";
+  os << indent << "Value: " << this->Value << "\n";
+  os << indent << "TargetReduction: " << this->TargetReduction << "\n";
+  os << indent << "NumberOfThreads: " << this->NumberOfThreads << "\n";
+  os << indent << "NumberOfBlocks: " << this->GetNumberOfBlocks() << "\n";
+}
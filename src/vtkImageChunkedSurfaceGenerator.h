@@ -0,0 +1,194 @@
+#ifndef __vtkImageChunkedSurfaceGenerator_h
+#define __vtkImageChunkedSurfaceGenerator_h
+
+#include "vtkObject.h"
+#include "vtkMultiThreader.h" // for VTK_THREAD_RETURN_TYPE
+#include "MicroViewConfigure.h"
+
+class vtkAbstractTransform;
+class vtkAppendPolyData;
+class vtkCleanPolyData;
+class vtkDataArray;
+class vtkImageData;
+class vtkImageStencilData;
+class vtkIntArray;
+class vtkMutexLock;
+class vtkPolyData;
+class vtkImageChunkedSurfaceGeneratorPipeline;
+
+// .NAME vtkImageChunkedSurfaceGenerator - contour an image block by block on worker threads
+// .SECTION Description
+// vtkImageChunkedSurfaceGenerator reslices, resamples, smooths, contours
+// and decimates an image one block at a time.  Each worker thread pulls
+// blocks through its own copy of that pipeline, so that the work is spread
+// over all of the processors without holding the Python interpreter lock.
+// Start() returns straight away: poll GetNumberOfCompletedBlocks() and
+// IsDone(), or call Wait().  The last worker to finish stitches the blocks
+// together by merging the coincident points on their shared planes.
+//
+// The input, stencil and transform must not be modified until the
+// generator is done or has been aborted.
+
+class VTK_MicroView_EXPORT vtkImageChunkedSurfaceGenerator : public vtkObject
+{
+public:
+  static vtkImageChunkedSurfaceGenerator *New();
+  vtkTypeMacro(vtkImageChunkedSurfaceGenerator, vtkObject);
+  void PrintSelf(ostream& os, vtkIndent indent);
+
+  // Description:
+  // The image to contour.  It must be up to date.
+  virtual void SetInputData(vtkImageData *input);
+  vtkGetObjectMacro(Input, vtkImageData);
+
+  // Description:
+  // Only contour the voxels inside this stencil.  Those outside of it
+  // are set to the BackgroundLevel.
+  virtual void SetStencilData(vtkImageStencilData *stencil);
+  vtkGetObjectMacro(StencilData, vtkImageStencilData);
+  vtkSetMacro(BackgroundLevel, double);
+  vtkGetMacro(BackgroundLevel, double);
+
+  // Description:
+  // The transform to reslice the input through.
+  virtual void SetTransform(vtkAbstractTransform *transform);
+  vtkGetObjectMacro(Transform, vtkAbstractTransform);
+
+  // Description:
+  // The extent, spacing and origin to reslice the input onto, before it
+  // is resampled.
+  vtkSetVector6Macro(OutputExtent, int);
+  vtkGetVector6Macro(OutputExtent, int);
+  vtkSetVector3Macro(OutputSpacing, double);
+  vtkGetVector3Macro(OutputSpacing, double);
+  vtkSetVector3Macro(OutputOrigin, double);
+  vtkGetVector3Macro(OutputOrigin, double);
+
+  // Description:
+  // The magnification used to resample the resliced image.  The image
+  // isn't resampled unless this is less than one.
+  vtkSetMacro(ResampleFactor, double);
+  vtkGetMacro(ResampleFactor, double);
+
+  // Description:
+  // Smooth the resampled image with a Gaussian kernel before contouring.
+  vtkSetMacro(Smoothing, int);
+  vtkGetMacro(Smoothing, int);
+  vtkBooleanMacro(Smoothing, int);
+  vtkSetMacro(StandardDeviation, double);
+  vtkGetMacro(StandardDeviation, double);
+
+  // Description:
+  // The iso-value to contour at.
+  vtkSetMacro(Value, double);
+  vtkGetMacro(Value, double);
+
+  // Description:
+  // The fraction of the triangles that decimation should try to remove.
+  // The vertices on the open boundary of a block are never removed, so
+  // that they still line up with those of the neighbouring block.
+  vtkSetClampMacro(TargetReduction, double, 0.0, 1.0);
+  vtkGetMacro(TargetReduction, double);
+
+  // Description:
+  // The number of worker threads.
+  vtkSetClampMacro(NumberOfThreads, int, 1, VTK_MAX_THREADS);
+  vtkGetMacro(NumberOfThreads, int);
+
+  // Description:
+  // Compute the whole extent of the image that is contoured, after it has
+  // been resliced, resampled and smoothed.  The blocks must lie within it.
+  void UpdateInformation();
+  vtkGetVector6Macro(WholeExtent, int);
+
+  // Description:
+  // The blocks to contour.  Neighbouring blocks must overlap by one plane
+  // of voxels, so that every marching cubes cell belongs to one block.
+  void AddBlock(int x0, int x1, int y0, int y1, int z0, int z1);
+  void RemoveAllBlocks();
+  int GetNumberOfBlocks();
+
+  // Description:
+  // Start contouring the blocks, and return without waiting for them.
+  void Start();
+
+  // Description:
+  // The number of blocks that have been contoured so far.
+  int GetNumberOfCompletedBlocks();
+
+  // Description:
+  // Return 1 once every block has been contoured and the output has been
+  // stitched together.
+  int IsDone();
+
+  // Description:
+  // Return 1 between Start() and Wait() or Abort().
+  int IsRunning();
+
+  // Description:
+  // Wait for the workers to finish.
+  void Wait();
+
+  // Description:
+  // Stop contouring.  Each worker finishes the block it is working on.
+  void Abort();
+
+  // Description:
+  // The stitched surface, once IsDone() returns 1.
+  vtkGetObjectMacro(Output, vtkPolyData);
+
+protected:
+  vtkImageChunkedSurfaceGenerator();
+  ~vtkImageChunkedSurfaceGenerator();
+
+  static VTK_THREAD_RETURN_TYPE WorkerThread(void *arg);
+
+  vtkImageChunkedSurfaceGeneratorPipeline *NewPipeline();
+  void DeletePipeline(vtkImageChunkedSurfaceGeneratorPipeline *pipeline);
+  int NextBlock();
+  void ContourBlock(vtkImageChunkedSurfaceGeneratorPipeline *pipeline, int block);
+  int FinishBlock();
+  void Stitch();
+  void JoinThreads();
+
+  vtkImageData *Input;
+  vtkImageStencilData *StencilData;
+  vtkAbstractTransform *Transform;
+  double BackgroundLevel;
+  int OutputExtent[6];
+  double OutputSpacing[3];
+  double OutputOrigin[3];
+  double ResampleFactor;
+  int Smoothing;
+  double StandardDeviation;
+  double Value;
+  double TargetReduction;
+  int NumberOfThreads;
+  int WholeExtent[6];
+
+  vtkIntArray *Blocks;
+  vtkPolyData **BlockSurfaces;
+  int NumberOfBlockSurfaces;
+  vtkAppendPolyData *Append;
+  vtkCleanPolyData *Clean;
+  vtkPolyData *Output;
+
+  vtkDataArray *InputScalars;
+  vtkMultiThreader *Threader;
+  vtkImageChunkedSurfaceGeneratorPipeline **Pipelines;
+  int *ThreadIds;
+  int NumberOfPipelines;
+
+  // guarded by Lock
+  vtkMutexLock *Lock;
+  int NextBlockId;
+  int CompletedBlocks;
+  int AbortFlag;
+  int Done;
+
+private:
+  vtkImageChunkedSurfaceGenerator(const vtkImageChunkedSurfaceGenerator&);  // Not implemented.
+  void operator=(const vtkImageChunkedSurfaceGenerator&);  // Not implemented.
+};
+
+#endif
@@ -5,6 +5,12 @@
 /* Class exists to purify a binary volume, removing isolated bony       */
 /* spicules and encapsulated marrow spaces.                             */
 /*                                                                      */
+/* The largest bone component touching the edge of the volume is kept,  */
+/* and any marrow space that can't reach the edge of the volume is      */
+/* filled in.  Both steps use a single-pass union-find labelling of the */
+/* volume, so the cost is O(voxels) regardless of how many components   */
+/* the image contains.                                                  */
+/*                                                                      */
 /************************************************************************/
 
 #include "vtkImagePurify.h"
@@ -12,564 +18,342 @@
 #include "vtkImageData.h"
 #include "vtkObjectFactory.h"
 
-#define max(a,b) ((a) > (b) ? (a) : (b))
-#define min(a,b) ((a) < (b) ? (a) : (b))
+#include <vector>
 
 
-vtkCxxRevisionMacro(vtkImagePurify, "$Revision: 1.3 $");  // this is needed to prevent vtable problems
+vtkCxxRevisionMacro(vtkImagePurify, "$Revision: 1.4 $");  // this is needed to prevent vtable problems
 vtkStandardNewMacro(vtkImagePurify);
 
-// The switch statement in Execute will call this method with
-// the appropriate input type (IT). Note that this example assumes
-// that the output data type is the same as the input data type.
-// This is not always the case.
-template <class IT>
-void vtkImagePurifyExecute(vtkImagePurify* self, vtkImageData* input,
-                                        vtkImageData* output,
-                                        IT* inPtr, IT* outPtr)
+//----------------------------------------------------------------------------
+vtkImagePurify::vtkImagePurify()
 {
-  int x, y, z;
-  float Threshold;
-  unsigned char *scrap, *pure;
-  int *xbound, *ybound, *zbound;
-  vtkIdType outInc0, outInc1, outInc2;
-  long index, numbounds;
-  int dims[3]; 
-
-  input->GetDimensions(dims);
-  output->GetIncrements(outInc0, outInc1, outInc2);
-  int size = dims[0]*dims[1]*dims[2];
-  
-  Threshold = self->GetThreshold();
+  this->Threshold = 0.0;
+  this->PurifyError = 0;
+  this->Connectivity = 26;
+}
 
-  self->SetPurifyError(0);
-  
-  if (input->GetScalarType() != output->GetScalarType())
+//----------------------------------------------------------------------------
+void vtkImagePurify::SetConnectivity(int connectivity)
+{
+  connectivity = (connectivity < 16 ? 6 : 26);
+  if (this->Connectivity != connectivity)
     {
-    vtkGenericWarningMacro(<< "Execute: input ScalarType, " << input->GetScalarType()
-    << ", must match out ScalarType " << output->GetScalarType());
-    self->SetPurifyError(-1);
-    return;
+    this->Connectivity = connectivity;
+    this->Modified();
     }
- 
-  // allocate space for various arrays
-  scrap = new unsigned char[size];
-  pure = new unsigned char[size];
-  xbound = new int[size]; 
-  ybound = new int[size]; 
-  zbound = new int[size]; 
+}
 
-  // create two binarized copies of image
-  for (index = 0; index < size; index++)
-  {
-    if (inPtr[index] >= Threshold)
-      scrap[index] = outPtr[index] = static_cast<IT>(255);
-    else
-      scrap[index] = outPtr[index] = 0;
-  }
-  
-  // search for first non-zero value on first edge of cube
-  numbounds = 0;
-  x = y = z = 0;
-  while ( ( y < dims[1] ) && ( numbounds == 0 ) )
+//----------------------------------------------------------------------------
+// Union-find over provisional component labels.  Label 0 is reserved for
+// voxels that don't belong to the set being labelled.
+class vtkImagePurifyComponents
+{
+public:
+  std::vector<unsigned int> Parent;
+  std::vector<vtkIdType> Size;
+
+  void Initialize()
     {
-    while ( ( x < dims[0] ) && ( numbounds == 0 ) )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      x++;
-      }
-    x = 0;
-    y++;
+    this->Parent.assign(1, 0);
+    this->Size.assign(1, 0);
     }
- 
-  // search for first non-zero value on second edge of cube
-  x = y = 0; z = dims[2] - 1;
-  while ( ( y < dims[1] ) && ( numbounds == 0 ) )
+
+  unsigned int NewLabel()
     {
-    while ( ( x < dims[0] ) && ( numbounds == 0 ) )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      x++;
-      }
-    x = 0;
-    y++;
+    unsigned int label = static_cast<unsigned int>(this->Parent.size());
+    this->Parent.push_back(label);
+    this->Size.push_back(0);
+    return label;
     }
 
-  // search for first non-zero value on third edge of cube
-  x = z = y = 0; 
-  while ( ( z < dims[2] ) && ( numbounds == 0 ) )
+  unsigned int Find(unsigned int label)
     {
-    while ( ( x < dims[0] ) && ( numbounds == 0 ) )
+    // path halving
+    while (this->Parent[label] != label)
       {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      x++;
+      this->Parent[label] = this->Parent[this->Parent[label]];
+      label = this->Parent[label];
       }
-    x = 0;
-    z++;
+    return label;
     }
 
-  // search for first non-zero value on fourth edge of cube
-  x = z = 0; y = dims[1] - 1; 
-  while ( ( z < dims[2] ) && ( numbounds == 0 ) )
+  // Merge two components, returning the new root.  The lower label always
+  // wins so that roots don't depend on merge order.
+  unsigned int Union(unsigned int a, unsigned int b)
     {
-    while ( ( x < dims[0] ) && ( numbounds == 0 ) )
+    a = this->Find(a);
+    b = this->Find(b);
+    if (a == b)
       {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      x++;
+      return a;
+      }
+    if (b < a)
+      {
+      unsigned int t = a; a = b; b = t;
       }
-    x = 0;
-    z++;
+    this->Parent[b] = a;
+    this->Size[a] += this->Size[b];
+    return a;
     }
+};
 
-  // search for first non-zero value on fifth edge of cube
-  x = z = y = 0; 
-  while ( ( z < dims[2] ) && ( numbounds == 0 ) )
+//----------------------------------------------------------------------------
+// Label every voxel whose mask value equals 'value', using either 6 or 26
+// connectivity.  Each voxel is visited once and only compared against its
+// already-visited neighbours; component sizes are accumulated on the fly.
+static void vtkImagePurifyLabel(const unsigned char *mask, unsigned char value,
+                                int connectivity, int dims[3],
+                                unsigned int *labels,
+                                vtkImagePurifyComponents &components)
+{
+  vtkIdType inc1 = dims[0];
+  vtkIdType inc2 = static_cast<vtkIdType>(dims[0]) * dims[1];
+  int offsets[13][3];
+  int numOffsets = 0;
+  int dx, dy, dz, n;
+
+  // neighbours that precede a voxel in raster order
+  if (connectivity == 6)
     {
-    while ( ( y < dims[1] ) && ( numbounds == 0 ) )
+    int causal[3][3] = {{-1, 0, 0}, {0, -1, 0}, {0, 0, -1}};
+    for (n = 0; n < 3; n++)
       {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      y++;
+      offsets[n][0] = causal[n][0];
+      offsets[n][1] = causal[n][1];
+      offsets[n][2] = causal[n][2];
       }
-    y = 0;
-    z++;
+    numOffsets = 3;
     }
-
-  // search for first non-zero value on sixth edge of cube
-  z = y = 0; x = dims[0] - 1; 
-  while ( ( z < dims[2] ) && ( numbounds == 0 ) )
+  else
     {
-    while ( ( y < dims[1] ) && ( numbounds == 0 ) )
+    for (dz = -1; dz <= 0; dz++)
       {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
+      for (dy = -1; dy <= 1; dy++)
         {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
+        for (dx = -1; dx <= 1; dx++)
+          {
+          if (dz == 0 && (dy > 0 || (dy == 0 && dx >= 0)))
+            {
+            continue;
+            }
+          offsets[numOffsets][0] = dx;
+          offsets[numOffsets][1] = dy;
+          offsets[numOffsets][2] = dz;
+          numOffsets++;
+          }
         }
-      y++;
       }
-    y = 0;
-    z++;
     }
 
-//////////////////////////////////////////////////////////////////////////
-  if ( numbounds == 0 ) {
-    vtkGenericWarningMacro(<< "Execute: no bounding edge voxel detected!");
-    self->SetPurifyError(-1);
-  }
-  
-//////////////////////////////////////////////////////////////////////////
-  long xstart, ystart, zstart, xend, yend, zend, numvox, numvox_max = 0;
-  long xi, yi, zi;
+  components.Initialize();
 
-  while ( numbounds > 0 )
+  vtkIdType index = 0;
+  for (int z = 0; z < dims[2]; z++)
     {
-    while ( numbounds > 0 )
+    for (int y = 0; y < dims[1]; y++)
       {
-      numbounds--;
-      x = xbound[numbounds];
-      y = ybound[numbounds];
-      z = zbound[numbounds];
-      
-      outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(253);
-      xstart = max(x - 1, 0);
-      xend   = min(x + 1, dims[0] - 1);
-      ystart = max(y - 1, 0);
-      yend   = min(y + 1, dims[1] - 1);
-      zstart = max(z - 1, 0);
-      zend   = min(z + 1, dims[2] - 1);
-  
-      for ( zi = zstart; zi <= zend; zi++ )
+      for (int x = 0; x < dims[0]; x++, index++)
         {
-        for ( yi = ystart; yi <= yend; yi++ )
+        if (mask[index] != value)
+          {
+          labels[index] = 0;
+          continue;
+          }
+
+        unsigned int label = 0;
+        for (n = 0; n < numOffsets; n++)
           {
-          for ( xi = xstart; xi <= xend; xi++ )
+          int xn = x + offsets[n][0];
+          int yn = y + offsets[n][1];
+          int zn = z + offsets[n][2];
+          if (xn < 0 || xn >= dims[0] || yn < 0 || yn >= dims[1] || zn < 0)
             {
-            if ( outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] == static_cast<IT>(255) )
-              {
-              outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] = static_cast<IT>(254);
-              xbound[numbounds] = xi;
-              ybound[numbounds] = yi;
-              zbound[numbounds] = zi;
-              numbounds++;
-              }
+            continue;
+            }
+          unsigned int neighbour = labels[zn*inc2 + yn*inc1 + xn];
+          if (neighbour)
+            {
+            label = label ? components.Union(label, neighbour) : components.Find(neighbour);
             }
           }
-        }
-      }
-    numvox = 0;
-    for (zi = 0; zi < dims[2]; zi++) 
-      for (yi = 0; yi < dims[1]; yi++)
-        for (xi = 0; xi < dims[0]; xi++)
-        {
-        if ( outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] == static_cast<IT>(255) )
-          outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] = 0;
-        if ( outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] == static_cast<IT>(253) )
+        if (!label)
           {
-          outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] = static_cast<IT>(255);
-          numvox++;
+          label = components.NewLabel();
           }
+        labels[index] = label;
+        components.Size[label]++;
         }
-    
-    if ( numvox > numvox_max )
-      {
-      numvox_max = numvox;
-      index = 0;
-      for (zi = 0; zi < dims[2]; zi++) 
-        for (yi = 0; yi < dims[1]; yi++)
-          for (xi = 0; xi < dims[0]; xi++)
-            pure[index++] = outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0];
       }
+    }
+}
 
-    index = 0;
-    for (zi = 0; zi < dims[2]; zi++) 
-      for (yi = 0; yi < dims[1]; yi++)
-        for (xi = 0; xi < dims[0]; xi++)
-	{
-          if (outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] == static_cast<IT>(255))
-          {
-            outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] = 0;
-            scrap[index] = 0;
-          }
-	  if (outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] == 0)
-            outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] = scrap[index];
-	  index++;
-	}
+//----------------------------------------------------------------------------
+// Visit the voxels on the faces of the volume in the order the original
+// seed search used, and record for each component touching a face the
+// order in which it was first encountered (-1 for interior components).
+static void vtkImagePurifyRankEdgeComponents(int dims[3], unsigned int *labels,
+                                             vtkImagePurifyComponents &components,
+                                             std::vector<vtkIdType> &rank)
+{
+  vtkIdType inc1 = dims[0];
+  vtkIdType inc2 = static_cast<vtkIdType>(dims[0]) * dims[1];
+  vtkIdType count = 0;
+  int x, y, z, face;
 
-////////////////////////////////////////////////////////////////////////
+  rank.assign(components.Parent.size(), -1);
 
-  // search for first non-zero value on first edge of cube
-  numbounds = 0;
-  x = y = z = 0;
-  while ( ( y < dims[1] ) && ( numbounds == 0 ) )
+  for (face = 0; face < 6; face++)
     {
-    while ( ( x < dims[0] ) && ( numbounds == 0 ) )
+    int fixed = (face % 2 == 0) ? 0 : dims[face / 2 == 0 ? 2 : (face / 2 == 1 ? 1 : 0)] - 1;
+    int outer = (face < 2) ? dims[1] : dims[2];
+    int inner = (face < 4) ? dims[0] : dims[1];
+    for (int i = 0; i < outer; i++)
       {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
+      for (int j = 0; j < inner; j++)
         {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      x++;
-      }
-    x = 0;
-    y++;
-    }
-  
-  // search for first non-zero value on second edge of cube
-  x = y = 0; z = dims[2] - 1;
-  while ( ( y < dims[1] ) && ( numbounds == 0 ) )
-    {
-    while ( ( x < dims[0] ) && ( numbounds == 0 ) )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
+        if (face < 2)
+          {
+          x = j; y = i; z = fixed;
+          }
+        else if (face < 4)
+          {
+          x = j; y = fixed; z = i;
+          }
+        else
+          {
+          x = fixed; y = j; z = i;
+          }
+        unsigned int label = labels[z*inc2 + y*inc1 + x];
+        if (label)
+          {
+          label = components.Find(label);
+          if (rank[label] < 0)
+            {
+            rank[label] = count++;
+            }
+          }
         }
-      x++;
       }
-    x = 0;
-    y++;
     }
+}
 
-  // search for first non-zero value on third edge of cube
-  x = z = y = 0; 
-  while ( ( z < dims[2] ) && ( numbounds == 0 ) )
-    {
-    while ( ( x < dims[0] ) && ( numbounds == 0 ) )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      x++;
-      }
-    x = 0;
-    z++;
-    }
+// The switch statement in Execute will call this method with
+// the appropriate input type (IT). Note that this example assumes
+// that the output data type is the same as the input data type.
+// This is not always the case.
+template <class IT>
+void vtkImagePurifyExecute(vtkImagePurify* self, vtkImageData* input,
+                                        vtkImageData* output,
+                                        IT* inPtr, IT* outPtr)
+{
+  int x, y, z;
+  float Threshold;
+  unsigned char *mask;
+  unsigned int *labels;
+  vtkIdType outInc0, outInc1, outInc2;
+  vtkIdType index, size;
+  int dims[3];
+  int connectivity;
+  vtkImagePurifyComponents components;
+  std::vector<vtkIdType> rank;
 
-  // search for first non-zero value on fourth edge of cube
-  x = z = 0; y = dims[1] - 1; 
-  while ( ( z < dims[2] ) && ( numbounds == 0 ) )
-    {
-    while ( ( x < dims[0] ) && ( numbounds == 0 ) )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      x++;
-      }
-    x = 0;
-    z++;
-    }
+  input->GetDimensions(dims);
+  output->GetIncrements(outInc0, outInc1, outInc2);
+  size = static_cast<vtkIdType>(dims[0])*dims[1]*dims[2];
 
-  // search for first non-zero value on fifth edge of cube
-  x = z = y = 0; 
-  while ( ( z < dims[2] ) && ( numbounds == 0 ) )
-    {
-    while ( ( y < dims[1] ) && ( numbounds == 0 ) )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      y++;
-      }
-    y = 0;
-    z++;
-    }
+  Threshold = self->GetThreshold();
+  connectivity = self->GetConnectivity();
 
-  // search for first non-zero value on sixth edge of cube
-  z = y = 0; x = dims[0] - 1; 
-  while ( ( z < dims[2] ) && ( numbounds == 0 ) )
-    {
-    while ( ( y < dims[1] ) && ( numbounds == 0 ) )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == static_cast<IT>(255) )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = static_cast<IT>(254);
-        xbound[0] = x; ybound[0] = y; zbound[0] = z;
-        numbounds = 1;
-        }
-      y++;
-      }
-    y = 0;
-    z++;
-    }
-    }   
-////////////////////////////////////////////////////////////////////////
+  self->SetPurifyError(0);
 
-  index = 0;
-  for (zi = 0; zi < dims[2]; zi++) 
-    for (yi = 0; yi < dims[1]; yi++)
-      for (xi = 0; xi < dims[0]; xi++)
-        outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] = pure[index++];
-  
-  numbounds = 0;
-  z = 0;
-  for ( y = 0; y < dims[1]; y++ )
+  if (input->GetScalarType() != output->GetScalarType())
     {
-    for ( x = 0; x < dims[0]; x++ )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
+    vtkGenericWarningMacro(<< "Execute: input ScalarType, " << input->GetScalarType()
+    << ", must match out ScalarType " << output->GetScalarType());
+    self->SetPurifyError(-1);
+    return;
     }
 
-  z = dims[2] - 1;
-  for ( y = 0; y < dims[1]; y++ )
+  if (size >= static_cast<vtkIdType>(VTK_UNSIGNED_INT_MAX))
     {
-    for ( x = 0; x < dims[0]; x++ )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
+    vtkGenericWarningMacro(<< "Execute: image is too large to purify");
+    self->SetPurifyError(-1);
+    return;
     }
 
-  y = 0;
-  for ( z = 0; z < dims[2]; z++ )
+  // allocate space for various arrays
+  mask = new unsigned char[size];
+  labels = new unsigned int[size];
+
+  // binarize image
+  for (index = 0; index < size; index++)
     {
-    for ( x = 0; x < dims[0]; x++ )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
+    mask[index] = (inPtr[index] >= Threshold) ? 1 : 0;
     }
 
+//////////////////////////////////////////////////////////////////////////
+  // find the largest bone component touching the edge of the volume.  Ties
+  // are broken in favour of the component encountered first along the edges
+  vtkImagePurifyLabel(mask, 1, connectivity, dims, labels, components);
+  vtkImagePurifyRankEdgeComponents(dims, labels, components, rank);
 
-  y = dims[1] - 1;
-  for ( z = 0; z < dims[2]; z++ )
+  unsigned int best = 0;
+  for (unsigned int label = 1; label < components.Parent.size(); label++)
     {
-    for ( x = 0; x < dims[0]; x++ )
+    if (rank[label] < 0)
       {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
+      continue;
+      }
+    if (best == 0 || components.Size[label] > components.Size[best] ||
+        (components.Size[label] == components.Size[best] && rank[label] < rank[best]))
+      {
+      best = label;
       }
     }
 
-  x = 0;
-  for ( z = 0; z < dims[2]; z++ )
+  if (best == 0)
     {
-    for ( y = 0; y < dims[1]; y++ )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
+    vtkGenericWarningMacro(<< "Execute: no bounding edge voxel detected!");
+    self->SetPurifyError(-1);
     }
 
-  x = dims[0] - 1;
-  for ( z = 0; z < dims[2]; z++ )
+  for (index = 0; index < size; index++)
     {
-    for ( y = 0; y < dims[1]; y++ )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
+    mask[index] = (labels[index] && components.Find(labels[index]) == best) ? 1 : 0;
     }
 
-  while ( numbounds > 0 )
+//////////////////////////////////////////////////////////////////////////
+  // now find marrow spaces that connect to the edge of the volume.  Marrow
+  // uses the complementary connectivity to the bone so that the two phases
+  // can't leak through each other
+  vtkImagePurifyLabel(mask, 0, (connectivity == 6) ? 26 : 6, dims, labels, components);
+  vtkImagePurifyRankEdgeComponents(dims, labels, components, rank);
+
+  // write the result: bone and encapsulated marrow become 1, marrow
+  // connected to the edge of the volume becomes 0
+  index = 0;
+  for (z = 0; z < dims[2]; z++)
     {
-    numbounds--;
-    x = xbound[numbounds];
-    y = ybound[numbounds];
-    z = zbound[numbounds];
-    outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 2;
-    if ( x > 0 )
-      {
-      if ( outPtr[z*outInc2 + y*outInc1 + (x-1)*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + y*outInc1 + (x-1)*outInc0] = 1;
-        xbound[numbounds] = x - 1;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
-    if ( x < dims[0] - 1 )
+    for (y = 0; y < dims[1]; y++)
       {
-      if ( outPtr[z*outInc2 + y*outInc1 + (x+1)*outInc0] == 0 )
+      for (x = 0; x < dims[0]; x++, index++)
         {
-        outPtr[z*outInc2 + y*outInc1 + (x+1)*outInc0] = 1;
-        xbound[numbounds] = x + 1;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
-    if ( y > 0 )
-      {
-      if ( outPtr[z*outInc2 + (y-1)*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + (y-1)*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y - 1;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
-    if ( y < dims[1] - 1 )
-      {
-      if ( outPtr[z*outInc2 + (y+1)*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[z*outInc2 + (y+1)*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y + 1;
-        zbound[numbounds] = z;
-        numbounds++;
-        }
-      }
-    if ( z > 0 )
-      {
-      if ( outPtr[(z-1)*outInc2 + y*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[(z-1)*outInc2 + y*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z - 1;
-        numbounds++;
-        }
-      }
-    if ( z < dims[2] - 1 )
-      {
-      if ( outPtr[(z+1)*outInc2 + y*outInc1 + x*outInc0] == 0 )
-        {
-        outPtr[(z+1)*outInc2 + y*outInc1 + x*outInc0] = 1;
-        xbound[numbounds] = x;
-        ybound[numbounds] = y;
-        zbound[numbounds] = z + 1;
-        numbounds++;
+        if (mask[index] || rank[components.Find(labels[index])] < 0)
+          {
+          outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 1;
+          }
+        else
+          {
+          outPtr[z*outInc2 + y*outInc1 + x*outInc0] = 0;
+          }
         }
       }
     }
 
-  for (zi = 0; zi < dims[2]; zi++) 
-    for (yi = 0; yi < dims[1]; yi++)
-      for (xi = 0; xi < dims[0]; xi++)
-      {
-        if ((outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] == 0) || (outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] == static_cast<IT>(255)))
-	  outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] = 1;
-        if (outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] == 2)
-	  outPtr[zi*outInc2 + yi*outInc1 + xi*outInc0] = 0;
-      }
-
 //////////////////////////////////////////////////////////////////////////
   // free arrays
-  delete [] scrap;
-  delete [] pure;
-  delete [] xbound;
-  delete [] ybound;
-  delete [] zbound;
+  delete [] mask;
+  delete [] labels;
 }
 
 void vtkImagePurify::SimpleExecute(vtkImageData* input,
@@ -598,5 +382,6 @@ void vtkImagePurify::PrintSelf(ostream& os, vtkIndent indent)
 {
   vtkSimpleImageToImageFilter::PrintSelf(os,indent);
   os << indent << "Threshold: " << this->Threshold << "\n";
+  os << indent << "Connectivity: " << this->Connectivity << "\n";
   os << indent << "Error value: " << this->PurifyError << "\n";
 }
@@ -15,10 +15,21 @@ public:
   vtkGetMacro(PurifyError, int);
   vtkSetMacro(PurifyError, int);
 
+  // Description:
+  // Set the connectivity used to find bone components, either 6 (faces)
+  // or 26 (faces, edges and corners).  Marrow spaces are found using the
+  // complementary connectivity.  The default is 26.  Other values are
+  // rounded to whichever of 6 or 26 is nearer.
+  virtual void SetConnectivity(int connectivity);
+  vtkGetMacro(Connectivity, int);
+  void SetConnectivityTo6() { this->SetConnectivity(6); }
+  void SetConnectivityTo26() { this->SetConnectivity(26); }
+
 protected:
   float Threshold;
+  int Connectivity;
 
-  vtkImagePurify() {};
+  vtkImagePurify();
   ~vtkImagePurify() {};
 
   int PurifyError;
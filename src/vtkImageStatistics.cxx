@@ -6,6 +6,7 @@
 #include "vtkInformation.h"
 #include "vtkInformationVector.h"
 #include "vtkStreamingDemandDrivenPipeline.h"
+#include "vtkMultiThreader.h"
 
 #include <math.h>
 
@@ -15,6 +16,9 @@ vtkStandardNewMacro(vtkImageStatistics);
 #define SB3_DENSITY 1850.0
 #define BMC_FRACTION 0.58
 
+// upper limit on the memory used by the per-thread histograms
+#define VTK_IMAGE_STATISTICS_MAX_HISTOGRAM_MEMORY (256*1024*1024)
+
 //----------------------------------------------------------------------------
 // Constructor sets default values
 vtkImageStatistics::vtkImageStatistics()
@@ -52,12 +56,16 @@ vtkImageStatistics::vtkImageStatistics()
   this->BoneMineralConst = SB3_DENSITY * BMC_FRACTION;
 
   this->SetNumberOfInputPorts(2);
+
+  this->Threader = vtkMultiThreader::New();
+  this->NumberOfThreads = this->Threader->GetNumberOfThreads();
 }
 
 
 //----------------------------------------------------------------------------
 vtkImageStatistics::~vtkImageStatistics()
 {
+  this->Threader->Delete();
 }
 
 //----------------------------------------------------------------------------
@@ -85,13 +93,63 @@ double vtkImageStatistics::GetThresholdedVolume()
 
 
 //----------------------------------------------------------------------------
-// This templated function executes the filter for any type of data.
+// Partial results for the rows handled by one thread.  The mean and
+// variance are kept as a running mean and a sum of squared deviations from
+// it (M2), which are merged with Chan et al.'s pairwise update rather than
+// being derived from a sum of squares, so that no precision is lost on
+// large volumes.
+struct vtkImageStatisticsSums
+{
+  vtkIdType Count;
+  double Mean[4];
+  double M2[4];
+  double Min[4];
+  double Max[4];
+  int MaxPosition[3];
+  long BoneVoxelCount;
+  double BoneMineral;
+  double ThresholdedBoneMineral;
+  int *Histogram;
+};
+
+struct vtkImageStatisticsThreadStruct
+{
+  vtkImageStatistics *Filter;
+  vtkImageData *InData;
+  void *InPtr;
+  vtkImageData *OutData;
+  int *OutExt;
+  vtkImageStatisticsSums *Sums;
+};
+
+//----------------------------------------------------------------------------
+// Merge the statistics of n values with mean 'mean' and squared deviations
+// 'm2' into a running count/mean/M2.
+static inline void vtkImageStatisticsMerge(vtkIdType count, double &mean,
+                                           double &m2, vtkIdType n,
+                                           double nmean, double nm2)
+{
+  vtkIdType total = count + n;
+  if (n == 0)
+    {
+    return;
+    }
+  double delta = nmean - mean;
+  mean += delta * n / total;
+  m2 += nm2 + delta * delta * ((double)count * n / total);
+}
+
+//----------------------------------------------------------------------------
+// This templated function executes the filter for any type of data, over
+// rows firstRow..lastRow-1 of the extent, where row r is y = r % ny,
+// z = r / ny.
 template <class T>
 void vtkImageStatisticsExecute(vtkImageStatistics *self,
                                vtkImageData *inData, T *inPtr,
                                vtkImageData *outData, int *outPtr,
-                               double Min[4], double Max[4], double Mean[4], double StandardDeviation[4],
-                               vtkIdType *VoxelCount, int outExt[6])
+                               int outExt[6], vtkIdType firstRow,
+                               vtkIdType lastRow, int threadId,
+                               vtkImageStatisticsSums *sums)
 {
   int idX, idY, idZ, idxC;
   int iter, pmin0, pmax0;
@@ -100,180 +158,195 @@ void vtkImageStatisticsExecute(vtkImageStatistics *self,
   int *outPtrC;
   int numC, outIdx, *outExtent;
   vtkIdType *outIncs;
-  
-  double *origin, *spacing, *inspacing;
+  vtkIdType row, ny;
+  double *origin, *spacing;
+  double value, bin;
   unsigned long count = 0;
   unsigned long target;
-  double sumSqr[4], variance;
-  // max value index
-  int imax[4];
-
-  // variables used to compute statistics (filter handles max 4 components)
-  double sum[4];
-  for (int i=0; i<4; i++) {
-      sum[i] = 0.0;
-      Min[i] = VTK_DOUBLE_MAX;
-      Max[i] = VTK_DOUBLE_MIN;
-      imax[i] = VTK_INT_MIN;
-      sumSqr[i] = 0.0;
-      StandardDeviation[i] = 0.0;
-  }
-  *VoxelCount = 0;
-  
+
+  // span sums, taken relative to the first value of the span
+  double shift[4], spanSum[4], spanSumSqr[4];
+
   vtkImageStencilData *stencil = self->GetStencil();
+  int reverseStencil = self->GetReverseStencil();
 
-  // Get information to march through data 
+  // Get information to march through data
   numC = inData->GetNumberOfScalarComponents();
 
-  // Zero count in every bin
-  // TODO: next two lines should be moved elsewhere to allow memory streaming to operate correctly
-  memset((void *)outPtr, 0, (outExt[1]-outExt[0] + 1)*(outExt[3] - outExt[2] + 1)*(outExt[5] - outExt[4] + 1)*sizeof(int)*numC);
-
   inData->GetIncrements(inInc0, inInc1, inInc2);
   outExtent = outData->GetExtent();
   outIncs = outData->GetIncrements();
   origin = outData->GetOrigin();
   spacing = outData->GetSpacing();
-  inspacing = inData->GetSpacing();
-  target = (unsigned long)((outExt[3] - outExt[2] + 1)*(outExt[1] - outExt[0] +1)/50.0);
+  ny = outExt[3] - outExt[2] + 1;
+  target = (unsigned long)((lastRow - firstRow)/50.0);
   target++;
 
   // Initialize bone density variables
-  double BoneValue = self->GetBoneValue();
+  double BVFThreshold = self->GetBVFThreshold();
   double WaterValue = self->GetWaterValue();
   double LowerExclusionValue = self->GetLowerExclusionValue();
   double UpperExclusionValue = self->GetUpperExclusionValue();
-  self->BoneMineralMass = 0.0;
-  self->ThresholdedBoneMineralMass = 0.0;
-  double dVoxelVolume = inspacing[0] * inspacing[1] * inspacing[2] / 1000.0;  // measured in cm cubed
-  double dMultiplier;
-
-  if (BoneValue != 0)
-    dMultiplier = self->GetBoneMineralConst() * dVoxelVolume / (BoneValue - WaterValue);
-  else
-    dMultiplier = 0.0;
 
-
-  // Loop through input pixels
-  for (idZ = outExt[4]; !self->GetAbortExecute() && idZ <= outExt[5]; idZ++)
+  // Loop through input rows
+  for (row = firstRow; !self->GetAbortExecute() && row < lastRow; row++)
     {
-    for (idY = outExt[2]; idY <= outExt[3]; idY++)
+    idY = outExt[2] + (int)(row % ny);
+    idZ = outExt[4] + (int)(row / ny);
+
+    if (!threadId)
       {
-      if (!(count%target)) 
+      if (!(count%target))
         {
         self->UpdateProgress((double)count/(50.0*target));
         }
       count++;
+      }
+
+    // loop over stencil sub-extents
+    iter = 0;
+    if (reverseStencil)
+      { // flag that we want the complementary extents
+      iter = -1;
+      }
 
-      // loop over stencil sub-extents
-      iter = 0;
-      if (self->GetReverseStencil())
-        { // flag that we want the complementary extents
-        iter = -1;
+    pmin0 = outExt[0];
+    pmax0 = outExt[1];
+    while ((stencil != 0 &&
+            stencil->GetNextExtent(pmin0,pmax0,outExt[0],outExt[1],idY,idZ,iter)) ||
+           (stencil == 0 && iter++ == 0))
+      {
+      if (pmin0 > pmax0)
+        {
+        continue;
         }
 
-      pmin0 = outExt[0];
-      pmax0 = outExt[1];
-      while ((stencil != 0 && 
-              stencil->GetNextExtent(pmin0,pmax0,outExt[0],outExt[1],idY,idZ,iter)) ||
-             (stencil == 0 && iter++ == 0))
+      // set up pointer for sub extent
+      tempPtr = inPtr + (inInc2*(idZ - outExt[4]) +
+                         inInc1*(idY - outExt[2]) +
+                         numC*(pmin0 - outExt[0]));
+
+      for (idxC = 0; idxC < numC; ++idxC)
         {
-        // set up pointer for sub extent
-        tempPtr = inPtr + (inInc2*(idZ - outExt[4]) +
-                           inInc1*(idY - outExt[2]) +
-                           numC*(pmin0 - outExt[0]));
+        shift[idxC] = tempPtr[idxC];
+        spanSum[idxC] = 0.0;
+        spanSumSqr[idxC] = 0.0;
+        }
 
-        // accumulate over the sub extent
-        for (idX = pmin0; idX <= pmax0; idX++)
+      // accumulate over the sub extent
+      for (idX = pmin0; idX <= pmax0; idX++)
+        {
+        // find the bin for this pixel.
+        outPtrC = sums->Histogram;
+        for (idxC = 0; idxC < numC; ++idxC)
           {
-          // find the bin for this pixel.
-          outPtrC = outPtr;
-          (*VoxelCount)++;
-          for (idxC = 0; idxC < numC; ++idxC)
+          value = *tempPtr++;
+
+          // Gather statistics
+          spanSum[idxC] += value - shift[idxC];
+          spanSumSqr[idxC] += (value - shift[idxC]) * (value - shift[idxC]);
+          if (value > sums->Max[idxC])
             {
-            // Gather statistics
-            sum[idxC]+= *tempPtr;
-            sumSqr[idxC]+= (*tempPtr * *tempPtr);
-            if (*tempPtr > Max[idxC])
-              {
-              Max[idxC] = *tempPtr;
-              imax[0] = idX;    // save the location of max value...
-              imax[1] = idY;    // hack, will not work if numC > 1
-              imax[2] = idZ;
-              }
-            else if (*tempPtr < Min[idxC])
+            sums->Max[idxC] = value;
+            if (!idxC)
               {
-              Min[idxC] = *tempPtr;
+              sums->MaxPosition[0] = idX;    // save the location of max value...
+              sums->MaxPosition[1] = idY;
+              sums->MaxPosition[2] = idZ;
               }
-            if (*tempPtr >= (self->GetBVFThreshold()))
-              (self->BoneVoxelCount)++;
-            if ((*tempPtr >= (LowerExclusionValue)) && (*tempPtr <= (UpperExclusionValue))) {
-              self->BoneMineralMass +=
-                (*tempPtr - WaterValue) * dMultiplier;
-	    }
-	// Next if bracket added for TM...
-            if ((*tempPtr >= (self->GetBVFThreshold())) && (*tempPtr >= (LowerExclusionValue)) && (*tempPtr <= (UpperExclusionValue))) {
-              self->ThresholdedBoneMineralMass +=
-                (*tempPtr - WaterValue) * dMultiplier;
-             }
-            // compute the index
-            outIdx = (int) floor((((double)*tempPtr++ - origin[idxC]) 
-                                  / spacing[idxC]));
-            if (!idxC && (outIdx < outExtent[idxC*2] || outIdx > outExtent[idxC*2+1]))
+            }
+          if (value < sums->Min[idxC])
+            {
+            sums->Min[idxC] = value;
+            }
+          if (value >= BVFThreshold)
+            {
+            sums->BoneVoxelCount++;
+            }
+          if (value >= LowerExclusionValue && value <= UpperExclusionValue)
+            {
+            sums->BoneMineral += value - WaterValue;
+            // thresholded mineral mass for TMD
+            if (value >= BVFThreshold)
               {
-              // Out of bin range
-              outPtrC = NULL;
-              break;
+              sums->ThresholdedBoneMineral += value - WaterValue;
               }
-            outPtrC += (outIdx - outExtent[idxC*2]) * outIncs[idxC];
             }
-          if (outPtrC)
+
+          // compute the index
+          bin = (value - origin[idxC]) / spacing[idxC];
+          outIdx = (int) bin;
+          if (outIdx > bin)
+            {
+            outIdx--;
+            }
+          if (!idxC && (outIdx < outExtent[idxC*2] || outIdx > outExtent[idxC*2+1]))
             {
-            ++(*outPtrC);
+            // Out of bin range
+            outPtrC = NULL;
+            tempPtr += numC - idxC - 1;
+            break;
             }
+          outPtrC += (outIdx - outExtent[idxC*2]) * outIncs[idxC];
           }
+        if (outPtrC)
+          {
+          ++(*outPtrC);
+          }
+        }
+
+      // fold the span into the running statistics
+      vtkIdType n = pmax0 - pmin0 + 1;
+      for (idxC = 0; idxC < numC; ++idxC)
+        {
+        vtkImageStatisticsMerge(sums->Count, sums->Mean[idxC], sums->M2[idxC],
+                                n, shift[idxC] + spanSum[idxC] / n,
+                                spanSumSqr[idxC] - spanSum[idxC] * spanSum[idxC] / n);
         }
+      sums->Count += n;
       }
     }
- 
-  // user aborted?
-  if (self->GetAbortExecute()) {
-    printf("Aborted!");
-    return;
-  }
-  
-  if (*VoxelCount) // avoid the div0
+}
+
+//----------------------------------------------------------------------------
+// Each thread takes a contiguous range of rows of the extent.
+VTK_THREAD_RETURN_TYPE vtkImageStatisticsThreadedExecute(void *arg)
+{
+  vtkMultiThreader::ThreadInfo *info =
+    static_cast<vtkMultiThreader::ThreadInfo *>(arg);
+  vtkImageStatisticsThreadStruct *str =
+    static_cast<vtkImageStatisticsThreadStruct *>(info->UserData);
+  int threadId = info->ThreadID;
+  int numThreads = info->NumberOfThreads;
+  int *ext = str->OutExt;
+  vtkIdType numRows = (vtkIdType)(ext[3] - ext[2] + 1) * (ext[5] - ext[4] + 1);
+  vtkIdType firstRow = numRows * threadId / numThreads;
+  vtkIdType lastRow = numRows * (threadId + 1) / numThreads;
+
+  if (firstRow >= lastRow)
     {
-    Mean[0] = sum[0] / (double)*VoxelCount;    
-    Mean[1] = sum[1] / (double)*VoxelCount;    
-    Mean[2] = sum[2] / (double)*VoxelCount;    
-
-    variance = sumSqr[0] / (double)(*VoxelCount-1) - ((double) *VoxelCount * Mean[0] * Mean[0] / (double) (*VoxelCount - 1));
-    StandardDeviation[0] = sqrt(variance);
-    variance = sumSqr[1] / (double)(*VoxelCount-1) - ((double) *VoxelCount * Mean[1] * Mean[1] / (double) (*VoxelCount - 1));
-    StandardDeviation[1] = sqrt(variance);
-    variance = sumSqr[2] / (double)(*VoxelCount-1) - ((double) *VoxelCount * Mean[2] * Mean[2] / (double) (*VoxelCount - 1));
-    StandardDeviation[2] = sqrt(variance);
+    return VTK_THREAD_RETURN_VALUE;
     }
-  else
+
+  switch (str->InData->GetScalarType())
     {
-    Mean[0] = Mean[1] = Mean[2] = 0.0;
-    StandardDeviation[0] = StandardDeviation[1] = StandardDeviation[2] = 0.0;
+    vtkTemplateMacro(vtkImageStatisticsExecute(str->Filter,
+                       str->InData, static_cast<VTK_TT *>(str->InPtr),
+                       str->OutData, static_cast<int *>(str->OutData->GetScalarPointer()),
+                       ext, firstRow, lastRow, threadId,
+                       &str->Sums[threadId]));
+    default:
+      vtkGenericWarningMacro(<< "Execute: Unknown ScalarType");
     }
 
-  self->SetMaxValuePosition(imax);
-
+  return VTK_THREAD_RETURN_VALUE;
 }
 
-        
-
 //----------------------------------------------------------------------------
 // This method is passed a input and output Data, and executes the filter
-// algorithm to fill the output from the input.
-// It just executes a switch statement to call the correct function for
-// the Datas data types.
-
-
+// algorithm to fill the output from the input.  The rows of the extent are
+// split between threads, each with its own statistics and histogram, and
+// the partial results are merged in row order at the end.
 int vtkImageStatistics::RequestData(
  vtkInformation* vtkNotUsed( request ),
   vtkInformationVector** inputVector,
@@ -315,20 +388,146 @@ int vtkImageStatistics::RequestData(
                   << " must be int\n");
     return 1;
     }
-  
-  switch (inData->GetScalarType())
+
+  int numC = inData->GetNumberOfScalarComponents();
+  int idx, idxC;
+
+  // Zero count in every bin
+  // TODO: next two lines should be moved elsewhere to allow memory streaming to operate correctly
+  vtkIdType histSize = (vtkIdType)(outExt[1]-outExt[0] + 1)*(outExt[3] - outExt[2] + 1)*(outExt[5] - outExt[4] + 1)*numC;
+  memset(outPtr, 0, histSize*sizeof(int));
+
+  // every thread but the first needs a histogram of its own, so limit the
+  // number of threads for very large (multi-component) histograms
+  vtkIdType numRows = (vtkIdType)(outExt[3] - outExt[2] + 1) * (outExt[5] - outExt[4] + 1);
+  int numThreads = this->NumberOfThreads;
+  if (numThreads > 1 && histSize*sizeof(int)*(numThreads - 1) > VTK_IMAGE_STATISTICS_MAX_HISTOGRAM_MEMORY)
     {
-    vtkTemplateMacro(vtkImageStatisticsExecute(this, 
-                       inData, static_cast<VTK_TT *>(inPtr), 
-                       outData, static_cast<int *>(outPtr),
-                       this->Min, this->Max,
-                       this->Mean,
-                       this->StandardDeviation, 
-                       &this->VoxelCount, outExt));
-    default:
-      vtkErrorMacro(<< "Execute: Unknown ScalarType");
-      return 1;
+    numThreads = 1 + (int)(VTK_IMAGE_STATISTICS_MAX_HISTOGRAM_MEMORY / (histSize*sizeof(int)));
+    }
+  if (numThreads > numRows)
+    {
+    numThreads = (int)numRows;
+    }
+  if (numThreads < 1)
+    {
+    numThreads = 1;
+    }
+
+  vtkImageStatisticsThreadStruct str;
+  str.Filter = this;
+  str.InData = inData;
+  str.InPtr = inPtr;
+  str.OutData = outData;
+  str.OutExt = outExt;
+  str.Sums = new vtkImageStatisticsSums[numThreads];
+  for (idx = 0; idx < numThreads; idx++)
+    {
+    vtkImageStatisticsSums *sums = &str.Sums[idx];
+    sums->Count = 0;
+    for (idxC = 0; idxC < 4; idxC++)
+      {
+      sums->Mean[idxC] = 0.0;
+      sums->M2[idxC] = 0.0;
+      sums->Min[idxC] = VTK_DOUBLE_MAX;
+      sums->Max[idxC] = VTK_DOUBLE_MIN;
+      }
+    sums->MaxPosition[0] = sums->MaxPosition[1] = sums->MaxPosition[2] = VTK_INT_MIN;
+    sums->BoneVoxelCount = 0;
+    sums->BoneMineral = 0.0;
+    sums->ThresholdedBoneMineral = 0.0;
+    sums->Histogram = idx ? new int[histSize] : static_cast<int *>(outPtr);
+    if (idx)
+      {
+      memset(sums->Histogram, 0, histSize*sizeof(int));
+      }
+    }
+
+  this->Threader->SetNumberOfThreads(numThreads);
+  this->Threader->SetSingleMethod(vtkImageStatisticsThreadedExecute, &str);
+  this->Threader->SingleMethodExecute();
+
+  // merge the partial results in row order
+  vtkImageStatisticsSums total = str.Sums[0];
+  for (idx = 1; idx < numThreads; idx++)
+    {
+    vtkImageStatisticsSums *sums = &str.Sums[idx];
+    for (idxC = 0; idxC < 4; idxC++)
+      {
+      vtkImageStatisticsMerge(total.Count, total.Mean[idxC], total.M2[idxC],
+                              sums->Count, sums->Mean[idxC], sums->M2[idxC]);
+      if (sums->Min[idxC] < total.Min[idxC])
+        {
+        total.Min[idxC] = sums->Min[idxC];
+        }
+      if (sums->Max[idxC] > total.Max[idxC])
+        {
+        total.Max[idxC] = sums->Max[idxC];
+        if (!idxC)
+          {
+          total.MaxPosition[0] = sums->MaxPosition[0];
+          total.MaxPosition[1] = sums->MaxPosition[1];
+          total.MaxPosition[2] = sums->MaxPosition[2];
+          }
+        }
+      }
+    total.Count += sums->Count;
+    total.BoneVoxelCount += sums->BoneVoxelCount;
+    total.BoneMineral += sums->BoneMineral;
+    total.ThresholdedBoneMineral += sums->ThresholdedBoneMineral;
+
+    int *hist = static_cast<int *>(outPtr);
+    for (vtkIdType bin = 0; bin < histSize; bin++)
+      {
+      hist[bin] += sums->Histogram[bin];
+      }
+    delete [] sums->Histogram;
+    }
+  delete [] str.Sums;
+
+  // user aborted?
+  if (this->GetAbortExecute())
+    {
+    printf("Aborted!");
+    return 1;
+    }
+
+  // bone mineral mass is linear in the voxel values, so it is scaled once
+  double *inspacing = inData->GetSpacing();
+  double dVoxelVolume = inspacing[0] * inspacing[1] * inspacing[2] / 1000.0;  // measured in cm cubed
+  double dMultiplier;
+
+  if (this->BoneValue != 0)
+    dMultiplier = this->BoneMineralConst * dVoxelVolume / (this->BoneValue - this->WaterValue);
+  else
+    dMultiplier = 0.0;
+
+  this->BoneMineralMass = total.BoneMineral * dMultiplier;
+  this->ThresholdedBoneMineralMass = total.ThresholdedBoneMineral * dMultiplier;
+  this->BoneVoxelCount = total.BoneVoxelCount;
+  this->VoxelCount = total.Count;
+
+  for (idxC = 0; idxC < 4; idxC++)
+    {
+    this->Min[idxC] = total.Min[idxC];
+    this->Max[idxC] = total.Max[idxC];
+    }
+
+  for (idxC = 0; idxC < 3; idxC++)
+    {
+    this->Mean[idxC] = total.Mean[idxC];
+    if (total.Count > 1)
+      {
+      this->StandardDeviation[idxC] = sqrt(total.M2[idxC] / (double)(total.Count - 1));
+      }
+    else
+      {
+      this->StandardDeviation[idxC] = 0.0;
+      }
     }
+
+  this->SetMaxValuePosition(total.MaxPosition);
+
   if (this->VoxelCount)
   {
     this->Total[0] = this->Mean[0]*this->VoxelCount;
@@ -378,6 +577,7 @@ void vtkImageStatistics::PrintSelf(ostream& os, vtkIndent indent)
   os << indent << "LowerExclusionValue: " << this->LowerExclusionValue << "\n";
   os << indent << "UpperExclusionValue: " << this->UpperExclusionValue << "\n";
   os << indent << "Stencil: " << this->GetStencil() << "\n";
+  os << indent << "NumberOfThreads: " << this->NumberOfThreads << "\n";
   os << indent << "ReverseStencil: " << (this->ReverseStencil ?
                                          "On\n" : "Off\n");
 
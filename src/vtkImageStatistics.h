@@ -22,6 +22,7 @@
 #include "MicroViewConfigure.h"
 
 class vtkImageStencilData;
+class vtkMultiThreader;
 
 class VTK_MicroView_EXPORT vtkImageStatistics : public vtkImageAccumulate
 {
@@ -49,6 +50,12 @@ public:
   vtkSetVector3Macro(MaxValuePosition, int);
   vtkGetVector3Macro(MaxValuePosition, int);
 
+  // Description:
+  // Get/Set the number of threads to create when computing the
+  // statistics.  The rows of the image are split between the threads.
+  vtkSetClampMacro(NumberOfThreads, int, 1, VTK_MAX_THREADS);
+  vtkGetMacro(NumberOfThreads, int);
+
   long int BoneVoxelCount;
   long int GetBoneVoxelCount() { return BoneVoxelCount; }
   double BoneMineralMass;
@@ -78,6 +85,8 @@ protected:
   double LowerExclusionValue;
   double UpperExclusionValue;
   double BoneMineralConst;
+  int NumberOfThreads;
+  vtkMultiThreader *Threader;
 
 private:
   vtkImageStatistics(const vtkImageStatistics&);  // Not implemented.
@@ -0,0 +1,49 @@
+/************************************************************************/
+/* vtkImageStencilTranslator.cxx                                        */
+/*                                                                      */
+/* Moves a stencil by a whole number of voxels.  Only the row extents   */
+/* change, so this costs one pass over the stencil's rows.              */
+/*                                                                      */
+/************************************************************************/
+
+#include "vtkImageStencilTranslator.h"
+
+#include "vtkImageStencilData.h"
+#include "vtkObjectFactory.h"
+
+vtkStandardNewMacro(vtkImageStencilTranslator);
+
+//----------------------------------------------------------------------------
+void vtkImageStencilTranslator::Translate(vtkImageStencilData *input,
+                                          int dx, int dy, int dz,
+                                          vtkImageStencilData *output)
+{
+  int extent[6];
+  input->GetExtent(extent);
+
+  int outExtent[6];
+  outExtent[0] = extent[0] + dx;
+  outExtent[1] = extent[1] + dx;
+  outExtent[2] = extent[2] + dy;
+  outExtent[3] = extent[3] + dy;
+  outExtent[4] = extent[4] + dz;
+  outExtent[5] = extent[5] + dz;
+
+  output->SetSpacing(input->GetSpacing());
+  output->SetOrigin(input->GetOrigin());
+  output->SetExtent(outExtent);
+  output->AllocateExtents();
+
+  for (int z = extent[4]; z <= extent[5]; z++)
+    {
+    for (int y = extent[2]; y <= extent[3]; y++)
+      {
+      int iter = 0;
+      int r1, r2;
+      while (input->GetNextExtent(r1, r2, extent[0], extent[1], y, z, iter))
+        {
+        output->InsertNextExtent(r1 + dx, r2 + dx, y + dy, z + dz);
+        }
+      }
+    }
+}
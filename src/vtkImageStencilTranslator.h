@@ -0,0 +1,36 @@
+#ifndef __vtkImageStencilTranslator_h
+#define __vtkImageStencilTranslator_h
+
+#include "vtkObject.h"
+#include "MicroViewConfigure.h"
+
+class vtkImageStencilData;
+
+// .NAME vtkImageStencilTranslator - move a stencil by whole voxels
+// .SECTION Description
+// vtkImageStencilTranslator copies a stencil to a new position, a whole
+// number of voxels away, by offsetting its row extents.  This is much
+// cheaper than regenerating a stencil whose shape hasn't changed.
+
+class VTK_MicroView_EXPORT vtkImageStencilTranslator : public vtkObject
+{
+public:
+  static vtkImageStencilTranslator *New();
+  vtkTypeMacro(vtkImageStencilTranslator, vtkObject);
+
+  // Description:
+  // Copy input into output, offset by (dx, dy, dz) voxels.  The output
+  // keeps the input's origin and spacing.
+  static void Translate(vtkImageStencilData *input, int dx, int dy, int dz,
+                        vtkImageStencilData *output);
+
+protected:
+  vtkImageStencilTranslator() {};
+  ~vtkImageStencilTranslator() {};
+
+private:
+  vtkImageStencilTranslator(const vtkImageStencilTranslator&);  // Not implemented.
+  void operator=(const vtkImageStencilTranslator&);  // Not implemented.
+};
+
+#endif
@@ -5,8 +5,11 @@
 #include "vtkInformation.h"
 #include "vtkInformationExecutivePortKey.h"
 #include "vtkInformationVector.h"
+#include "vtkMultiThreader.h"
 #include "vtkStreamingDemandDrivenPipeline.h"
 
+#include <string.h>
+
 inline double deter_euler3d_rec3_3(double q27[3][3][3]);
 /*
  *  Original notes from Tim Morgan
@@ -49,51 +52,87 @@ vtkImageStereology::vtkImageStereology()
              this->PlZ = this->Euler3D = 0.0;
   this->Threshold = 0.0;
   this->mask = NULL;
+  this->Accumulate = 0;
+  this->ResetAccumulation();
+  this->Threader = vtkMultiThreader::New();
+  this->NumberOfThreads = this->Threader->GetNumberOfThreads();
 }
 
 //----------------------------------------------------------------------------
 vtkImageStereology::~vtkImageStereology()
 {
+  this->Threader->Delete();
+}
+
+//----------------------------------------------------------------------------
+// Clear the running totals used when Accumulate is on
+void vtkImageStereology::ResetAccumulation()
+{
+  this->IntX = this->IntY = this->IntZ = 0;
+  this->IntXO = this->IntYO = this->IntZO = 0;
+  this->numVoxels = 0;
+  this->numBoneVoxels = 0;
+  this->Euler3D = 0.0;
 }
 
 //----------------------------------------------------------------------------
-// This templated function executes the filter for any type of data.
+// Partial sums accumulated by each thread.  Every quantity the filter
+// computes is additive, so the partial sums are simply added together once
+// all threads have finished.  The Euler contributions are all small dyadic
+// fractions, so their double precision sum is exact and doesn't depend on
+// the order in which the slabs are added up.
+struct vtkImageStereologySums
+{
+  long numVoxels;
+  long numBoneVoxels;
+  long numX, numY, numZ;
+  long numXO, numYO, numZO;
+  double euler;
+};
+
+struct vtkImageStereologyThreadStruct
+{
+  vtkImageStereology *Filter;
+  vtkImageData *Data;
+  int Extent[6];
+  vtkImageStereologySums *Sums;
+};
+
+//----------------------------------------------------------------------------
+// This templated function executes the filter for any type of data, over
+// the slab z = zmin..zmax of the interior extent.  Neighbourhoods are read
+// straight from the full input, so slab boundaries need no special care.
 template <class T>
 void vtkImageStereologyExecute(vtkImageStereology *self,
-        vtkImageData *outData, T *ptr)
+        vtkImageData *outData, T *ptr, int ext[6], int zmin, int zmax,
+        int threadId, vtkImageStereologySums *sums)
 {
-  int min0, max0, min1, max1, min2, max2;
+  int min0, max0, min1, max1;
   int x, y, z;
   int i, j, k;
   unsigned char *maskPtr;
   vtkImageData *mask = self->GetImageMask();
-  double threshold = self->GetThreshold();  
+  double threshold = self->GetThreshold();
   long numVoxels = 0;
   long numBoneVoxels = 0;
   long numX = 0, numY = 0, numZ = 0;
   long numXO = 0, numYO = 0, numZO = 0;
   double euler = 0.0;
 
-  double *inSpacing = ((vtkImageData *)self->GetInput())->GetSpacing();
   int increments[3];
   double q27[3][3][3];
 
-  
-  outData->GetExtent(min0, max0, min1, max1, min2, max2);
+  min0 = ext[0]; max0 = ext[1]; min1 = ext[2]; max1 = ext[3];
 
   increments[0] = 1;
-  increments[1] = max0 - min0 + 1;
-  increments[2] = increments[1] * (max1 - min1 + 1);
-
-  min0++; max0--; min1++; max1--; min2++; max2--;
+  increments[1] = max0 - min0 + 3;
+  increments[2] = increments[1] * (max1 - min1 + 3);
 
-  self->UpdateProgress(0.0);
-
-  for (z = min2; z <= max2; z++)
+  for (z = zmin; z <= zmax; z++)
   {
   /* update progress */
-  if (min2 != max2)
-    self->UpdateProgress((z-min2) / (float)(max2-min2));
+  if (!threadId && zmin != zmax)
+    self->UpdateProgress((z-zmin) / (float)(zmax-zmin));
   for (y = min1; y <= max1; y++)
     {
     ptr = (T *) (outData->GetScalarPointer(min0, y, z));
@@ -134,47 +173,145 @@ void vtkImageStereologyExecute(vtkImageStereology *self,
       }
     }
   }
-  self->SetPp((double)numBoneVoxels/(double)numVoxels);
-
-  self->SetIntX(numX);
-  self->SetIntY(numY);
-  self->SetIntZ(numZ);
-  self->SetIntXO(numXO);
-  self->SetIntYO(numYO);
-  self->SetIntZO(numZO);
-
-  self->SetPlX((double) ((numX+numXO)/2.0) / (double) (numVoxels * inSpacing[0]) * 2);
-  self->SetPlY((double) ((numY+numYO)/2.0) / (double) (numVoxels * inSpacing[1]) * 2);
-  self->SetPlZ((double) ((numZ+numZO)/2.0) / (double) (numVoxels * inSpacing[2]) * 2);
-  self->SetPl((self->GetPlX() + self->GetPlY() + self->GetPlZ()) / 3.0);
-  self->SetEuler3D(euler);
-  self->SetnumVoxels(numVoxels);
-  self->UpdateProgress(1.0);
+
+  sums->numVoxels = numVoxels;
+  sums->numBoneVoxels = numBoneVoxels;
+  sums->numX = numX;
+  sums->numY = numY;
+  sums->numZ = numZ;
+  sums->numXO = numXO;
+  sums->numYO = numYO;
+  sums->numZO = numZO;
+  sums->euler = euler;
+}
+
+//----------------------------------------------------------------------------
+// Each thread takes a contiguous z-slab of the interior extent.
+VTK_THREAD_RETURN_TYPE vtkImageStereologyThreadedExecute(void *arg)
+{
+  vtkMultiThreader::ThreadInfo *info =
+    static_cast<vtkMultiThreader::ThreadInfo *>(arg);
+  vtkImageStereologyThreadStruct *str =
+    static_cast<vtkImageStereologyThreadStruct *>(info->UserData);
+  int threadId = info->ThreadID;
+  int numThreads = info->NumberOfThreads;
+  int *ext = str->Extent;
+  int numSlices = ext[5] - ext[4] + 1;
+  int zmin = ext[4] + (int)(((long)numSlices * threadId) / numThreads);
+  int zmax = ext[4] + (int)(((long)numSlices * (threadId + 1)) / numThreads) - 1;
+  void *ptr = NULL;
+
+  if (zmin > zmax)
+    {
+    return VTK_THREAD_RETURN_VALUE;
+    }
+
+  switch (str->Data->GetScalarType())
+    {
+    vtkTemplateMacro(vtkImageStereologyExecute(str->Filter,
+                      str->Data, static_cast<VTK_TT *>(ptr), ext, zmin, zmax,
+                      threadId, &str->Sums[threadId]));
+    default:
+      vtkGenericWarningMacro(<< "Execute: Unknown ScalarType");
+    }
+
+  return VTK_THREAD_RETURN_VALUE;
 }
 
 
 //----------------------------------------------------------------------------
 // This method is passed a input and output region, and executes the filter
-// algorithm to fill the output from the input.
-// It just executes a switch statement to call the correct function for
-// the regions data types.
+// algorithm to fill the output from the input.  The interior of the extent
+// is split into z-slabs that are processed in parallel, and the per-thread
+// partial sums are reduced at the end.
 void vtkImageStereology::ExecuteData(vtkDataObject *out)
 { 
-  void *ptr = NULL;
-  
+  vtkImageStereologyThreadStruct str;
+  int numThreads, numSlices, idx;
+
   // let superclass allocate data
   this->vtkImageInPlaceFilter::ExecuteData(out);
 
   vtkImageData *outData = this->GetOutput();
-  
-  switch (outData->GetScalarType())
+  double *inSpacing = ((vtkImageData *)this->GetInput())->GetSpacing();
+
+  // the outermost layer of voxels is only used as neighbours
+  outData->GetExtent(str.Extent);
+  str.Extent[0]++; str.Extent[1]--;
+  str.Extent[2]++; str.Extent[3]--;
+  str.Extent[4]++; str.Extent[5]--;
+  str.Filter = this;
+  str.Data = outData;
+
+  numSlices = str.Extent[5] - str.Extent[4] + 1;
+  numThreads = this->NumberOfThreads;
+  if (numThreads > numSlices)
     {
-    vtkTemplateMacro(vtkImageStereologyExecute(this,
-                      outData, static_cast<VTK_TT *>(ptr)));
-    default:
-      vtkErrorMacro(<< "Execute: Unknown ScalarType");
-      return;
+    numThreads = numSlices;
+    }
+  if (numThreads < 1)
+    {
+    numThreads = 1;
     }
+
+  str.Sums = new vtkImageStereologySums[numThreads];
+  memset(str.Sums, 0, numThreads * sizeof(vtkImageStereologySums));
+
+  this->UpdateProgress(0.0);
+
+  this->Threader->SetNumberOfThreads(numThreads);
+  this->Threader->SetSingleMethod(vtkImageStereologyThreadedExecute, &str);
+  this->Threader->SingleMethodExecute();
+
+  // reduce the partial sums in slab order
+  vtkImageStereologySums total;
+  memset(&total, 0, sizeof(total));
+  for (idx = 0; idx < numThreads; idx++)
+    {
+    total.numVoxels += str.Sums[idx].numVoxels;
+    total.numBoneVoxels += str.Sums[idx].numBoneVoxels;
+    total.numX += str.Sums[idx].numX;
+    total.numY += str.Sums[idx].numY;
+    total.numZ += str.Sums[idx].numZ;
+    total.numXO += str.Sums[idx].numXO;
+    total.numYO += str.Sums[idx].numYO;
+    total.numZO += str.Sums[idx].numZO;
+    total.euler += str.Sums[idx].euler;
+    }
+  delete [] str.Sums;
+
+  // add in the results of previous executions, e.g. earlier slabs of a
+  // volume that is being streamed through the filter
+  if (this->Accumulate)
+    {
+    total.numVoxels += this->numVoxels;
+    total.numBoneVoxels += this->numBoneVoxels;
+    total.numX += this->IntX;
+    total.numY += this->IntY;
+    total.numZ += this->IntZ;
+    total.numXO += this->IntXO;
+    total.numYO += this->IntYO;
+    total.numZO += this->IntZO;
+    total.euler += this->Euler3D;
+    }
+
+  this->SetPp((double)total.numBoneVoxels/(double)total.numVoxels);
+
+  this->SetIntX(total.numX);
+  this->SetIntY(total.numY);
+  this->SetIntZ(total.numZ);
+  this->SetIntXO(total.numXO);
+  this->SetIntYO(total.numYO);
+  this->SetIntZO(total.numZO);
+
+  this->SetPlX((double) ((total.numX+total.numXO)/2.0) / (double) (total.numVoxels * inSpacing[0]) * 2);
+  this->SetPlY((double) ((total.numY+total.numYO)/2.0) / (double) (total.numVoxels * inSpacing[1]) * 2);
+  this->SetPlZ((double) ((total.numZ+total.numZO)/2.0) / (double) (total.numVoxels * inSpacing[2]) * 2);
+  this->SetPl((this->GetPlX() + this->GetPlY() + this->GetPlZ()) / 3.0);
+  this->SetEuler3D(total.euler);
+  this->SetnumVoxels(total.numVoxels);
+  this->numBoneVoxels = total.numBoneVoxels;
+  this->UpdateProgress(1.0);
 }
 
 
@@ -246,6 +383,8 @@ void vtkImageStereology::PrintSelf(ostream& os, vtkIndent indent)
 
   vtkImageInPlaceFilter::PrintSelf(os,indent);
   os << indent << "Threshold: " << this->Threshold << "\n";
+  os << indent << "NumberOfThreads: " << this->NumberOfThreads << "\n";
+  os << indent << "Accumulate: " << this->Accumulate << "\n";
   os << indent << "Number of voxels used: " << this->numVoxels << "\n";
   os << indent << "Volume used (mm^3): " << (double) this->numVoxels * voxel_volume << "\n";
   os << indent << "Number of Intersections (x,y,z): " << this->GetIntX() << " : " << this->GetIntXO() << ", "
@@ -6,6 +6,8 @@
 #include "vtkImageInPlaceFilter.h"
 #include "vtkImageData.h"
 
+class vtkMultiThreader;
+
 class VTK_MicroView_EXPORT vtkImageStereology : public vtkImageInPlaceFilter
 {
 public:
@@ -47,6 +49,7 @@ public:
 
   vtkSetMacro(numVoxels, long);
   vtkGetMacro(numVoxels, long);
+  vtkGetMacro(numBoneVoxels, long);
 
   double GetBVTV() { return Pp; }
 
@@ -73,6 +76,24 @@ public:
   void SetImageMask(vtkImageData *mask) { this->mask = mask; }
   vtkImageData *GetImageMask() { return this->mask; }
 
+  // Description:
+  // Get/Set the number of threads to create when computing the
+  // stereology.  The volume is split into z-slabs, one per thread.
+  vtkSetClampMacro(NumberOfThreads, int, 1, VTK_MAX_THREADS);
+  vtkGetMacro(NumberOfThreads, int);
+
+  // Description:
+  // When Accumulate is on, each execution adds its counts to those of the
+  // previous executions instead of replacing them.  This allows a large
+  // volume to be streamed through the filter one z-slab at a time: each
+  // slab should include one slice of overlap on either side, since the
+  // outermost layer of the input is only used as neighbours.  Call
+  // ResetAccumulation() before the first slab.
+  vtkSetMacro(Accumulate, int);
+  vtkGetMacro(Accumulate, int);
+  vtkBooleanMacro(Accumulate, int);
+  void ResetAccumulation();
+
 protected:
   double Threshold;
   double Pp;
@@ -88,7 +109,11 @@ protected:
   long IntYO;
   long IntZO;
   long numVoxels;
+  long numBoneVoxels;
+  int Accumulate;
   vtkImageData *mask;
+  int NumberOfThreads;
+  vtkMultiThreader *Threader;
 
   vtkImageStereology();
   ~vtkImageStereology();
@@ -0,0 +1,334 @@
+/************************************************************************/
+/* vtkOrientedROIStencilSource.cxx                                      */
+/*                                                                      */
+/* Stencil for a box, cylinder or ellipsoid ROI under an arbitrary      */
+/* linear transform.                                                    */
+/*                                                                      */
+/* Every (y, z) row of voxels maps to a straight line in the            */
+/* coordinates of the shape, so the part of the row that is inside the  */
+/* shape is a single interval that can be computed directly: the        */
+/* intersection of the line's intervals inside each pair of box slabs,  */
+/* or the roots of a quadratic for the curved shapes.                   */
+/*                                                                      */
+/************************************************************************/
+
+#include "vtkOrientedROIStencilSource.h"
+
+#include "vtkImageStencilData.h"
+#include "vtkInformation.h"
+#include "vtkInformationVector.h"
+#include "vtkLinearTransform.h"
+#include "vtkObjectFactory.h"
+#include "vtkStreamingDemandDrivenPipeline.h"
+
+#include <math.h>
+
+vtkStandardNewMacro(vtkOrientedROIStencilSource);
+vtkCxxSetObjectMacro(vtkOrientedROIStencilSource, Transform, vtkLinearTransform);
+
+//----------------------------------------------------------------------------
+vtkOrientedROIStencilSource::vtkOrientedROIStencilSource()
+{
+  this->SetNumberOfInputPorts(0);
+
+  this->Shape = vtkOrientedROIStencilSource::BOX;
+
+  this->Bounds[0] = 0.0;
+  this->Bounds[1] = 0.0;
+  this->Bounds[2] = 0.0;
+  this->Bounds[3] = 0.0;
+  this->Bounds[4] = 0.0;
+  this->Bounds[5] = 0.0;
+
+  this->Transform = NULL;
+}
+
+//----------------------------------------------------------------------------
+vtkOrientedROIStencilSource::~vtkOrientedROIStencilSource()
+{
+  this->SetTransform(NULL);
+}
+
+//----------------------------------------------------------------------------
+void vtkOrientedROIStencilSource::PrintSelf(ostream& os, vtkIndent indent)
+{
+  this->Superclass::PrintSelf(os,indent);
+
+  os << indent << "Shape: " << this->GetShapeAsString() << "\n";
+  os << indent << "Bounds: " << this->Bounds[0] << " "
+     << this->Bounds[1] << " " << this->Bounds[2] << " "
+     << this->Bounds[3] << " " << this->Bounds[4] << " "
+     << this->Bounds[5] << "\n";
+  os << indent << "Transform: " << this->Transform << "\n";
+}
+
+//----------------------------------------------------------------------------
+const char *vtkOrientedROIStencilSource::GetShapeAsString()
+{
+  switch (this->Shape)
+    {
+    case vtkOrientedROIStencilSource::BOX:
+      return "Box";
+    case vtkOrientedROIStencilSource::ELLIPSOID:
+      return "Ellipsoid";
+    case vtkOrientedROIStencilSource::CYLINDERX:
+      return "CylinderX";
+    case vtkOrientedROIStencilSource::CYLINDERY:
+      return "CylinderY";
+    case vtkOrientedROIStencilSource::CYLINDERZ:
+      return "CylinderZ";
+    }
+  return "";
+}
+
+//----------------------------------------------------------------------------
+unsigned long vtkOrientedROIStencilSource::GetMTime()
+{
+  unsigned long mTime = this->Superclass::GetMTime();
+
+  if (this->Transform)
+    {
+    unsigned long t = this->Transform->GetMTime();
+    if (t > mTime)
+      {
+      mTime = t;
+      }
+    }
+
+  return mTime;
+}
+
+//----------------------------------------------------------------------------
+// Narrow [tmin, tmax] to the part of the line u + t*d for which
+// lo <= u + t*d <= hi.
+static void vtkOrientedROIStencilSourceSlab(double u, double d,
+                                            double lo, double hi,
+                                            double &tmin, double &tmax)
+{
+  if (d == 0.0)
+    {
+    if (u < lo || u > hi)
+      {
+      tmin = VTK_DOUBLE_MAX;
+      tmax = -VTK_DOUBLE_MAX;
+      }
+    return;
+    }
+
+  double t1 = (lo - u) / d;
+  double t2 = (hi - u) / d;
+  if (t1 > t2)
+    {
+    double t = t1; t1 = t2; t2 = t;
+    }
+  if (t1 > tmin)
+    {
+    tmin = t1;
+    }
+  if (t2 < tmax)
+    {
+    tmax = t2;
+    }
+}
+
+//----------------------------------------------------------------------------
+// Narrow [tmin, tmax] to the part of the line u + t*d that is inside the
+// axis-aligned ellipse or ellipsoid with the given center and radii, using
+// only the listed axes.
+static void vtkOrientedROIStencilSourceQuadric(const double u[3], const double d[3],
+                                               const double center[3],
+                                               const double radius[3],
+                                               const int *axes, int numAxes,
+                                               double &tmin, double &tmax)
+{
+  double a = 0.0;
+  double b = 0.0;
+  double c = -1.0;
+
+  for (int i = 0; i < numAxes; i++)
+    {
+    int k = axes[i];
+    if (radius[k] == 0.0)
+      {
+      tmin = VTK_DOUBLE_MAX;
+      tmax = -VTK_DOUBLE_MAX;
+      return;
+      }
+    double uk = (u[k] - center[k]) / radius[k];
+    double dk = d[k] / radius[k];
+    a += dk * dk;
+    b += uk * dk;
+    c += uk * uk;
+    }
+
+  // line parallel to the axis of a cylinder: all in or all out
+  if (a == 0.0)
+    {
+    if (c > 0.0)
+      {
+      tmin = VTK_DOUBLE_MAX;
+      tmax = -VTK_DOUBLE_MAX;
+      }
+    return;
+    }
+
+  double disc = b * b - a * c;
+  if (disc < 0.0)
+    {
+    tmin = VTK_DOUBLE_MAX;
+    tmax = -VTK_DOUBLE_MAX;
+    return;
+    }
+
+  double s = sqrt(disc);
+  double t1 = (-b - s) / a;
+  double t2 = (-b + s) / a;
+  if (t1 > tmin)
+    {
+    tmin = t1;
+    }
+  if (t2 < tmax)
+    {
+    tmax = t2;
+    }
+}
+
+//----------------------------------------------------------------------------
+int vtkOrientedROIStencilSource::RequestData(
+  vtkInformation *request,
+  vtkInformationVector **inputVector,
+  vtkInformationVector *outputVector)
+{
+  int extent[6];
+  double origin[3];
+  double spacing[3];
+
+  // allocates the stencil for the update extent
+  this->Superclass::RequestData(request, inputVector, outputVector);
+
+  vtkInformation *outInfo = outputVector->GetInformationObject(0);
+  vtkImageStencilData *data = vtkImageStencilData::SafeDownCast(
+    outInfo->Get(vtkDataObject::DATA_OBJECT()));
+
+  outInfo->Get(vtkStreamingDemandDrivenPipeline::UPDATE_EXTENT(), extent);
+  outInfo->Get(vtkDataObject::ORIGIN(), origin);
+  outInfo->Get(vtkDataObject::SPACING(), spacing);
+
+  // the shape, inscribed in the bounds
+  double lo[3], hi[3], center[3], radius[3];
+  for (int i = 0; i < 3; i++)
+    {
+    lo[i] = this->Bounds[2*i];
+    hi[i] = this->Bounds[2*i + 1];
+    if (lo[i] > hi[i])
+      {
+      double t = lo[i]; lo[i] = hi[i]; hi[i] = t;
+      }
+    center[i] = 0.5 * (lo[i] + hi[i]);
+    radius[i] = 0.5 * (hi[i] - lo[i]);
+    }
+
+  // the voxel at index (x, y, z) maps to base + x*step[0] + y*step[1] +
+  // z*step[2] in the coordinates of the shape
+  double base[3];
+  double step[3][3];
+  double point[3], tpoint[3];
+  if (this->Transform)
+    {
+    this->Transform->TransformPoint(origin, base);
+    }
+  else
+    {
+    base[0] = origin[0]; base[1] = origin[1]; base[2] = origin[2];
+    }
+  for (int j = 0; j < 3; j++)
+    {
+    point[0] = origin[0]; point[1] = origin[1]; point[2] = origin[2];
+    point[j] += spacing[j];
+    if (this->Transform)
+      {
+      this->Transform->TransformPoint(point, tpoint);
+      }
+    else
+      {
+      tpoint[0] = point[0]; tpoint[1] = point[1]; tpoint[2] = point[2];
+      }
+    for (int i = 0; i < 3; i++)
+      {
+      step[j][i] = tpoint[i] - base[i];
+      }
+    }
+
+  // the axes of the circular cross section, and the axis of a cylinder
+  static const int ellipsoidAxes[3] = { 0, 1, 2 };
+  static const int cylinderAxes[3][2] = { { 1, 2 }, { 0, 2 }, { 0, 1 } };
+  int axis = this->Shape - vtkOrientedROIStencilSource::CYLINDERX;
+
+  // voxels exactly on the surface count as inside, as they do for
+  // vtkImplicitFunctionToImageStencil, so allow for round-off
+  const double tol = 1e-6;
+
+  for (int z = extent[4]; z <= extent[5]; z++)
+    {
+    if (extent[5] > extent[4])
+      {
+      this->UpdateProgress((z - extent[4]) / static_cast<double>(extent[5] - extent[4]));
+      }
+
+    for (int y = extent[2]; y <= extent[3]; y++)
+      {
+      double u[3];
+      for (int i = 0; i < 3; i++)
+        {
+        u[i] = base[i] + y*step[1][i] + z*step[2][i];
+        }
+
+      double tmin = -VTK_DOUBLE_MAX;
+      double tmax = VTK_DOUBLE_MAX;
+
+      switch (this->Shape)
+        {
+        case vtkOrientedROIStencilSource::BOX:
+          for (int i = 0; i < 3; i++)
+            {
+            vtkOrientedROIStencilSourceSlab(u[i], step[0][i], lo[i], hi[i], tmin, tmax);
+            }
+          break;
+        case vtkOrientedROIStencilSource::ELLIPSOID:
+          vtkOrientedROIStencilSourceQuadric(u, step[0], center, radius,
+                                             ellipsoidAxes, 3, tmin, tmax);
+          break;
+        default:
+          vtkOrientedROIStencilSourceSlab(u[axis], step[0][axis], lo[axis], hi[axis],
+                                          tmin, tmax);
+          vtkOrientedROIStencilSourceQuadric(u, step[0], center, radius,
+                                             cylinderAxes[axis], 2, tmin, tmax);
+          break;
+        }
+
+      if (tmin > tmax)
+        {
+        continue;
+        }
+
+      double r1 = ceil(tmin - tol);
+      double r2 = floor(tmax + tol);
+      if (r1 < extent[0])
+        {
+        r1 = extent[0];
+        }
+      if (r2 > extent[1])
+        {
+        r2 = extent[1];
+        }
+      if (r1 <= r2)
+        {
+        data->InsertNextExtent(static_cast<int>(r1), static_cast<int>(r2), y, z);
+        }
+      }
+    }
+
+  this->UpdateProgress(1.0);
+
+  return 1;
+}
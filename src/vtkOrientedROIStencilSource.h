@@ -0,0 +1,78 @@
+#ifndef __vtkOrientedROIStencilSource_h
+#define __vtkOrientedROIStencilSource_h
+
+#include "vtkImageStencilSource.h"
+#include "MicroViewConfigure.h"
+
+class vtkLinearTransform;
+
+// .NAME vtkOrientedROIStencilSource - stencil for an oriented box, cylinder or ellipsoid
+// .SECTION Description
+// vtkOrientedROIStencilSource creates the same stencil as
+// vtkImplicitFunctionToImageStencil would for a vtkBox, a cropped
+// vtkCylinder or a vtkSphere under a linear transform, but without
+// evaluating the implicit function voxel by voxel.  Each (y, z) row of the
+// stencil is a straight line in the coordinates of the shape, so its
+// inside-interval is found directly by intersecting that line with the
+// box's slabs or the quadric.  The cost is proportional to the number of
+// rows rather than the number of voxels.
+
+class VTK_MicroView_EXPORT vtkOrientedROIStencilSource : public vtkImageStencilSource
+{
+public:
+  static vtkOrientedROIStencilSource *New();
+  vtkTypeMacro(vtkOrientedROIStencilSource, vtkImageStencilSource);
+  void PrintSelf(ostream& os, vtkIndent indent);
+
+  enum {
+    BOX = 0,
+    ELLIPSOID = 1,
+    CYLINDERX = 2,
+    CYLINDERY = 3,
+    CYLINDERZ = 4
+  };
+
+  // Description:
+  // The shape, inscribed in the Bounds.  The default is a box.
+  vtkGetMacro(Shape, int);
+  vtkSetClampMacro(Shape, int, BOX, CYLINDERZ);
+  void SetShapeToBox() { this->SetShape(BOX); };
+  void SetShapeToEllipsoid() { this->SetShape(ELLIPSOID); };
+  void SetShapeToCylinderX() { this->SetShape(CYLINDERX); };
+  void SetShapeToCylinderY() { this->SetShape(CYLINDERY); };
+  void SetShapeToCylinderZ() { this->SetShape(CYLINDERZ); };
+  virtual const char *GetShapeAsString();
+
+  // Description:
+  // The bounds of the shape, in the coordinates of the shape.
+  vtkSetVector6Macro(Bounds, double);
+  vtkGetVector6Macro(Bounds, double);
+
+  // Description:
+  // The transform from image coordinates into the coordinates of the
+  // shape, as for vtkImplicitFunction::SetTransform.  No transform is
+  // the same as the identity.
+  virtual void SetTransform(vtkLinearTransform *transform);
+  vtkGetObjectMacro(Transform, vtkLinearTransform);
+
+  // Description:
+  // Take the transform into account.
+  unsigned long GetMTime();
+
+protected:
+  vtkOrientedROIStencilSource();
+  ~vtkOrientedROIStencilSource();
+
+  virtual int RequestData(vtkInformation *, vtkInformationVector **,
+                          vtkInformationVector *);
+
+  int Shape;
+  double Bounds[6];
+  vtkLinearTransform *Transform;
+
+private:
+  vtkOrientedROIStencilSource(const vtkOrientedROIStencilSource&);  // Not implemented.
+  void operator=(const vtkOrientedROIStencilSource&);  // Not implemented.
+};
+
+#endif